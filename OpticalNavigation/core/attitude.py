@@ -255,10 +255,147 @@ def updateQuaternionEstimate(xhatkp, qhatkm):
 def resetSigmaSeed(xhatkp):
     return np.array([[0., 0., 0., xhatkp[3][0], xhatkp[4][0], xhatkp[5][0]]]).T
 
+# Batched attitude engine
+# The sigma set is held as (N x 6) error states and (N x 4) quaternions (N = 2*NX+1) and every sigma point is
+# stepped through the whole gyro timeline at once. The per sigma point functions above are the reference
+# implementation; each function below matches its unbatched counterpart.
+
+def _sigmaWeights(n):
+    """Weights of the n sigma points in the predicted mean and covariance sums"""
+    weights = np.full(n, 1./(2.*(NX+LAM)))
+    weights[0] = (1./(NX + LAM))*LAM
+    return weights
+
+def _weightedCov(dx, dz, weights):
+    return np.dot(dx.T * weights, dz)
+
+def generateSigmasBatch(xhatkp, Phatkp, Q):
+    """Returns the (N x 6) sigma points, interleaved positive/negative as in generateSigmas"""
+    seed = np.array([0., 0., 0., xhatkp[3][0], xhatkp[4][0], xhatkp[5][0]])
+    S = getCholesky(Phatkp, Q)
+    offsets = np.sqrt(NX+LAM)*S.T  # row i is column i of S
+    sigpoints = np.zeros((int(2*NX + 1), int(NX)))
+    sigpoints[0] = seed
+    sigpoints[1::2] = seed + offsets
+    sigpoints[2::2] = seed - offsets
+    return sigpoints
+
+def makeErrorQuaternionBatch(sigmas):
+    deltap = sigmas[:, :3]
+    norm2 = np.linalg.norm(deltap, axis=1)**2.
+    deltaq4p = ((-_a*norm2 + _f*np.sqrt(_f**2. + (1-_a**2.)*norm2))/
+                (_f**2. + norm2))
+    deltaqhatkp = ((1./_f)*(_a + deltaq4p))[:, np.newaxis]*deltap
+    deltaq = np.concatenate((deltaqhatkp, deltaq4p[:, np.newaxis]), axis=1)
+    return deltaq/np.linalg.norm(deltaq, axis=1, keepdims=True)
+
+def quaternionCompositionBatch(firstq, secondq):
+    """
+    [firstq]: (N x 4) quaternions
+    [secondq]: (N x 4) or (4,) quaternions
+    """
+    q1, q2, q3, q4 = firstq[:, 0], firstq[:, 1], firstq[:, 2], firstq[:, 3]
+    mat = np.stack([np.stack([q4, q3, -q2, q1], axis=1),
+                    np.stack([-q3, q4, q1, q2], axis=1),
+                    np.stack([q2, -q1, q4, q3], axis=1),
+                    np.stack([-q1, -q2, -q3, q4], axis=1)], axis=1)
+    return np.einsum('nij,nj->ni', mat, np.broadcast_to(secondq, firstq.shape))
+
+def _normalizeRows(quats):
+    return quats/np.linalg.norm(quats, axis=1, keepdims=True)
+
+def perturbQuaternionEstimateBatch(errorquat, qhatk):
+    return _normalizeRows(quaternionCompositionBatch(errorquat, qhatk.reshape(4)))
+
+def computeBigOmegaBatch(biasEst, gyro_sigma, sample_rate, ws, bs):
+    """
+    Big omega matrices for every sigma point and gyro sample (N x T x 4 x 4)
+    [biasEst]: (N x 3) bias estimates of the sigma points
+    Gyro noise is drawn in the same order as the nested loops of propagateQuaternion/computeBigOmega:
+    per sigma point, per gyro sample, three draws (psi, upper left cosine, lower right cosine)
+    """
+    n, t = biasEst.shape[0], len(ws)
+    omegas = np.array([w.data.reshape(3) for w in ws])
+    noise = np.random.randn(n, t, 3, 3)*gyro_sigma
+    omegaplus = (omegas[np.newaxis, :, np.newaxis, :] + bs.reshape(3)) + noise - biasEst[:, np.newaxis, np.newaxis, :]
+    norms = np.linalg.norm(omegaplus, axis=3)
+
+    psi = (np.sin(0.5*sample_rate*norms[..., 0])/norms[..., 0])[..., np.newaxis] * omegaplus[..., 0, :]
+    oneone = np.cos(0.5*sample_rate*norms[..., 1])
+    lowerright = np.cos(0.5*sample_rate*norms[..., 2])
+
+    p1, p2, p3 = psi[..., 0], psi[..., 1], psi[..., 2]
+    bigO = np.zeros((n, t, 4, 4))
+    # upper left: cos(.)*I - crs(psi)
+    bigO[..., 0, 0] = oneone
+    bigO[..., 1, 1] = oneone
+    bigO[..., 2, 2] = oneone
+    bigO[..., 0, 1] = p3
+    bigO[..., 0, 2] = -p2
+    bigO[..., 1, 0] = -p3
+    bigO[..., 1, 2] = p1
+    bigO[..., 2, 0] = p2
+    bigO[..., 2, 1] = -p1
+    bigO[..., :3, 3] = psi
+    bigO[..., 3, :3] = -psi
+    bigO[..., 3, 3] = lowerright
+    return bigO
+
+def propagateQuaternionBatch(perturbed_quats, sigmas, time_segment, gyro_sigma, gyro_sample_rate, ws, bs, cameradt):
+    """
+    Steps every sigma point quaternion (N x 4) through the gyro timeline at once.
+    See propagateQuaternion for parameters.
+    """
+    bigO = computeBigOmegaBatch(sigmas[:, 3:6], gyro_sigma, gyro_sample_rate, ws[:len(time_segment)], bs)
+    quats = perturbed_quats
+    for j in range(len(time_segment)):
+        quats = _normalizeRows(np.einsum('nij,nj->ni', bigO[:, j], quats))
+    return quats
+
+def propagatedQuaternionErrorBatch(newquats):
+    invquat = newquats[0] * np.array([-1., -1., -1., 1.])
+    return _normalizeRows(quaternionCompositionBatch(newquats, invquat))
+
+def recoverPropSigmaBatch(quat_errors, old_sigmas):
+    top = (_f*quat_errors[:, :3])/(_a + quat_errors[:, 3:4])
+    return np.concatenate((top, old_sigmas[:, 3:6]), axis=1)
+
+def predictedMeanBatch(newsigs):
+    """Returns the (6 x 1) weighted mean of the (N x 6) sigma points"""
+    return np.dot(_sigmaWeights(len(newsigs)), newsigs).reshape(-1, 1)
+
+def predictedCovBatch(newsigs, pred_mean, Q):
+    dx = newsigs - pred_mean.reshape(1, -1)
+    return _weightedCov(dx, dx, _sigmaWeights(len(newsigs))) + Q
+
+def hFromSigsBatch(prop_quaternions, e, m, s):
+    """Returns the (N x 9) expected measurements of the (N x 4) propagated quaternions"""
+    q1, q2, q3, q4 = prop_quaternions[:, 0], prop_quaternions[:, 1], prop_quaternions[:, 2], prop_quaternions[:, 3]
+    A = np.stack([np.stack([1. - 2.*q2**2. - 2.*q3**2., 2.*q1*q2 - 2.*q3*q4, 2.*q1*q3 + 2.*q2*q4], axis=1),
+                  np.stack([2.*q1*q2 + 2.*q3*q4, 1.-2.*q1**2. - 2.*q3**2., 2.*q2*q3 - 2.*q1*q4], axis=1),
+                  np.stack([2.*q1*q3 - 2.*q2*q4, 2.*q1*q4 + 2.*q2*q3, 1.-2.*q1**2. - 2.*q2**2.], axis=1)], axis=1)
+    bodies = np.stack([np.reshape(e, 3), np.reshape(m, 3), np.reshape(s, 3)])
+    return np.einsum('nij,bj->nbi', A, bodies).reshape(len(prop_quaternions), 9)
+
+def meanMeasurementBatch(hlist):
+    """Returns the (9 x 1) normalized weighted mean of the (N x 9) expected measurements"""
+    zmean = np.dot(_sigmaWeights(len(hlist)), hlist).reshape(3, 3)
+    zmean = zmean/np.sqrt(np.sum(zmean**2., axis=1, keepdims=True))
+    return zmean.reshape(9, 1)
+
+def PzzBatch(hlist, zmean, R):
+    dz = hlist - zmean.reshape(1, -1)
+    return _weightedCov(dz, dz, _sigmaWeights(len(hlist))) + R
+
+def PxzBatch(siglist, xmean, hlist, zmean):
+    dx = siglist - xmean.reshape(1, -1)
+    dz = hlist - zmean.reshape(1, -1)
+    return _weightedCov(dx, dz, _sigmaWeights(len(siglist)))
+
 def UKFSingle(cameradt:np.float, gyroVars:GyroVars, P0:np.ndarray, 
             x0:np.ndarray, q0:np.ndarray, omegas, 
             estimatedSatState, moonEph:np.ndarray, 
-            sunEph:np.ndarray, timeline:List[np.float]) -> AttitudeEstimateOutput:
+            sunEph:np.ndarray, timeline:List[np.float], vectorized:bool=True) -> AttitudeEstimateOutput:
     """
     NOTE: Does not make any assumptions about gyroSampleCount
     let n = # of camera measurements in batch
@@ -293,19 +430,36 @@ def UKFSingle(cameradt:np.float, gyroVars:GyroVars, P0:np.ndarray,
     earthVec = (-1*satPos)/np.linalg.norm(satPos)
     moonVec = (moonPos - satPos)/np.linalg.norm(moonPos - satPos)
     sunVec = (sunPos - satPos)/np.linalg.norm(sunPos - satPos)
-    sigma_points = generateSigmas(xhatkp, Phatkp, Q)
-    err_quats = makeErrorQuaternion(sigma_points)
-    pert_quats = perturbQuaternionEstimate(err_quats, qhatkp)
-    prop_quats = propagateQuaternion(pert_quats, sigma_points, timeline, gyro_sigma, gyro_sample_rate, omegas, x0[3:], cameradt)
-    qhatkp1m = prop_quats[0]
-    prop_err = propagatedQuaternionError(prop_quats)
-    prop_sigmas = recoverPropSigma(prop_err, sigma_points)
-    x_mean = predictedMean(prop_sigmas)
-    p_mean = predictedCov(prop_sigmas, x_mean, Q)
-    h_list = hFromSigs(prop_quats, earthVec, moonVec, sunVec)
-    z_mean = meanMeasurement(h_list)
-    Pzz_kp1 = Pzz(h_list, z_mean, R)
-    Pxz_kp1 = Pxz(prop_sigmas, x_mean, h_list, z_mean)
+    if vectorized:
+        sigma_points = generateSigmasBatch(xhatkp, Phatkp, Q)
+        err_quats = makeErrorQuaternionBatch(sigma_points)
+        pert_quats = perturbQuaternionEstimateBatch(err_quats, qhatkp)
+        prop_quats = propagateQuaternionBatch(pert_quats, sigma_points, timeline, gyro_sigma, gyro_sample_rate, omegas,
+                                              x0[3:], cameradt)
+        qhatkp1m = prop_quats[0].reshape(4, 1)
+        prop_err = propagatedQuaternionErrorBatch(prop_quats)
+        prop_sigmas = recoverPropSigmaBatch(prop_err, sigma_points)
+        x_mean = predictedMeanBatch(prop_sigmas)
+        p_mean = predictedCovBatch(prop_sigmas, x_mean, Q)
+        h_list = hFromSigsBatch(prop_quats, earthVec, moonVec, sunVec)
+        z_mean = meanMeasurementBatch(h_list)
+        Pzz_kp1 = PzzBatch(h_list, z_mean, R)
+        Pxz_kp1 = PxzBatch(prop_sigmas, x_mean, h_list, z_mean)
+    else:
+        sigma_points = generateSigmas(xhatkp, Phatkp, Q)
+        err_quats = makeErrorQuaternion(sigma_points)
+        pert_quats = perturbQuaternionEstimate(err_quats, qhatkp)
+        prop_quats = propagateQuaternion(pert_quats, sigma_points, timeline, gyro_sigma, gyro_sample_rate, omegas,
+                                         x0[3:], cameradt)
+        qhatkp1m = prop_quats[0]
+        prop_err = propagatedQuaternionError(prop_quats)
+        prop_sigmas = recoverPropSigma(prop_err, sigma_points)
+        x_mean = predictedMean(prop_sigmas)
+        p_mean = predictedCov(prop_sigmas, x_mean, Q)
+        h_list = hFromSigs(prop_quats, earthVec, moonVec, sunVec)
+        z_mean = meanMeasurement(h_list)
+        Pzz_kp1 = Pzz(h_list, z_mean, R)
+        Pxz_kp1 = Pxz(prop_sigmas, x_mean, h_list, z_mean)
     K = getGain(Pxz_kp1, Pzz_kp1)
     meas = np.concatenate((earthVec, moonVec, sunVec), axis=0).reshape(9, 1)
     assert(z_mean.shape == meas.shape)
@@ -328,7 +482,7 @@ def UKFSingle(cameradt:np.float, gyroVars:GyroVars, P0:np.ndarray,
 def runAttitudeUKF(cameradt:np.float, gyroVars:GyroVars, P0:CovarianceMatrix, 
                 x0:AttitudeStateVector, quat:QuaternionVector, omegas:List[GyroMeasurementVector], 
                 satState, moonEph:np.ndarray, 
-                sunEph:np.ndarray, timeline:List[np.float], singleIteration=False) -> AttitudeEstimateOutput:
+                sunEph:np.ndarray, timeline:List[np.float], singleIteration=False, vectorized=True) -> AttitudeEstimateOutput:
     """
     Runs the attitude UKF and produces attitude estimates in the form of:
         1) attitde error state (Rodriguez Parameters) + bias (size 6x1)
@@ -349,6 +503,8 @@ def runAttitudeUKF(cameradt:np.float, gyroVars:GyroVars, P0:CovarianceMatrix,
     [sunEph]: sun position/vel from ephemeris table (n x gyroSampleCount, 3)
     [timeline]: time deltas of omegas and biases readings: [avg delta t, 2nd-1st, 3rd-2nd, ...]
     [singleIteration]: [True] run single iteration [False] run batch iteration 
+    [vectorized]: [True] propagate all sigma points through the gyro timeline at once with the batched engine
+                  [False] run the per sigma point reference implementation
     returns:
     [Phat_kp1]: new covariance matrix for state estimate (6x6)
     [qhat_kp1]: estimated quaternion state (4x1)
@@ -365,4 +521,5 @@ def runAttitudeUKF(cameradt:np.float, gyroVars:GyroVars, P0:CovarianceMatrix,
     quat.data = quat.data/np.linalg.norm(quat.data)
     # if singleIteration is False:
     #     return UKFMultiple(cameradt, gyroVars, P0, x0, q0, omegas, biases, satState, moonEph, sunEph, timeline)
-    return UKFSingle(cameradt, gyroVars, P0.data.reshape(6,6), x0.data.reshape(6,1), quat.data.reshape(4,1), omegas, satState, moonEph, sunEph, timeline)
\ No newline at end of file
+    return UKFSingle(cameradt, gyroVars, P0.data.reshape(6,6), x0.data.reshape(6,1), quat.data.reshape(4,1), omegas,
+                     satState, moonEph, sunEph, timeline, vectorized=vectorized)
\ No newline at end of file
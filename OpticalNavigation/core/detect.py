@@ -0,0 +1,148 @@
+from OpticalNavigation.core.const import CameraParameters, CisLunarCameraParameters
+from OpticalNavigation.core.find_with_contours import find
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import numpy as np
+import re
+import signal
+import threading
+import utils.parameters as params
+from utils.log import get_log
+
+logger = get_log()
+
+# Body order of the second axis of the detection tensor
+EARTH, MOON, SUN = 0, 1, 2
+
+# Camera id and timestamp [us since reboot] of each detected frame
+FRAME_METADATA_DTYPE = np.dtype([("camera_id", np.int8), ("timestamp", np.int64)])
+
+# Size of a full resolution frame [bytes]
+FRAME_BYTES = 3280 * 2464 * 3
+# find() holds the frame, its blurred copy and the threshold masks at the same time
+FIND_WORKING_SET = 3
+
+def __frame_cost(frame) -> int:
+    """
+    Memory [bytes] find() needs for [frame]. Frames given as paths are decoded by the worker.
+    """
+    nbytes = frame[4].nbytes if isinstance(frame, tuple) else FRAME_BYTES
+    return FIND_WORKING_SET * nbytes
+
+def __frame_metadata(frame):
+    """
+    (camera id, timestamp) of a stream_frames tuple, or parsed from a frame name like cam1_expLow_f0_t123.jpeg
+    """
+    if isinstance(frame, tuple):
+        return frame[0], frame[3]
+    return int(re.search("[cam](\\d+)", frame).group(1)), int(re.search("[t](\\d+)", frame).group(1))
+
+def __find_frame(frame, camera_params:CameraParameters):
+    if isinstance(frame, tuple):
+        camera_id, exposure, _, _, img = frame
+        return find(img, camera_params, camera_id=camera_id, exposure=exposure)
+    return find(frame, camera_params)
+
+def __raise_system_exit(signum, stack_frame):
+    raise SystemExit(f"[OPNAV]: Detection stopped by signal {signum}")
+
+def detect_frames(frames, camera_params:CameraParameters=CisLunarCameraParameters, workers:int=None, memory_cap:int=None):
+    """
+    Runs find() on every frame on a bounded thread pool. OpenCV releases the GIL, so the frames are processed in parallel.
+    [frames]: iterable of frame paths, or of (camera id, exposure, frame index, timestamp, frame) tuples from stream_frames
+    [workers]: number of worker threads, defaults to OPNAV_DETECTION_WORKERS
+    [memory_cap]: bytes of frames held by submitted but unfinished detections, defaults to OPNAV_DETECTION_MEMORY_CAP MB.
+                  Frames are only pulled from [frames] when there is room, at least one frame is always in flight.
+    If the process receives SIGTERM (OpNav subprocess terminated), pending frames are cancelled, the running ones
+    are waited for and SystemExit is raised.
+    @returns
+    [detections]: (number of frames x 3 x 4) array of the [x, y, z, diameter] of the Earth, Moon and Sun in each frame,
+                  NaN where the body was not detected
+    [metadata]: (number of frames) FRAME_METADATA_DTYPE array of the camera id and timestamp of each frame
+    """
+    workers = params.OPNAV_DETECTION_WORKERS if workers is None else workers
+    memory_cap = params.OPNAV_DETECTION_MEMORY_CAP * 2**20 if memory_cap is None else memory_cap
+
+    results = {}
+    metadata = []
+    pending = {}  # future: (frame index, cost)
+    in_flight = 0
+
+    def collect(return_when):
+        nonlocal in_flight
+        done, _ = wait(list(pending), return_when=return_when)
+        for future in done:
+            index, cost = pending.pop(future)
+            in_flight -= cost
+            results[index] = future.result()
+            logger.info(f"[OPNAV]: Image {index + 1}: Earth: {results[index].get_earth_detection()}, "
+                        f"Moon: {results[index].get_moon_detection()}, Sun: {results[index].get_sun_detection()}")
+
+    previous_handler = None
+    if threading.current_thread() is threading.main_thread():
+        previous_handler = signal.signal(signal.SIGTERM, __raise_system_exit)
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="opnav-detect")
+    try:
+        for index, frame in enumerate(frames):
+            cost = __frame_cost(frame)
+            metadata.append(__frame_metadata(frame))
+            # One frame queued per worker at most, and no more frames in memory than the cap allows
+            while pending and (len(pending) >= 2 * workers or in_flight + cost > memory_cap):
+                collect(FIRST_COMPLETED)
+            pending[executor.submit(__find_frame, frame, camera_params)] = (index, cost)
+            in_flight += cost
+        while pending:
+            collect(FIRST_COMPLETED)
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+        if previous_handler is not None:
+            signal.signal(signal.SIGTERM, previous_handler)
+
+    detections = np.full((len(results), 3, 4), np.nan, dtype=np.float64)
+    for index, circles in results.items():
+        bodies = [circles.get_earth_detection(), circles.get_moon_detection(), circles.get_sun_detection()]
+        for body, detection in enumerate(bodies):
+            if detection is not None:
+                detections[index, body] = detection
+    return detections, np.array(metadata, dtype=FRAME_METADATA_DTYPE)
+
+def select_best_detections(detections:np.ndarray, metadata:np.ndarray, camera_params:CameraParameters=CisLunarCameraParameters,
+                           y_rate:float=None, t0:float=None):
+    """
+    Picks the frame closest to the boresight for each body and rotates the detections to the body frame, and
+    optionally to the body frame at the start of the observation, all three bodies at once.
+    [detections]: (number of frames x 3 x 4) detection tensor from detect_frames
+    [metadata]: FRAME_METADATA_DTYPE array of the camera id and timestamp of each frame
+    [y_rate]: rotation rate about the body Y axis; the T0 rotation is skipped when None
+    [t0]: start of the observation [s since reboot]
+    @returns
+    [best]: (3 x 4) array of the [x, y, z, diameter] of the Earth, Moon and Sun, NaN for bodies detected in no frame
+    [frame_indices]: (3) index of the frame each body was taken from
+    """
+    dist = np.hypot(detections[:, :, 0], detections[:, :, 1])
+    found = ~np.isnan(dist).all(axis=0)
+    # Bodies detected in no frame take the first frame, whose detection is NaN
+    frame_indices = np.nanargmin(np.where(found, dist, 0.), axis=0)
+    best = detections[frame_indices, [EARTH, MOON, SUN]].copy()
+
+    # Camera to body frame, frames from unknown cameras are not rotated
+    rotations = np.stack([np.eye(3), camera_params.cam1Rotation, camera_params.cam2Rotation, camera_params.cam3Rotation])
+    camera_ids = metadata["camera_id"][frame_indices]
+    camera_ids = np.where((camera_ids >= 1) & (camera_ids <= 3), camera_ids, 0)
+    best[:, :3] = np.einsum("bij,bj->bi", rotations[camera_ids], best[:, :3])
+
+    if y_rate is not None:
+        # Body to T0: rotate back about Y by the angle turned between the start of the observation and the frame
+        elapsed = metadata["timestamp"][frame_indices] * 1e-6 - t0
+        angle = np.where(found, y_rate * elapsed, 0.)
+        c, s = np.cos(angle), np.sin(angle)
+        t0_rotations = np.zeros((3, 3, 3))
+        t0_rotations[:, 0, 0] = c
+        t0_rotations[:, 0, 2] = s
+        t0_rotations[:, 1, 1] = 1
+        t0_rotations[:, 2, 0] = -s
+        t0_rotations[:, 2, 2] = c
+        best[:, :3] = np.einsum("bij,bj->bi", t0_rotations, best[:, :3])
+    return best, frame_indices
@@ -3,8 +3,12 @@ from dataclasses import dataclass
 import cv2
 import numpy as np
 from math import pi, radians, tan, floor, ceil
+from functools import lru_cache
 import argparse
+import hashlib
+import os
 import re
+from utils.constants import OPNAV_REMAP_DIR
 from utils.log import get_log
 
 logger = get_log()
@@ -55,6 +59,18 @@ class Camera:
         yp = (y / self.ymax_st + 1) * (self.h - 1) / 2
         return xp, yp
 
+    def gn_to_px(self, x, y):
+        """Convert gnomonic coordinates to pixel coordinates."""
+        xp = (x / self.xmax_gn + 1) * (self.w - 1) / 2
+        yp = (y / self.ymax_gn + 1) * (self.h - 1) / 2
+        return xp, yp
+
+
+@lru_cache(maxsize=4)
+def get_camera(hfov, vfov, w, h):
+    """Return the shared Camera for the given field-of-view and resolution."""
+    return Camera(hfov, vfov, w, h)
+
 
 def gn_to_sph(xx, yy):
     """Convert gnomonic coordinates to spherical coordinates."""
@@ -180,8 +196,162 @@ def tile_transform_bb(src, cam, rot, dst):
     return c, bb
 
 
-def remap_roi(img, src, cam, rot):
+# Remap table cache
+# The stereographic reprojection only depends on the camera, its rotation axis and the rotation per row, so the
+# inverse map (stereographic pixel -> gnomonic source pixel) is computed once per rotation rate bucket, sampled on a
+# coarse grid, and kept in memory and as a .npy file under OPNAV_REMAP_DIR that is memory-mapped by later OpNav runs.
+
+# Width of a rotation rate bucket [rad per row]
+REMAP_OMEGA_DT_QUANTUM = 1e-6
+# Spacing of the remap table grid [px]; the map is interpolated bilinearly between grid nodes
+REMAP_GRID_STEP = 8
+# Fixed-point iterations used to invert the rolling shutter rotation
+REMAP_ITERATIONS = 8
+
+_remap_tables = {}
+
+
+@dataclass
+class RemapTable:
+    """Inverse stereographic reprojection of a rotating camera, sampled every [step] pixels.
+
+    x0, y0: Stereographic pixel coordinates of the first grid node
+    step: Grid spacing [px]
+    grid: (ny, nx, 2) float32 array of gnomonic source pixel coordinates (x, y) of each grid node
+    """
+
+    x0: int
+    y0: int
+    step: int
+    grid: np.ndarray
+
+    def map(self, bb):
+        """Return the cv2.remap-ready (bb.h, bb.w, 2) float32 map of the stereographic pixels in bounding box [bb]."""
+        ny, nx, _ = self.grid.shape
+        fx = (np.arange(bb.x0, bb.x0 + bb.w, dtype=np.float32) - self.x0) / self.step
+        fy = (np.arange(bb.y0, bb.y0 + bb.h, dtype=np.float32) - self.y0) / self.step
+        ix = np.clip(np.floor(fx).astype(np.intp), 0, nx - 2)
+        iy = np.clip(np.floor(fy).astype(np.intp), 0, ny - 2)
+        wx = (fx - ix.astype(np.float32))[np.newaxis, :, np.newaxis]
+        wy = (fy - iy.astype(np.float32))[:, np.newaxis, np.newaxis]
+
+        # Interpolate along rows on the few grid rows needed, then along columns
+        rows = np.asarray(self.grid[iy[0]:(iy[-1] + 2)])
+        cols = rows[:, ix] * (1 - wx) + rows[:, ix + 1] * wx
+        iy -= iy[0]
+        return cols[iy] * (1 - wy) + cols[iy + 1] * wy
+
+
+def quantize_rotation(rot):
+    """Return the rotation rate bucket of [rot] and the rotation at the center of the bucket."""
+    bucket = int(round(rot.omega_dt / REMAP_OMEGA_DT_QUANTUM))
+    return bucket, CameraRotation(rot.u, bucket * REMAP_OMEGA_DT_QUANTUM)
+
+
+def st_extent(cam, rot, step=32):
+    """Bounding box of the stereographic pixels reached by the whole frame."""
+    xp = np.append(np.arange(0, cam.w, step), cam.w - 1)
+    yp = np.append(np.arange(0, cam.h, step), cam.h - 1)
+    x, _ = cam.normalize_gn(xp, 0)
+    _, y = cam.normalize_gn(0, yp)
+    rs = rotate(rot, gn_to_sph(x, y), np.repeat(yp[:, np.newaxis], len(xp), axis=1))
+    xstp, ystp = cam.st_to_px(*sph_to_st(rs))
+    xmin, ymin = floor(np.min(xstp)), floor(np.min(ystp))
+    return BoundingBox(xmin, ymin, ceil(np.max(xstp)) - xmin + 1, ceil(np.max(ystp)) - ymin + 1)
+
+
+def build_remap_table(cam, rot, step=REMAP_GRID_STEP):
+    """Compute the inverse reprojection map of [cam] rotating by [rot] on a grid of spacing [step].
+
+    Each stereographic grid node is taken to the unit sphere and rotated back by the angle of the row it was
+    read out on. That row depends on the answer, so the rotation is found by fixed-point iteration
+    (the angle changes by omega_dt per row, so this converges in a few steps).
+    """
+    ext = st_extent(cam, rot)
+    x0, y0 = ext.x0 - step, ext.y0 - step
+    nx = int(ceil((ext.w + 2 * step) / step)) + 1
+    ny = int(ceil((ext.h + 2 * step) / step)) + 1
+    xst, _ = cam.normalize_st(x0 + step * np.arange(nx, dtype=np.float64), 0)
+    _, yst = cam.normalize_st(0, y0 + step * np.arange(ny, dtype=np.float64))
+    xst, yst = np.meshgrid(xst, yst)
+
+    # Inverse of sph_to_st, camera looking down -z
+    norm = xst ** 2 + yst ** 2 + 4
+    d = np.stack((4 * xst / norm, 4 * yst / norm, (norm - 8) / norm), axis=-1)
+
+    u = np.asarray(rot.u, dtype=np.float64)
+    s = d
+    for _ in range(REMAP_ITERATIONS):
+        _, row = cam.gn_to_px(0, s[:, :, 1] / -s[:, :, 2])
+        # Rodrigues rotation of d about u by +omega_dt * row, undoing the readout rotation
+        th = (rot.omega_dt * row)[:, :, np.newaxis]
+        s = d * np.cos(th) + np.cross(u, d) * np.sin(th) + u * (d @ u)[:, :, np.newaxis] * (1 - np.cos(th))
+
+    xp, yp = cam.gn_to_px(s[:, :, 0] / -s[:, :, 2], s[:, :, 1] / -s[:, :, 2])
+    grid = np.stack((xp, yp), axis=-1).astype(np.float32)
+    # Directions behind the camera have no source pixel
+    grid[s[:, :, 2] >= 0] = -1
+    return RemapTable(x0, y0, step, grid)
+
+
+def remap_table_key(camera_params, cam_num, cam, bucket, step=REMAP_GRID_STEP):
+    rotation = getattr(camera_params, f"cam{cam_num}Rotation", np.eye(3))
+    params = repr((camera_params.hFov, camera_params.vFov, cam.w, cam.h, cam_num, bucket, step,
+                   np.round(rotation, 12).tolist()))
+    return f"cam{cam_num}_{hashlib.sha1(params.encode()).hexdigest()[:16]}"
+
+
+def get_remap_table(camera_params, cam_num, cam, rot, cache_dir=OPNAV_REMAP_DIR):
+    """Return the remap table of camera [cam_num] rotating by [rot] (rounded to its rotation rate bucket).
+
+    Tables are looked up in memory, then memory-mapped from [cache_dir], and only built when neither has them.
+    [cache_dir]: directory of the persisted tables, None to keep them in memory only
+    """
+    bucket, qrot = quantize_rotation(rot)
+    key = remap_table_key(camera_params, cam_num, cam, bucket)
+    table = _remap_tables.get(key)
+    if table is not None:
+        return table
+
+    ext = st_extent(cam, qrot)
+    x0, y0 = ext.x0 - REMAP_GRID_STEP, ext.y0 - REMAP_GRID_STEP
+    path = os.path.join(cache_dir, key + ".npy") if cache_dir is not None else None
+    if path is not None and os.path.exists(path):
+        try:
+            table = RemapTable(x0, y0, REMAP_GRID_STEP, np.load(path, mmap_mode="r"))
+        except (OSError, ValueError) as e:
+            logger.warning(f"[OPNAV]: Could not load remap table {path}: {e}")
+
+    if table is None:
+        logger.info(f"[OPNAV]: Building remap table for camera {cam_num}, omega dt {qrot.omega_dt}")
+        table = build_remap_table(cam, qrot)
+        if path is not None:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                np.save(path, table.grid)
+            except OSError as e:
+                logger.warning(f"[OPNAV]: Could not save remap table {path}: {e}")
+
+    _remap_tables[key] = table
+    return table
+
+
+def remap_roi(img, src, cam, rot, table=None):
+    """Reproject the region [src] of gnomonic image [img] to stereographic coordinates.
+
+    [table]: RemapTable of the camera and rotation; when None the region is warped tile by tile instead
+    Returns the stereographic image and its bounding box in stereographic pixel coordinates.
+    """
     _, bb0 = tile_transform_bb(src, cam, rot, BoundingBox(0, 0, 0, 0))
+    if table is not None:
+        out = np.zeros((bb0.h, bb0.w, 3), dtype=np.uint8)
+        m = table.map(bb0)
+        # Only use data from the region, as the tiled warp does
+        m -= np.array([src.x0, src.y0], dtype=np.float32)
+        cv2.remap(img[src.y0:(src.y1() + 1), src.x0:(src.x1() + 1)], m, None, cv2.INTER_CUBIC,
+                  dst=out, borderMode=cv2.BORDER_TRANSPARENT)
+        return out, bb0
+
     out = np.zeros((bb0.h, bb0.w, 3), dtype=np.uint8)
     dst = BoundingBox(0, 0, bb0.w, bb0.h)
 
@@ -269,12 +439,26 @@ def measureMoon(img):
     return None
 
 
-def find(src, camera_params:CameraParameters=CisLunarCameraParameters):
-    cam = Camera(radians(camera_params.hFov), radians(camera_params.vFov), 3280, 2464)
+def find(src, camera_params:CameraParameters=CisLunarCameraParameters, remap_cache_dir=OPNAV_REMAP_DIR,
+         camera_id=None, exposure=None):
+    """
+    [src]: path of the frame (camera id and exposure are parsed from its name), or the (hxwx3) frame itself
+    [camera_id], [exposure]: camera id and exposure ("Low" or "High") of the frame, required when [src] is an array
+    [remap_cache_dir]: directory of the persisted remap tables, None to keep them in memory only
+    """
+    cam = get_camera(radians(camera_params.hFov), radians(camera_params.vFov), 3280, 2464)
+
+    if isinstance(src, np.ndarray):
+        if camera_id is None or exposure is None:
+            raise ValueError("find needs the camera id and exposure of a frame passed as an array")
+        camNum = int(camera_id)
+        lowExposure = exposure == "Low"
+    else:
+        camNum = int(re.search("[cam](\d+)", src).group(1))
+        lowExposure = "Low" in src
 
     # u is in body frame here
     u = np.array([0, 1, 0], dtype=np.float32)
-    camNum = int(re.search("[cam](\d+)", src).group(1))
     if camNum == 1:
         u = np.linalg.inv(camera_params.cam1Rotation).dot(u)
     elif camNum == 2:
@@ -285,13 +469,17 @@ def find(src, camera_params:CameraParameters=CisLunarCameraParameters):
     omega = -5
     dt = 18.904e-6
     rot = CameraRotation(u, -omega * dt)
+    table = get_remap_table(camera_params, camNum, cam, rot, cache_dir=remap_cache_dir)
 
     result = ImageDetectionCircles()
 
-    img = cv2.imread(src)
-
-    # In-place blur to reduce noise, avoid hot pixels
-    img = cv2.GaussianBlur(img, (5, 5), 0, dst=img)
+    if isinstance(src, np.ndarray):
+        # Blur into a new image, the caller's frame is left untouched
+        img = cv2.GaussianBlur(src, (5, 5), 0)
+    else:
+        img = cv2.imread(src)
+        # In-place blur to reduce noise, avoid hot pixels
+        img = cv2.GaussianBlur(img, (5, 5), 0, dst=img)
 
     # Extract and threshold channels
     bwThreshRed = cv2.inRange(img, (0, 0, 50), (255, 255, 255))
@@ -301,8 +489,8 @@ def find(src, camera_params:CameraParameters=CisLunarCameraParameters):
 
     contours = cv2.findContours(bw, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
 
-    # Hack around API breakage between OpenCV versions
-    contours = contours[0] if len(contours) == 2 else contours[1]
+    # Hack around API breakage between OpenCV versions (newer versions also return a tuple)
+    contours = list(contours[0] if len(contours) == 2 else contours[1])
     if len(contours) is 0:
         logger.info("[OPNAV]: No countours found")
         return result
@@ -316,7 +504,7 @@ def find(src, camera_params:CameraParameters=CisLunarCameraParameters):
 
     x, y, w, h = bufferedRoi(x, y, w, h, cam.w, cam.h, 16)
     box = BoundingBox(x, y, w, h)
-    out, bbst = remap_roi(img, box, cam, rot)
+    out, bbst = remap_roi(img, box, cam, rot, table)
 
     # Gets the next largest body that doesn't overlap with first body
     c2 = None
@@ -333,14 +521,14 @@ def find(src, camera_params:CameraParameters=CisLunarCameraParameters):
 
     x2, y2, w2, h2 = bufferedRoi(x2, y2, w2, h2, cam.w, cam.h, 16)
     box2 = BoundingBox(x2, y2, w2, h2)
-    out2, bbst2 = remap_roi(img, box2, cam, rot)
+    out2, bbst2 = remap_roi(img, box2, cam, rot, table)
 
     # Measure body in region-of-interest
     sun = None
     earth = None
     moon = None
 
-    if "Low" in src:
+    if lowExposure:
         for f in [out]:
             sun = measureSun(f)
             if sun is not None:
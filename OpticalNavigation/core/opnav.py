@@ -5,8 +5,9 @@ from OpticalNavigation.core.cam_meas import cameraMeasurements
 import OpticalNavigation.core.ukf as traj_ukf
 import OpticalNavigation.core.attitude as attitude
 from OpticalNavigation.core.sense import select_camera, record_video, record_gyro
-from OpticalNavigation.core.preprocess import extract_frames
+from OpticalNavigation.core.preprocess import stream_frames
 from OpticalNavigation.core.find_with_contours import *
+from OpticalNavigation.core.detect import detect_frames, select_best_detections, EARTH, MOON, SUN
 from OpticalNavigation.core.const import OPNAV_EXIT_STATUS, CisLunarCameraParameters, CisLunarCamRecParams
 import numpy as np
 import traceback
@@ -15,12 +16,10 @@ from utils.db import create_sensor_tables_from_path, OpNavTrajectoryStateModel,
 from utils.db import OpNavEphemerisModel, OpNavCameraMeasurementModel, OpNavPropulsionModel, OpNavGyroMeasurementModel, RebootsModel
 from utils.constants import DB_FILE
 from utils.log import *
-from datetime import datetime, timedelta
+from datetime import datetime
 import math
 from sqlalchemy import desc
 from sqlalchemy.orm import session
-import re
-import glob
 
 logger = get_log()
 
@@ -30,18 +29,10 @@ Entry point into OpNav. This method calls observe() and process().
 ####### helper functions #######
 def __get_covariance_matrix_from_state(state_entry) -> CovarianceMatrix:
     """
-    Obtains 6x6 covariance matrix from state entry. Column names should be in the following format:
-    r#c# where 1 <= # <= 6
+    Obtains 6x6 covariance matrix from state entry. The covariance column decodes to a read-only
+    (6, 6) view of the stored bytes, so no Python floats are allocated.
     """
-    a_P = [
-        [state_entry.r1c1, state_entry.r1c2, state_entry.r1c3, state_entry.r1c4, state_entry.r1c5, state_entry.r1c6],
-        [state_entry.r2c1, state_entry.r2c2, state_entry.r2c3, state_entry.r2c4, state_entry.r2c5, state_entry.r2c6],
-        [state_entry.r3c1, state_entry.r3c2, state_entry.r3c3, state_entry.r3c4, state_entry.r3c5, state_entry.r3c6],
-        [state_entry.r4c1, state_entry.r4c2, state_entry.r4c3, state_entry.r4c4, state_entry.r4c5, state_entry.r4c6],
-        [state_entry.r5c1, state_entry.r5c2, state_entry.r5c3, state_entry.r5c4, state_entry.r5c5, state_entry.r5c6],
-        [state_entry.r6c1, state_entry.r6c2, state_entry.r6c3, state_entry.r6c4, state_entry.r6c5, state_entry.r6c6],
-    ]
-    return CovarianceMatrix(matrix=np.array(a_P, dtype=np.float).reshape(6,6))
+    return CovarianceMatrix(matrix=state_entry.covariance)
 
 def __process_propulsion_events(session: session.Session) -> OPNAV_EXIT_STATUS:
     """
@@ -157,94 +148,19 @@ def __observe(session: session.Session, gyro_count: int, camera_params:CameraPar
         recordings.append(filename_timestamp1)
         recordings.append(filename_timestamp2)
 
-    ##### Commented out for software demo
-    #logger.info("[OPNAV]: Extracting frames...")
-    # TODO: What is format of vid_dir / where is file stored? recordings[i][0]?
-    #frames0 = extract_frames(vid_dir=recordings[0][0], endTimestamp = recordings[0][1])
-    #frames1 = extract_frames(vid_dir=recordings[1][0], endTimestamp = recordings[1][1])
-    #frames2 = extract_frames(vid_dir=recordings[2][0], endTimestamp = recordings[2][1])
-    #frames3 = extract_frames(vid_dir=recordings[3][0], endTimestamp = recordings[3][1])
-    #frames4 = extract_frames(vid_dir=recordings[4][0], endTimestamp = recordings[4][1])
-    #frames5 = extract_frames(vid_dir=recordings[5][0], endTimestamp = recordings[5][1])
-    #frames = frames0 + frames1 + frames2 + frames3 + frames4 + frames5
-    #####
+    logger.info("[OPNAV]: Streaming frames...")
+    # Frames are decoded in memory as (camera id, exposure, frame index, timestamp, frame) tuples and passed to
+    # find(frame, camera_id=..., exposure=...); set debug_dir to also write every frame to a jpeg
+    frames = stream_frames(recordings, debug_dir=None)
+    # For the software demo, detect on prerendered images instead of the recordings:
     # On Stephen's VM: /home/stephen_z/PycharmProjects/FlightSoftware/OpticalNavigation/tests/surrender_images/*.jpg
     # On HITL, path to images will be /home/pi/surrender_images/*.jpg
-    #frames = glob.glob("/home/stephen_z/PycharmProjects/FlightSoftware/OpticalNavigation/tests/surrender_images/*.jpg")
-    frames = glob.glob("/home/pi/surrender_images/*.jpg")
-    logger.info(f"[OPNAV]: Total number of frames is {len(frames)}")
+    #frames = glob.glob("/home/pi/surrender_images/*.jpg")
 
-    #These arrays take the form (number if frame number): [[x0,y0,z0,diameter0], [x1,y1,z1,diameter1], ...]
-    earthDetectionArray = np.zeros((len(frames), 4), dtype = np.float)
-    moonDetectionArray = np.zeros((len(frames), 4), dtype = np.float)
-    sunDetectionArray = np.zeros((len(frames), 4), dtype = np.float)
+    # detections: (number of frames x 3 x 4) [x, y, z, diameter] of the Earth, Moon and Sun in each frame
     logger.info("[OPNAV]: Finding...")
-    progress = 1
-    for f in range(len(frames)):
-        logger.info(f"[OPNAV]: Image {progress}/96: {frames[f]}")
-        imageDetectionCircles = find(frames[f])# Puts results in ImageDetectionCircles object which is then accessed by next lines
-        earthDetectionArray[f, ...] = imageDetectionCircles.get_earth_detection()
-        moonDetectionArray[f, ...] = imageDetectionCircles.get_moon_detection()
-        sunDetectionArray[f, ...] = imageDetectionCircles.get_sun_detection()
-        logger.info(f"[OPNAV]: Result: Earth: {imageDetectionCircles.get_earth_detection()}, Moon: {imageDetectionCircles.get_moon_detection()}, Sun: {imageDetectionCircles.get_sun_detection()}")
-        progress += 1
-
-
-    # best___Tuple is tuple of file, distance and vector of best result
-
-    # Find the distance to center
-    logger.info("[OPNAV]: Finding best frames...")
-    earthCenterDistances = []
-    for e in range(earthDetectionArray.shape[0]):
-        dist = math.sqrt(earthDetectionArray[e, 0]**2 + earthDetectionArray[e, 1]**2)
-        earthCenterDistances.append(dist)
-    earthFileDistVec = list(zip(frames, earthCenterDistances, earthDetectionArray))
-    bestEarthTuple = earthFileDistVec[0]
-    for e in earthFileDistVec:
-        if np.isnan(e[1]):
-            continue
-        if e[1] < bestEarthTuple[1] or np.isnan(bestEarthTuple[1]):
-            bestEarthTuple = e
-
-    moonCenterDistances = []
-    for m in range(moonDetectionArray.shape[0]):
-        dist = math.sqrt(moonDetectionArray[m, 0]**2 + moonDetectionArray[m, 1]**2)
-        moonCenterDistances.append(dist)
-    moonFileDistVec = list(zip(frames, moonCenterDistances, moonDetectionArray))
-    bestMoonTuple = moonFileDistVec[0]
-    for m in moonFileDistVec:
-        if np.isnan(m[1]):
-            continue
-        if m[1] < bestMoonTuple[1] or np.isnan(bestMoonTuple[1]):
-            bestMoonTuple = m
-
-    sunCenterDistances = []
-    for s in range(sunDetectionArray.shape[0]):
-        dist = math.sqrt(sunDetectionArray[s, 0]**2 + sunDetectionArray[s, 1]**2)
-        sunCenterDistances.append(dist)
-    sunFileDistVec = list(zip(frames, sunCenterDistances, sunDetectionArray))
-    bestSunTuple = sunFileDistVec[0]
-    for s in sunFileDistVec:
-        if np.isnan(s[1]):
-            continue
-        if s[1] < bestSunTuple[1] or np.isnan(bestSunTuple[1]):
-            bestSunTuple = s
-
-    # We now have the best result for earth, moon and sun; time to rotate vectors
-
-    logger.info("[OPNAV]: Performing camera to body rotations...")
-    for data in bestEarthTuple, bestMoonTuple, bestSunTuple:
-        coordArray = np.array([data[2][0], data[2][1], data[2][2]]).reshape(3, 1)
-        camNum = int(re.search("[cam](\d+)", data[0]).group(1))
-        if camNum == 1:
-            coordArray = (camera_params.cam1Rotation).dot(coordArray)
-        elif camNum == 2:
-            coordArray = (camera_params.cam2Rotation).dot(coordArray)
-        elif camNum == 3:
-            coordArray = (camera_params.cam3Rotation).dot(coordArray)
-        data[2][0] = coordArray[0]
-        data[2][1] = coordArray[1]
-        data[2][2] = coordArray[2]
+    detections, metadata = detect_frames(frames, camera_params)
+    logger.info(f"[OPNAV]: Total number of frames is {len(metadata)}")
 
     logger.info("[OPNAV]: Gathering gyro measurements...")
     gyro_meas = record_gyro(count=gyro_count)
@@ -259,56 +175,25 @@ def __observe(session: session.Session, gyro_count: int, camera_params:CameraPar
         session.add(new_entry)
     # TODO: Make sure that axes are correct - i.e. are consistent with what UKF expects
 
-    logger.info("[OPNAV]: Body to T0 rotation...")
-    avgGyroY = np.mean(gyro_meas, axis = 0)[1] * 180 / math.pi
     # Rotation is product of angular speed and time between frame and start of observation
+    avgGyroY = np.mean(gyro_meas, axis = 0)[1] * 180 / math.pi
     lastRebootRow = session.query(RebootsModel).order_by(desc('reboot_at')).first()
     lastReboot = lastRebootRow.reboot_at
 
-    if not np.isnan(bestEarthTuple[1]):
-        earthTimestamp = int(re.search("[t](\d+)", bestEarthTuple[0]).group(1))
-        dateTimeEarth = lastReboot + timedelta(microseconds=earthTimestamp)
-        earthTimeElapsed = (dateTimeEarth - observeStart).total_seconds()
-        earthRotation = avgGyroY * earthTimeElapsed
-        tZeroEarthRotation = np.array([math.cos(earthRotation), 0, math.sin(earthRotation), 0, 1, 0, -1 * math.sin(earthRotation), 0, math.cos(earthRotation)]).reshape(3, 3)
-        coordArray = np.array([bestEarthTuple[2][0], bestEarthTuple[2][1], bestEarthTuple[2][2]]).reshape(3, 1)
-        coordArray = tZeroEarthRotation.dot(coordArray)
-        bestEarthTuple[2][1] = coordArray[1]
-        bestEarthTuple[2][2] = coordArray[2]
-        bestEarthTuple[2][0] = coordArray[0]
-
-    if not np.isnan(bestMoonTuple[1]):
-        moonTimestamp = int(re.search("[t](\d+)", bestMoonTuple[0]).group(1))
-        dateTimeMoon = lastReboot + timedelta(microseconds=moonTimestamp)
-        moonTimeElapsed = (dateTimeMoon - observeStart).total_seconds()
-        moonRotation = avgGyroY * moonTimeElapsed
-        tZeroMoonRotation = np.array([math.cos(moonRotation), 0, math.sin(moonRotation), 0, 1, 0, -1 * math.sin(moonRotation), 0, math.cos(moonRotation)]).reshape(3, 3)
-        coordArray = np.array([bestMoonTuple[2][0], bestMoonTuple[2][1], bestMoonTuple[2][2]]).reshape(3, 1)
-        coordArray = tZeroMoonRotation.dot(coordArray)
-        bestMoonTuple[2][1] = coordArray[1]
-        bestMoonTuple[2][2] = coordArray[2]
-        bestMoonTuple[2][0] = coordArray[0]
-
-    if not np.isnan(bestSunTuple[1]):
-        sunTimestamp = int(re.search("[t](\d+)", bestSunTuple[0]).group(1))
-        dateTimeSun = lastReboot + timedelta(microseconds=sunTimestamp)
-        sunTimeElapsed = (dateTimeSun - observeStart).total_seconds()
-        sunRotation = avgGyroY * sunTimeElapsed
-        tZeroSunRotation = np.array([math.cos(sunRotation), 0, math.sin(sunRotation), 0, 1, 0, -1 * math.sin(sunRotation), 0, math.cos(sunRotation)]).reshape(3, 3)
-        coordArray = np.array([bestSunTuple[2][0], bestSunTuple[2][1], bestSunTuple[2][2]]).reshape(3, 1)
-        coordArray = tZeroSunRotation.dot(coordArray)
-        bestSunTuple[2][1] = coordArray[1]
-        bestSunTuple[2][2] = coordArray[2]
-        bestSunTuple[2][0] = coordArray[0]
+    # Pick the frames closest to the center and rotate camera -> body -> T0 for all bodies at once
+    logger.info("[OPNAV]: Finding best frames and performing camera to body to T0 rotations...")
+    best, bestFrames = select_best_detections(detections, metadata, camera_params,
+                                              y_rate=avgGyroY, t0=(observeStart - lastReboot).total_seconds())
+    logger.info(f"[OPNAV]: Best frames: Earth {bestFrames[EARTH]}, Moon {bestFrames[MOON]}, Sun {bestFrames[SUN]}")
 
     bestDetectedCircles = ImageDetectionCircles()
-    bestDetectedCircles.set_earth_detection(bestEarthTuple[2][0], bestEarthTuple[2][1], bestEarthTuple[2][2], bestEarthTuple[2][3])
-    bestDetectedCircles.set_moon_detection(bestMoonTuple[2][0], bestMoonTuple[2][1], bestMoonTuple[2][2], bestMoonTuple[2][3])
-    bestDetectedCircles.set_sun_detection(bestSunTuple[2][0], bestSunTuple[2][1], bestSunTuple[2][2], bestSunTuple[2][3])
+    bestDetectedCircles.set_earth_detection(*best[EARTH])
+    bestDetectedCircles.set_moon_detection(*best[MOON])
+    bestDetectedCircles.set_sun_detection(*best[SUN])
     # As tuples
-    best_e = (bestEarthTuple[2][0], bestEarthTuple[2][1], bestEarthTuple[2][2], bestEarthTuple[2][3])
-    best_m = (bestMoonTuple[2][0], bestMoonTuple[2][1], bestMoonTuple[2][2], bestMoonTuple[2][3])
-    best_s = (bestSunTuple[2][0], bestSunTuple[2][1], bestSunTuple[2][2], bestSunTuple[2][3])
+    best_e = tuple(best[EARTH])
+    best_m = tuple(best[MOON])
+    best_s = tuple(best[SUN])
     ######
 
     logger.info(f"[OPNAV]: Best Earth {best_e}")
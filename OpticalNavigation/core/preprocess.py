@@ -1,7 +1,9 @@
 from __future__ import division
 from math import *
+from functools import lru_cache
 import cv2
 import os
+import re
 import numpy as np
 from OpticalNavigation.core.const import CisLunarCameraParameters, CisLunarCamRecParams
 import time
@@ -16,6 +18,64 @@ def rolling_shutter(img):
     time.sleep(3)
     raise NotImplementedError("implement rolling shutter transformation")
 
+def frame_timestamp(endTimestamp, frameIndex, camera_rec_params=CisLunarCamRecParams):
+    """
+    Timestamp [us] of frame [frameIndex] of a recording that ended at [endTimestamp]
+    """
+    # TODO: How to incorporate total number of frames, fps
+    frames_after = (camera_rec_params.recTime * camera_rec_params.fps + 1) - 1 - frameIndex
+    timestamp = endTimestamp - frames_after * (1 / camera_rec_params.fps * 10 ** 6)
+    return ceil(timestamp)
+
+def frame_name(vid_dir, frameIndex, timestamp):
+    """
+    Name of the jpeg of a frame of the video at [vid_dir], e.g. cam1_expLow_f0_t123.jpeg
+    """
+    base = os.path.splitext(os.path.basename(vid_dir))[0]
+    return base + f"_f{frameIndex}_t{timestamp}.jpeg"
+
+def parse_recording_name(vid_dir):
+    """
+    Returns (camera id, exposure) of a recording named like cam1_expLow.mjpeg
+    """
+    match = re.search(r"cam(\d+)_exp([A-Za-z]+)", os.path.basename(vid_dir))
+    if match is None:
+        raise ValueError(f"Recording name {vid_dir} does not contain a camera id and exposure")
+    return int(match.group(1)), match.group(2)
+
+def read_frames(vid_dir, endTimestamp):
+    """
+    Decodes the video located at path [vid_dir] in memory
+    @yields
+    (frame index, timestamp [us], (hxwx3) frame)
+    """
+    src = cv2.VideoCapture(vid_dir)
+    try:
+        currentFrame = 0
+        while True:
+            ret, frame = src.read()
+            if not ret:
+                break
+            yield currentFrame, frame_timestamp(endTimestamp, currentFrame), frame
+            currentFrame += 1
+    finally:
+        src.release()
+
+def stream_frames(recordings, debug_dir=None):
+    """
+    Streams the frames of the OpNav recordings without writing them to disk
+    [recordings]: list of (video path, end timestamp) as returned by record_video
+    [debug_dir]: if set, every frame is also written to a jpeg in this directory (named as extract_frames names them)
+    @yields
+    (camera id, exposure, frame index, timestamp [us], (hxwx3) frame)
+    """
+    for vid_dir, endTimestamp in recordings:
+        camera_id, exposure = parse_recording_name(vid_dir)
+        for frameIndex, timestamp, frame in read_frames(vid_dir, endTimestamp):
+            if debug_dir is not None:
+                cv2.imwrite(os.path.join(debug_dir, frame_name(vid_dir, frameIndex, timestamp)), frame)
+            yield camera_id, exposure, frameIndex, timestamp, frame
+
 def extract_frames(vid_dir, endTimestamp):
     """
     Extracts frames from video located at path [vid_dir]
@@ -26,27 +86,47 @@ def extract_frames(vid_dir, endTimestamp):
     #time.sleep(3)
     #raise NotImplementedError("implement frame extraction")
     """Convertes and mjpeg video into a list of jpeg images"""
-    src = cv2.VideoCapture(vid_dir)
-    currentFrame = 0
-    base = os.path.splitext(os.path.basename(vid_dir))[0]
     frames = []
-    while (True):
-    # Write next frame to a new jpeg image
-        ret, frame = src.read()
-        if ret:
-            # TODO: How to incorporate total number of frames, fps
-            timestamp = endTimestamp - ((CisLunarCamRecParams.recTime * CisLunarCamRecParams.fps + 1) - 1 - currentFrame) * (1 / CisLunarCamRecParams.fps * 10 ** 6)
-            timestamp = ceil(timestamp)
-            name = base + f"_f{currentFrame}_t{timestamp}.jpeg"
-            cv2.imwrite(name, frame)
-            frames.append(name)
-            currentFrame += 1
-        else:
-            break
-    # src.release()
-    # cv2.destroyAllWindows()
+    for currentFrame, timestamp, frame in read_frames(vid_dir, endTimestamp):
+        # Write next frame to a new jpeg image
+        name = frame_name(vid_dir, currentFrame, timestamp)
+        cv2.imwrite(name, frame)
+        frames.append(name)
     return frames
- 
+
+@lru_cache(maxsize=4)
+def stereo_proj_map(imgw, imgh, fov=62.2, fov2=48.8):
+    """
+    Builds the inverse mapping used by rect_to_stereo_proj for an [imgw]x[imgh] image.
+    The mapping only depends on the image size and fields of view, so it is computed once and cached.
+    [imgw], [imgh]: image width and height in pixels
+    [fov], [fov2]: horizontal and vertical field of view in degrees
+
+    Returns (imgh x imgw x 2) int16 array of the (x, y) source pixel of each destination pixel,
+    (-1, -1) where the destination pixel has no source. It can be passed to cv2.remap directly.
+    """
+    wh = int(imgw / 2)
+    hh = int(imgh / 2)
+    scale = 1.0 - ((fov - 90) / 340) ** 1.5 if fov > 90 else 1.0
+
+    # Same steps as the per pixel conversion in rect_to_stereo_proj_reference
+    x = (np.arange(imgw, dtype=np.float64) - wh)[np.newaxis, :]
+    y = (np.arange(imgh, dtype=np.float64) - hh)[:, np.newaxis]
+    nx = radians(fov2) * (x / wh)
+    ny = radians(fov2) * (y / wh)
+    r = np.sqrt(nx**2 + ny**2)
+    theta = np.arctan2(ny, nx)
+    r = np.tan(2 * np.arctan(r / 2)) * scale
+    px = np.trunc((r * np.cos(theta)) * wh / radians(fov2) + wh)
+    py = np.trunc((r * np.sin(theta)) * wh / radians(fov2) + hh)
+
+    valid = (py >= 0) & (py < imgh) & (px > 0) & (px < imgw)
+    srcmap = np.full((imgh, imgw, 2), -1, dtype=np.int16)
+    srcmap[..., 0][valid] = px[valid]
+    srcmap[..., 1][valid] = py[valid]
+    srcmap.setflags(write=False)
+    return srcmap
+
 def rect_to_stereo_proj(img, fov=62.2, fov2=48.8):
     """
     Source:     http://lexafrancis.com/rectilinear-to-stereographic-image-converter-python/
@@ -58,6 +138,16 @@ def rect_to_stereo_proj(img, fov=62.2, fov2=48.8):
     [fov2]: (float) vertical field of view. For us, it is 48.8 
     
     Returns new image in stereographic projection
+    The mapping is built once per image size and field of view (see stereo_proj_map) and applied with cv2.remap.
+    """
+    imgh, imgw = img.shape[:2]
+    srcmap = stereo_proj_map(imgw, imgh, fov, fov2)
+    return cv2.remap(img, srcmap, None, cv2.INTER_NEAREST, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+def rect_to_stereo_proj_reference(img, fov=62.2, fov2=48.8):
+    """
+    Per pixel implementation of rect_to_stereo_proj, kept as the reference for the cached mapping.
+    Takes minutes on a full frame, do not use in the pipeline.
     """
     imgh, imgw, bits = img.shape
     wh  = int( imgw / 2 )
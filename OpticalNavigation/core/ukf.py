@@ -38,12 +38,46 @@ def __makeSigmas(initState, Sx, Sv, nx, nv, constant):
 
     return sigmas, noise
 
+def __makeSigmasBatch(initState, Sx, Sv, nx, nv, constant):
+    """
+    Vectorized __makeSigmas
+    Returns:
+    [sigmas, noise]: sigma points and dynamic noise offsets (Nx6) where N = 2(nx+nv)+1
+    """
+    initState = initState.flatten()
+    sigmas = np.tile(initState, (2*(nx+nv)+1, 1))
+    noise = np.zeros_like(sigmas)
+
+    # Offset sigma points positively and negatively in state (by chol(P))
+    sigmas[1:nx+1] = initState + constant*Sx.T
+    sigmas[nx+1:2*nx+1] = initState - constant*Sx.T
+
+    # Offset sigma points positively and negatively in dynamic noise (by chol(Q))
+    noise[2*nx+1:2*nx+nv+1] = constant*Sv.T
+    noise[2*nx+nv+1:] = -constant*Sv.T
+
+    return sigmas, noise
+
 def __G(rec, rem, rcm, rcs, res, thrust):
     """
     [thrust] is 3D acceleration vector.
     """
     return -Const.ue * ( rec/(np.linalg.norm(rec)**3) ) + Const.um * ( (rem-rec)/((rcm.dot(rcm.T))**(3/2)) - rem/(np.linalg.norm(rem)**3) ) + Const.us * ( (res-rec)/((rcs.dot(rcs.T))**(3/2)) - res/(np.linalg.norm(res)**3) ) + thrust
 
+def __GBatch(rec, rem, rcm, rcs, res, thrust):
+    """
+    Vectorized __G
+    [rec, rcm, rcs]: (Nx3), one row per sigma point
+    [rem, res]: (3,)
+    [thrust] is 3D acceleration vector.
+    """
+    recNorm = np.sqrt(np.sum(rec*rec, axis=1, keepdims=True))
+    rcmNorm2 = np.sum(rcm*rcm, axis=1, keepdims=True)
+    rcsNorm2 = np.sum(rcs*rcs, axis=1, keepdims=True)
+    return (-Const.ue * ( rec/(recNorm**3) )
+            + Const.um * ( (rem-rec)/(rcmNorm2**(3/2)) - rem/(np.linalg.norm(rem)**3) )
+            + Const.us * ( (res-rec)/(rcsNorm2**(3/2)) - res/(np.linalg.norm(res)**3) ) + thrust)
+
 def __attitudeMatrix(quaternion):
     q1, q2, q3, q4 = quaternion
     i, j, k, r = q1, q2, q3, q4
@@ -93,6 +127,45 @@ def __dynamics_model(state, dt, moonEph, sunEph, main_thrust_info):
 
     return np.concatenate((position, velocity), axis=None) / 1000
 
+def __thrustAcceleration(main_thrust_info):
+    """
+    Main thrust acceleration converted into the ECI frame (1x3), zero if no kick occured
+    """
+    if main_thrust_info is None:
+        return np.zeros((1,3))
+    kick_orientation = main_thrust_info.get_kick_orientation().data
+    acc_mag = main_thrust_info.get_acceleration_magnitude()
+    Aq = __attitudeMatrix(kick_orientation).reshape(3,3)
+    return (np.dot(Aq, TrajUKFConstants.ACCELERATION_DIR.data[:3].T.reshape(3,1)) * acc_mag).reshape(1,3)
+
+def __dynamicsModelBatch(states, dt, moonEph, sunEph, main_thrust_info):
+    """
+    Vectorized __dynamics_model: Runge Kutta 4th Order, one timestep for all sigma points at once
+    [states]: Sigma points + noise (Nx6)
+    See __dynamics_model for the other parameters
+    Returns:
+    Propagated sigma points (Nx6) in km
+    """
+    moonEph = moonEph*1000
+    sunEph = sunEph*1000
+    rec = states[:,0:3]*1000
+    rec_dot = states[:,3:6]*1000
+    rem = moonEph[0, 0:3]
+    res = sunEph[0, 0:3]
+    rcm = rec-rem
+    rcs = rec-res
+    position = rec + rec_dot * dt
+
+    # Inlined RK4
+    n1 = __GBatch(position, rem, rcm, rcs, res, thrust=__thrustAcceleration(main_thrust_info))
+    net_acceleration_thrust = np.zeros((1,3))
+    n2 = __GBatch(position+dt*n1/2, rem, rcm, rcs, res, thrust=net_acceleration_thrust)
+    n3 = __GBatch(position+dt*n2/2, rem, rcm, rcs, res, thrust=net_acceleration_thrust)
+    n4 = __GBatch(position+n3*dt, rem, rcm, rcs, res, thrust=net_acceleration_thrust)
+    velocity = rec_dot + (1.0/6.0)*(n1 + 2*n2 + 2*n3 + n4)*dt # TODO: main thrust fire delta time
+
+    return np.hstack((position, velocity)) / 1000
+
 def __measModel(traj, moonEph, sunEph, const):
     """
     Expected measurements based on propogated sigmas
@@ -138,6 +211,49 @@ def __measModel(traj, moonEph, sunEph, const):
     # Note: multiply measurement vector by "const" to convert from angles to pixels
     return np.array([z1, z2, z3, z4, z5, z6]).T * const
 
+def __measModelBatch(trajs, moonEph, sunEph, const):
+    """
+    Vectorized __measModel: expected measurements for all propogated sigmas at once
+    [trajs]: propogated sigma points with gaussian randomness (Nx6)
+    Ephemiris (1,6)
+    [const]: camera constant: PixelWidth/FOV (pixels/radians)
+    Returns:
+    [h]: Expected measurement vectors [z1 z2 z3 z4 z5 z6] (Nx6)
+    """
+    moonEph = moonEph.flatten()
+    sunEph = sunEph.flatten()
+    x = trajs[:,0] * 1000
+    y = trajs[:,1] * 1000
+    z = trajs[:,2] * 1000
+    dmx = moonEph[0] * 1000 # Convert km to m
+    dmy = moonEph[1] * 1000
+    dmz = moonEph[2] * 1000
+    dsx = sunEph[0] * 1000 # Convert km to m
+    dsy = sunEph[1] * 1000
+    dsz = sunEph[2] * 1000
+    p_c2 = x**2 + y**2 + z**2
+    p_c = np.sqrt(p_c2)
+
+    p_cm = np.sqrt((dmx-x)**2 + (dmy-y)**2 + (dmz-z)**2)
+    p_cs = np.sqrt((dsx-x)**2 + (dsy-y)**2 + (dsz-z)**2)
+
+    num1 = -x*dmx - y*dmy - z*dmz + p_c2
+    num2 = -x*dsx - y*dsy - z*dsz + p_c2
+    num3 = dmx*(dsx-x) + dmy*(dsy-y) + dsz*(dmz-z) - z*dmz - x*dsx - y*dsy + p_c2
+
+    # Pixel Separation Between Bodies
+    z1 = np.arccos(num1/(p_c*p_cm))       # E to M
+    z2 = np.arccos(num2/(p_c*p_cs))       # E to S
+    z3 = np.arccos(num3/(p_cm*p_cs))      # M to S
+
+    # Pixel Diameter of Bodies
+    z4 = 2 * np.arctan(Const.re/p_c)               # E
+    z5 = 2 * np.arctan(Const.rm/p_cm)              # M
+    z6 = 2 * np.arctan(Const.rs/p_cs)              # S
+
+    # Note: multiply measurement vector by "const" to convert from angles to pixels
+    return np.stack([z1, z2, z3, z4, z5, z6], axis=1) * const
+
 def __getMeans(propSigmas, sigmaMeasurements, centerWeight, otherWeight):
     """
     Weighted sums, otherwise known as x_bar or z_bar
@@ -205,7 +321,7 @@ def __newEstimate(xMean:np.ndarray, zMean:np.ndarray, Pxx:np.ndarray,
 
 def runTrajUKF(moonEph: EphemerisVector, sunEph: EphemerisVector, measurements:CameraMeasurementVector, 
             initState:TrajectoryStateVector, dt:np.float, P:CovarianceMatrix, cameraParams:CameraParameters, 
-            main_thrust_info:MainThrustInfo=None, dynamicsOnly:bool=False) -> TrajectoryEstimateOutput:
+            main_thrust_info:MainThrustInfo=None, dynamicsOnly:bool=False, vectorized:bool=True) -> TrajectoryEstimateOutput:
     """
     Propogates dynamics model with instantaneous impulse from the main thruster.
     Due to the processing delays of the system and the short impulse duration, 
@@ -227,6 +343,8 @@ def runTrajUKF(moonEph: EphemerisVector, sunEph: EphemerisVector, measurements:C
     [P]: initial covariance matrix for state estimate
     [main_thrust_info]: Dictionary representing main thrust data (4x1 quaternion 'kick_orientation', float 'acceleration_magnitude', float 'kick_duration')
     [dynamicsOnly]: trust the dynamics model over measurements (helpful for testing)
+    [vectorized]: propagate all sigma points through the dynamics and measurement models in one array operation.
+        False runs the per sigma point reference implementation
     Returns:
     [xNew, pNew, K]: (6x1) new state vector, (6x6) new state covariance estimate, kalman gain
     """
@@ -264,23 +382,41 @@ def runTrajUKF(moonEph: EphemerisVector, sunEph: EphemerisVector, measurements:C
 
     Sx = np.linalg.cholesky(P.data)
 
-    # Generate Sigma Points
-    sigmas, noise = __makeSigmas(initState.data, Sx, Const.Sv, nx, nv, constant)
+    if vectorized:
+        # Generate Sigma Points (Nx6)
+        sigmas, noise = __makeSigmasBatch(initState.data, Sx, Const.Sv, nx, nv, constant)
 
-    # Propogate Sigma Points
-    propSigmas = np.zeros_like(sigmas) # Initialize
+        # Proprogate all Sigma Points through the dynamics model at once
+        propSigmas = __dynamicsModelBatch(sigmas+noise, dt, moonEph.data, sunEph.data, main_thrust_info=main_thrust_info)
+
+        # Expected measurements for all propagated sigma points. Noise is drawn in the same order as the
+        # per sigma point path below
+        measNoise = np.random.multivariate_normal(np.zeros((6,)), Const.R, size=propSigmas.shape[0])
+        sigmaMeasurements = __measModelBatch(propSigmas + measNoise, moonEph.data, sunEph.data, const)
+
+        # __getMeans and __findCovariances work on (6xN)
+        propSigmas = propSigmas.T
+        sigmaMeasurements = sigmaMeasurements.T
+    else:
+        # Generate Sigma Points
+        sigmas, noise = __makeSigmas(initState.data, Sx, Const.Sv, nx, nv, constant)
+
+        # Propogate Sigma Points
+        propSigmas = np.zeros_like(sigmas) # Initialize
+
+        # Proprogate Sigma Points by running through dynamics model/function
+        for j in range(__length(sigmas)):
+            propSigmas[:,j] = __dynamics_model(sigmas[:,j]+noise[:,j], dt, moonEph.data, sunEph.data,
+                                               main_thrust_info=main_thrust_info)
+
+        sigmaMeasurements = np.zeros((6,__length(propSigmas)))
+
+        # Sigma measurements are the expected measurements calculated from
+        # running the propagated sigma points through measurement model
+        for j in range(__length(sigmas)):
+            measurementNoise = np.random.multivariate_normal(np.zeros((6,)),Const.R).T
+            sigmaMeasurements[:,j] = __measModel(propSigmas[:,j] + measurementNoise, moonEph.data, sunEph.data, const)
 
-    # Proprogate Sigma Points by running through dynamics model/function
-    for j in range(__length(sigmas)):
-        propSigmas[:,j] = __dynamics_model(sigmas[:,j]+noise[:,j], dt, moonEph.data, sunEph.data, main_thrust_info=main_thrust_info)
-    
-    sigmaMeasurements = np.zeros((6,__length(propSigmas)))
-    
-    # Sigma measurements are the expected measurements calculated from
-    # running the propagated sigma points through measurement model
-    for j in range(__length(sigmas)):
-        sigmaMeasurements[:,j] = __measModel(propSigmas[:,j] + np.random.multivariate_normal(np.zeros((6,)),Const.R).T, moonEph.data, sunEph.data, const)
-        
     # a priori estimates
     xMean, zMean = __getMeans(propSigmas, sigmaMeasurements, centerWeight, otherWeight)
 
@@ -12,7 +12,7 @@ import threading
 import time
 
 from core.find import round_up_to_odd
-from core.preprocess import rectilinearToStereographicProjection
+from core.preprocess import rect_to_stereo_proj
 
 """
 Extracts circles from iteration images generated in Cesium for true measurements (red moon texture, no directional lighting)
@@ -287,7 +287,7 @@ def obtainCesiumDetections(batch, path, circleCSV, startIter, endIter):
             if np.min(image) == np.max(image) == 0:
                 os.remove(imagePath)
                 continue
-            stereoImage = rectilinearToStereographicProjection(image)
+            stereoImage = rect_to_stereo_proj(image)
             moonRes = detectCesiumRedMoon(copy.copy(stereoImage))
             sunRes = detectCesiumSun(copy.copy(stereoImage))
             earthRes = detectCesiumEarth(copy.copy(stereoImage))
@@ -434,7 +434,7 @@ if __name__ == "__main__":
     # TEMPLATE_SUN_PATH = "C:\\Users\\easha\\Downloads\\UnityTemplateSun.PNG"
 
     # image = cv2.imread(args["path"])
-    # stereoImage = rectilinearToStereographicProjection(image)
+    # stereoImage = rect_to_stereo_proj(image)
     # moonRes = detectCesiumRedMoon(copy.copy(stereoImage))
     # sunRes = detectCesiumSun(copy.copy(stereoImage))
     # earthRes = detectCesiumEarth(copy.copy(stereoImage))
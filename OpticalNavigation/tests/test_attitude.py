@@ -153,3 +153,37 @@ def test_attitude_6_hours():
     # omy_id = liveOmegas.addGraph(color='g', label='omega y', alpha=0.5, ls='-', traceLim=50)
     # omz_id = liveOmegas.addGraph(color='b', label='omega z', alpha=0.5, ls='-', traceLim=50)
 
+
+def test_vectorized_quaternion_propagation_matches_reference():
+    gyroSampleCount = 4
+    gyroVars = GyroVars()
+    gyroVars.gyro_noise_sigma = 1.e-7
+    gyroVars.gyro_sample_rate = 1.0 / gyroSampleCount
+    gyroVars.gyro_sigma = 1.e-10
+    gyroVars.meas_sigma = 8.7e-4
+    gyroVarsTup = (gyroVars.gyro_sigma, gyroVars.gyro_sample_rate, gyroVars.get_Q_matrix(), gyroVars.get_R_matrix())
+
+    np.random.seed(0)
+    P0 = np.diag([1.e-1, 1.e-1, 1.e-1, 9.7e-10, 9.7e-10, 9.7e-10]) * 10.
+    x0 = np.array([[0., 0., 0., 1.e-6, -2.e-6, 5.e-7]]).T
+    quat = np.random.randn(4, 1)
+    quat = quat / np.linalg.norm(quat)
+    omegas = [GyroMeasurementVector(omega_x=w[0], omega_y=w[1], omega_z=w[2])
+              for w in np.random.randn(gyroSampleCount, 3) * 1.e-2]
+    satState = np.random.randn(gyroSampleCount, 3) * 1.e5
+    moonEph = np.random.randn(gyroSampleCount, 3) * 4.e5
+    sunEph = np.random.randn(gyroSampleCount, 3) * 1.5e8
+    timeline = [gyroVars.gyro_sample_rate] * gyroSampleCount
+
+    estimates = []
+    for vectorized in [False, True]:
+        np.random.seed(1)
+        estimates.append(runAttitudeUKF(1, gyroVarsTup, CovarianceMatrix(matrix=P0),
+                                        AttitudeStateVector.from_numpy_array(state=x0),
+                                        QuaternionVector.from_numpy_array(quat=quat), omegas, satState, moonEph, sunEph,
+                                        timeline, vectorized=vectorized))
+    reference, batched = estimates
+    assert np.allclose(batched.new_state.data, reference.new_state.data, rtol=1e-8, atol=1e-14)
+    # pinv of the near singular Pzz amplifies summation order roundoff in the covariance update
+    assert np.allclose(batched.new_P.data, reference.new_P.data, rtol=1e-4, atol=1e-18)
+    assert np.allclose(batched.new_quat.data, reference.new_quat.data, rtol=1e-10, atol=1e-12)
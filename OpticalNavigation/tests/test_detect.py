@@ -0,0 +1,147 @@
+import math
+import os
+import signal
+import threading
+import time
+import numpy as np
+import pytest
+
+import OpticalNavigation.core.detect as detect
+from OpticalNavigation.core.const import CisLunarCameraParameters, ImageDetectionCircles
+from OpticalNavigation.core.detect import detect_frames, select_best_detections, EARTH, MOON, SUN
+
+
+class FakeFind:
+    """Stands in for find(): detects the Earth at x = frame number, the Moon in even frames only"""
+
+    def __init__(self, delay=0.02, on_call=None):
+        self.delay = delay
+        self.on_call = on_call
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.calls = []
+
+    def __call__(self, src, camera_params=None, camera_id=None, exposure=None):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            self.calls.append(src)
+        if self.on_call is not None:
+            self.on_call(src)
+        time.sleep(self.delay)
+        n = int(src[2]) if isinstance(src, np.ndarray) else int(src.split("_f")[1].split("_")[0])
+        result = ImageDetectionCircles()
+        result.set_earth_detection(n, 0., 1., 0.1)
+        if n % 2 == 0:
+            result.set_moon_detection(0., n, 1., 0.2)
+        with self.lock:
+            self.running -= 1
+        return result
+
+
+def test_detections_are_gathered_in_frame_order(monkeypatch):
+    fake = FakeFind()
+    monkeypatch.setattr(detect, "find", fake)
+    frames = [f"cam{n % 3 + 1}_expHigh_f{n}_t{1000 * n}" for n in range(12)]
+
+    detections, metadata = detect_frames(frames, workers=4)
+    earth, moon, sun = detections[:, EARTH], detections[:, MOON], detections[:, SUN]
+
+    assert fake.max_running > 1
+    assert np.array_equal(metadata["camera_id"], np.arange(12) % 3 + 1)
+    assert np.array_equal(metadata["timestamp"], 1000 * np.arange(12))
+    assert np.array_equal(earth[:, 0], np.arange(12))
+    assert np.array_equal(moon[::2, 1], np.arange(0, 12, 2))
+    assert np.isnan(moon[1::2]).all()
+    assert np.isnan(sun).all()
+
+
+def test_memory_cap_bounds_frames_in_flight(monkeypatch):
+    fake = FakeFind()
+    monkeypatch.setattr(detect, "find", fake)
+    frames = ((1, "High", n, 0, np.full(1000, n, dtype=np.uint8)) for n in range(10))
+
+    detections, metadata = detect_frames(frames, workers=4, memory_cap=2 * detect.FIND_WORKING_SET * 1000)
+
+    assert fake.max_running == 2
+    assert np.array_equal(detections[:, EARTH, 0], np.arange(10))
+    assert (metadata["camera_id"] == 1).all()
+
+
+def test_sigterm_shuts_down_pool(monkeypatch):
+    def terminate(src):
+        if src.endswith("_f3_t0"):
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    fake = FakeFind(delay=0.1, on_call=terminate)
+    monkeypatch.setattr(detect, "find", fake)
+    handler = signal.getsignal(signal.SIGTERM)
+
+    with pytest.raises(SystemExit):
+        detect_frames([f"cam1_expHigh_f{n}_t0" for n in range(50)], workers=2)
+
+    assert len(fake.calls) < 50
+    assert not any(t.name.startswith("opnav-detect") for t in threading.enumerate())
+    assert signal.getsignal(signal.SIGTERM) is handler
+
+
+def select_best_reference(detections, metadata, camera_params, y_rate, t0):
+    """Per body selection and rotation as __observe did it before the detection tensor"""
+    best = []
+    for body in [EARTH, MOON, SUN]:
+        bestIndex, bestDist = 0, math.sqrt(detections[0, body, 0]**2 + detections[0, body, 1]**2)
+        for f in range(len(detections)):
+            dist = math.sqrt(detections[f, body, 0]**2 + detections[f, body, 1]**2)
+            if np.isnan(dist):
+                continue
+            if dist < bestDist or np.isnan(bestDist):
+                bestIndex, bestDist = f, dist
+        data = detections[bestIndex, body].copy()
+        coordArray = data[:3].reshape(3, 1)
+        camNum = metadata["camera_id"][bestIndex]
+        if camNum == 1:
+            coordArray = (camera_params.cam1Rotation).dot(coordArray)
+        elif camNum == 2:
+            coordArray = (camera_params.cam2Rotation).dot(coordArray)
+        elif camNum == 3:
+            coordArray = (camera_params.cam3Rotation).dot(coordArray)
+        if not np.isnan(bestDist):
+            rotation = y_rate * (metadata["timestamp"][bestIndex] * 1e-6 - t0)
+            tZeroRotation = np.array([math.cos(rotation), 0, math.sin(rotation),
+                                      0, 1, 0,
+                                      -1 * math.sin(rotation), 0, math.cos(rotation)]).reshape(3, 3)
+            coordArray = tZeroRotation.dot(coordArray)
+        data[:3] = coordArray.reshape(3)
+        best.append(data)
+    return np.array(best)
+
+
+def test_select_best_detections_matches_reference():
+    rng = np.random.default_rng(0)
+    detections = rng.normal(size=(40, 3, 4))
+    detections[rng.random((40, 3)) < 0.6] = np.nan
+    detections[:, SUN] = np.nan  # Sun seen in no frame
+    metadata = np.zeros(40, dtype=detect.FRAME_METADATA_DTYPE)
+    metadata["camera_id"] = rng.integers(1, 4, 40)
+    metadata["timestamp"] = rng.integers(10**6, 10**7, 40)
+
+    best, frames = select_best_detections(detections, metadata, CisLunarCameraParameters, y_rate=0.3, t0=2.5)
+
+    expected = select_best_reference(detections, metadata, CisLunarCameraParameters, 0.3, 2.5)
+    assert np.allclose(best, expected, equal_nan=True)
+    assert np.isnan(best[SUN]).all() and frames[SUN] == 0
+    dist = np.hypot(detections[:, EARTH, 0], detections[:, EARTH, 1])
+    assert frames[EARTH] == np.nanargmin(dist)
+
+
+def test_select_best_detections_without_t0_rotation():
+    detections = np.full((2, 3, 4), np.nan)
+    detections[1] = [[0., 0., 1., 0.1], [0.1, 0., 1., 0.2], [0., 0.2, 1., 0.3]]
+    metadata = np.array([(1, 0), (2, 0)], dtype=detect.FRAME_METADATA_DTYPE)
+
+    best, frames = select_best_detections(detections, metadata, CisLunarCameraParameters)
+
+    assert (frames == 1).all()
+    assert np.allclose(best[:, :3], detections[1, :, :3] @ CisLunarCameraParameters.cam2Rotation.T)
+    assert np.array_equal(best[:, 3], detections[1, :, 3])
@@ -0,0 +1,81 @@
+from math import radians
+import cv2
+import numpy as np
+
+import OpticalNavigation.core.find_with_contours as fwc
+from OpticalNavigation.core.find_with_contours import BoundingBox, CameraRotation, build_remap_table, get_camera, \
+    get_remap_table, gn_to_sph, measureMoon, quantize_rotation, remap_roi, rotate, sph_to_st
+from OpticalNavigation.core.const import CisLunarCameraParameters
+
+
+def get_cam_rot(cam_num=1):
+    cam = get_camera(radians(CisLunarCameraParameters.hFov), radians(CisLunarCameraParameters.vFov), 3280, 2464)
+    rotation = getattr(CisLunarCameraParameters, f"cam{cam_num}Rotation")
+    u = np.linalg.inv(rotation).dot(np.array([0, 1, 0], dtype=np.float32))
+    _, rot = quantize_rotation(CameraRotation(u, 5 * 18.904e-6))
+    return cam, rot
+
+
+def test_remap_table_inverts_forward_projection():
+    cam, rot = get_cam_rot()
+    table = build_remap_table(cam, rot)
+
+    rng = np.random.default_rng(0)
+    for xp, yp in zip(rng.uniform(0, cam.w - 1, 50), rng.uniform(0, cam.h - 1, 50)):
+        x, y = cam.normalize_gn(xp, yp)
+        rs = rotate(rot, gn_to_sph(np.array([x]), np.array([y])), np.array([[yp]]))
+        xst, yst = cam.st_to_px(*sph_to_st(rs))
+        xst, yst = float(xst), float(yst)
+        # Nearest pixel of the map is within a pixel of the source
+        m = table.map(BoundingBox(int(round(xst)), int(round(yst)), 1, 1))
+        assert np.hypot(m[0, 0, 0] - xp, m[0, 0, 1] - yp) < 1.5
+
+
+def test_remap_roi_matches_tiled_warp():
+    cam, rot = get_cam_rot()
+    table = build_remap_table(cam, rot)
+    img = np.zeros((cam.h, cam.w, 3), dtype=np.uint8)
+    cv2.circle(img, (2000, 900), 250, (200, 180, 160), -1)
+    box = BoundingBox(1700, 600, 620, 620)
+
+    tiled, bb_tiled = remap_roi(img, box, cam, rot)
+    remapped, bb = remap_roi(img, box, cam, rot, table)
+
+    assert bb == bb_tiled
+    (x_tiled, y_tiled), r_tiled = measureMoon(tiled)
+    (x, y), r = measureMoon(remapped)
+    assert abs(x - x_tiled) < 1 and abs(y - y_tiled) < 1 and abs(r - r_tiled) < 1
+
+
+def test_remap_table_is_persisted(tmp_path):
+    cam, rot = get_cam_rot(2)
+    fwc._remap_tables.clear()
+    built = get_remap_table(CisLunarCameraParameters, 2, cam, rot, cache_dir=str(tmp_path))
+    assert len(list(tmp_path.glob("cam2_*.npy"))) == 1
+    # Rotations in the same bucket share the table
+    assert get_remap_table(CisLunarCameraParameters, 2, cam, CameraRotation(rot.u, rot.omega_dt + 1e-8),
+                           cache_dir=str(tmp_path)) is built
+
+    fwc._remap_tables.clear()
+    loaded = get_remap_table(CisLunarCameraParameters, 2, cam, rot, cache_dir=str(tmp_path))
+    fwc._remap_tables.clear()
+    assert isinstance(loaded.grid, np.memmap)
+    assert (loaded.x0, loaded.y0, loaded.step) == (built.x0, built.y0, built.step)
+    assert np.array_equal(loaded.grid, built.grid)
+
+
+def test_find_accepts_frame_array(tmp_path):
+    img = np.zeros((2464, 3280, 3), dtype=np.uint8)
+    cv2.circle(img, (1640, 1232), 200, (120, 120, 120), -1)
+    path = str(tmp_path / "cam1_expHigh_f0_t100.jpeg")
+    cv2.imwrite(path, img, [cv2.IMWRITE_JPEG_QUALITY, 100])
+    frame = cv2.imread(path)
+    original = frame.copy()
+
+    from_file = fwc.find(path, remap_cache_dir=None)
+    from_array = fwc.find(frame, remap_cache_dir=None, camera_id=1, exposure="High")
+
+    assert np.array_equal(frame, original)
+    assert from_file.get_moon_detection() is not None
+    assert np.array_equal(from_array.get_moon_detection(), from_file.get_moon_detection())
+    assert from_array.get_earth_detection() is None and from_array.get_sun_detection() is None
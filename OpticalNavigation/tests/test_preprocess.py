@@ -0,0 +1,52 @@
+import cv2
+import numpy as np
+import pytest
+
+from OpticalNavigation.core.const import CisLunarCamRecParams
+from OpticalNavigation.core.preprocess import frame_name, frame_timestamp, rect_to_stereo_proj, \
+    rect_to_stereo_proj_reference, stereo_proj_map, stream_frames
+
+
+@pytest.mark.parametrize("h, w, fov, fov2", [(246, 328, 62.2, 48.8), (101, 99, 62.2, 48.8), (200, 300, 100, 60)])
+def test_rect_to_stereo_proj_matches_reference(h, w, fov, fov2):
+    img = np.random.default_rng(0).integers(0, 256, (h, w, 3), dtype=np.uint8)
+    assert np.array_equal(rect_to_stereo_proj(img, fov, fov2), rect_to_stereo_proj_reference(img, fov, fov2))
+
+
+def test_stereo_proj_map_is_cached():
+    assert stereo_proj_map(328, 246) is stereo_proj_map(328, 246)
+    assert stereo_proj_map(328, 246) is not stereo_proj_map(328, 246, 60.0)
+
+
+def write_recording(path, values):
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"MJPG"), CisLunarCamRecParams.fps, (64, 48))
+    for v in values:
+        writer.write(np.full((48, 64, 3), v, dtype=np.uint8))
+    writer.release()
+
+
+def test_stream_frames_decodes_recordings_in_memory(tmp_path):
+    write_recording(tmp_path / "cam1_expLow.mjpeg", [0, 100])
+    write_recording(tmp_path / "cam3_expHigh.mjpeg", [200])
+    recordings = [(str(tmp_path / "cam1_expLow.mjpeg"), 1000000), (str(tmp_path / "cam3_expHigh.mjpeg"), 2000000)]
+
+    frames = list(stream_frames(recordings))
+
+    assert [f[:4] for f in frames] == [(1, "Low", 0, frame_timestamp(1000000, 0)),
+                                      (1, "Low", 1, frame_timestamp(1000000, 1)),
+                                      (3, "High", 0, frame_timestamp(2000000, 0))]
+    assert frames[2][4].shape == (48, 64, 3)
+    assert abs(int(np.median(frames[1][4])) - 100) <= 2
+    # Nothing was written to disk
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["cam1_expLow.mjpeg", "cam3_expHigh.mjpeg"]
+
+
+def test_stream_frames_debug_sink(tmp_path):
+    write_recording(tmp_path / "cam2_expHigh.mjpeg", [50, 60])
+    debug_dir = tmp_path / "frames"
+    debug_dir.mkdir()
+
+    frames = list(stream_frames([(str(tmp_path / "cam2_expHigh.mjpeg"), 500000)], debug_dir=str(debug_dir)))
+
+    names = sorted(p.name for p in debug_dir.iterdir())
+    assert names == sorted(frame_name("cam2_expHigh.mjpeg", f[2], f[3]) for f in frames)
@@ -150,4 +150,28 @@ def cislunar1_timestep(visual_analysis, state_error, kickTime=None):
     velError = math.sqrt( np.sum((traj[3:6] - state[3:6])**2) )
     print(f'Position error: {posError}\nVelocity error: {velError}')
     assert posError <= POS_ERROR, 'Position error is too large'
-    assert velError <= VEL_ERROR, 'Velocity error is too large'
\ No newline at end of file
+    assert velError <= VEL_ERROR, 'Velocity error is too large'
+
+def test_vectorized_sigma_propagation_matches_reference():
+    """
+    The batched sigma point path must give the same estimate as the per sigma point path
+    """
+    def inputs():
+        moonEph = EphemerisVector(x_pos=3.0e5, y_pos=1e5, z_pos=1e4, x_vel=-0.5, y_vel=0.9, z_vel=0.01)
+        sunEph = EphemerisVector(x_pos=1.4e8, y_pos=4e7, z_pos=1e6, x_vel=-8., y_vel=28., z_vel=0.1)
+        meas = CameraMeasurementVector(ang_em=1.0, ang_es=1.2, ang_ms=0.4, e_dia=0.05, m_dia=0.01, s_dia=0.009)
+        state = TrajectoryStateVector.from_numpy_array(state=np.array([7.0e4, 1.2e4, 3e3, 1.1, 2.4, 0.3]).reshape(6,1))
+        P = CovarianceMatrix(matrix=np.diag(np.array([100, 100, 100, 1e-5, 1e-6, 1e-5])))
+        return moonEph, sunEph, meas, state, P
+
+    estimates = []
+    for vectorized in [True, False]:
+        # Same seed so both paths draw the same measurement noise
+        np.random.seed(0)
+        moonEph, sunEph, meas, state, P = inputs()
+        estimates.append(runTrajUKF(moonEph, sunEph, meas, state, 60, P, CesiumTestCameraParameters, vectorized=vectorized))
+
+    batched, reference = estimates
+    assert np.allclose(batched.new_state.data, reference.new_state.data, rtol=1e-10, atol=0)
+    assert np.allclose(batched.new_P.data, reference.new_P.data, rtol=1e-8, atol=1e-10)
+    assert np.allclose(batched.K.data, reference.K.data, rtol=1e-8, atol=1e-12)
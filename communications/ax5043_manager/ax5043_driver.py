@@ -1,3 +1,4 @@
+from contextlib import contextmanager
 from enum import IntEnum, unique
 import time
 
@@ -309,6 +310,35 @@ class Bits(IntEnum):
     RNG_START = 0x10
     RNGERR = 0x20
 
+@unique
+class Irq(IntEnum):
+    # IRQREQUEST1:IRQREQUEST0, as returned by read_16(Reg.IRQREQUEST1)
+    FIFONOTEMPTY = 0x0001
+    FIFONOTFULL = 0x0002
+    FIFOTHRFREE = 0x0008  # more than FIFOTHRESH bytes free
+    FIFOERROR = 0x0010
+    RADIOCTRL = 0x0040
+    XTALREADY = 0x0100
+
+class Fifoflags(IntEnum):
+    # Flags of the FIFO DATA command
+    PKTSTART = 0x01
+    PKTEND = 0x02
+    RAW = 0x10
+
+class Rxflags(IntEnum):
+    # Flags of a received FIFO DATA chunk
+    PKTSTART = 0x01
+    PKTEND = 0x02
+    RESIDUE = 0x04
+    CRCFAIL = 0x08
+    ADDRFAIL = 0x10
+    SIZEFAIL = 0x20
+    LOCKLOST = 0x40
+
+FIFO_SIZE = 256  # bytes
+FIFO_DATA_HEADER = 3  # bytes of the FIFO DATA command in front of the data
+
 @unique
 class Fifocmd(IntEnum):
     CLEAR_DATA_FLAGS = 0x03
@@ -400,22 +430,74 @@ class UnknownChunk(Chunk):
     def __init__(self, buf):
         self.buf = buf
 
+# Registers whose writes have side effects, or that the chip changes by itself:
+# always written, never kept in the shadow copy
+VOLATILE_REGS = frozenset([Reg.PWRMODE, Reg.FIFOSTAT, Reg.FIFODATA, Reg.PLLRANGINGA, Reg.PLLRANGINGB])
+# Reading registers from here up has no side effects, so they can be read into the shadow copy in bursts
+SHADOW_READ_START = 0x100
+# Runs of writes separated by at most this many registers with known values are sent as one burst
+# (the registers in between are rewritten with their shadow values)
+BURST_GAP = 4
+# Registers read into the shadow copy are grouped into one burst read when at most this far apart
+SHADOW_READ_GAP = 32
+
+REG_ADDRS = frozenset(int(reg) for reg in Reg)
+
 # Note: CE0 is used as CS pin by Linux system calls (and is NOT held between
 # Python calls, even in the same context), so all reads must use write_readinto.
 class Ax5043:
     def __init__(self, bus):
         self._bus = bus
+        # Last known value of each configuration register, to skip redundant writes
+        self.shadow = {}
+        # Writes deferred by an open transaction()
+        self._pending = None
+        self.spi_transactions = 0
 
-    def execute(self, cmds):
+    def _write(self, addr_wvals):
+        self.spi_transactions += 1
+        with self._bus as spi: spi.write(addr_wvals)
+
+    def _write_readinto(self, addr_wvals, rvals):
+        self.spi_transactions += 1
+        with self._bus as spi: spi.write_readinto(addr_wvals, rvals)
+
+    def execute(self, cmds, force=False):
+        # Writes {register: value}, skipping values the register already has (per the shadow copy) unless force
+        if self._pending is not None:
+            if not VOLATILE_REGS.intersection(cmds):
+                self._pending.update(cmds)
+                return
+            # Keep the order of configuration and e.g. PWRMODE writes
+            pending, self._pending = self._pending, None
+            self.execute(pending)
+            self._pending = {}
+        writes = {addr: value for addr, value in cmds.items()
+                  if force or addr in VOLATILE_REGS or self.shadow.get(addr) != value}
+        for addr_wvals in self._bursts(writes):
+            self._write(addr_wvals)
+        for addr, value in writes.items():
+            if addr not in VOLATILE_REGS:
+                self.shadow[addr] = value
+        # Enhancements: return status bits?
+
+    def _bursts(self, writes):
+        # Yields one SPI write per run of contiguous register addresses (the address auto-increments)
         last_addr = -2
         addr_wvals = None
-        for addr, value in sorted(cmds.items()):
-            if addr - last_addr != 1:
-                # Write accumulated contiguous bytes
-                if addr_wvals is not None:
-                    with self._bus as spi: spi.write(addr_wvals)
+        for addr, value in sorted(writes.items()):
+            if addr_wvals is not None and addr - last_addr != 1:
+                gap = range(last_addr + 1, addr)
+                if (len(gap) <= BURST_GAP and (last_addr < 0x70) == (addr < 0x70)
+                        and all(a in self.shadow for a in gap)):
+                    addr_wvals.extend(self.shadow[a] for a in gap)
+                else:
+                    # Write accumulated contiguous bytes
+                    yield addr_wvals
+                    addr_wvals = None
 
-                # Initialize next write buffer
+            # Initialize next write buffer
+            if addr_wvals is None:
                 if addr < 0x70:
                     addr_wvals = bytearray([0x80 | addr])
                 else:
@@ -426,26 +508,53 @@ class Ax5043:
 
         # Write accumulated contiguous bytes
         if addr_wvals is not None:
-            with self._bus as spi: spi.write(addr_wvals)
-        # Enhancements: return status bits?
+            yield addr_wvals
 
-    def read(self, addr):
+    @contextmanager
+    def transaction(self):
+        # Defers the configuration writes of every execute() in the block and sends them as merged bursts at
+        # the end, so later values for a register replace earlier ones without being written twice
+        if self._pending is not None:
+            yield
+            return
+        self._pending = {}
+        try:
+            yield
+        finally:
+            pending, self._pending = self._pending, None
+            self.execute(pending)
+
+    def refresh_shadow(self, addrs):
+        # Reads the registers in addrs (at or above SHADOW_READ_START) and the registers between them into the
+        # shadow copy, so matching writes are skipped and gaps between writes can be bridged
+        addrs = sorted(addr for addr in addrs if addr >= SHADOW_READ_START and addr not in VOLATILE_REGS)
+        spans = []
+        for addr in addrs:
+            if spans and addr - spans[-1][1] <= SHADOW_READ_GAP:
+                spans[-1][1] = addr
+            else:
+                spans.append([addr, addr])
+        for start, end in spans:
+            for addr, value in zip(range(start, end + 1), self.read_burst(start, end - start + 1)):
+                if addr in REG_ADDRS and addr not in VOLATILE_REGS:
+                    self.shadow[addr] = value
+
+    def read_burst(self, addr, count):
+        # Reads count consecutive registers starting at addr in one SPI transaction
         if addr < 0x70:
-            addr_wvals = bytearray([addr, 0])
+            addr_wvals = bytearray([addr]) + bytearray(count)
         else:
-            addr_wvals = bytearray([0x70 | (addr >> 8), addr & 0xFF, 0])
+            addr_wvals = bytearray([0x70 | (addr >> 8), addr & 0xFF]) + bytearray(count)
         rvals = bytearray(len(addr_wvals))
-        with self._bus as spi: spi.write_readinto(addr_wvals, rvals)
-        return rvals[-1]
+        self._write_readinto(addr_wvals, rvals)
+        return rvals[-count:]
+
+    def read(self, addr):
+        return self.read_burst(addr, 1)[0]
 
     def read_16(self, addr):
-        if addr < 0x70:
-            addr_wvals = bytearray([addr, 0, 0])
-        else:
-            addr_wvals = bytearray([0x70 | (addr >> 8), addr & 0xFF, 0, 0])
-        rvals = bytearray(len(addr_wvals))
-        with self._bus as spi: spi.write_readinto(addr_wvals, rvals)
-        return (rvals[-2] << 8) | rvals[-1]
+        hi, lo = self.read_burst(addr, 2)
+        return (hi << 8) | lo
 
     def set_pwrmode(self, mode):
         # Always sets REFEN, XOEN high
@@ -454,20 +563,23 @@ class Ax5043:
     def reset(self):
         self.execute({Reg.PWRMODE: 0xE0})
         self.execute({Reg.PWRMODE: 0x50})
+        # Every register is back to its reset value
+        self.shadow.clear()
 
     def write_fifo(self, values):
         # Writing to FIFODATA does not auto-advance the SPI address pointer
         addr_wvals = bytearray([0x80 | Reg.FIFODATA]) + values
         rvals = bytearray(len(addr_wvals))
-        with self._bus as spi: spi.write_readinto(addr_wvals, rvals)
+        self._write_readinto(addr_wvals, rvals)
         # TODO: Check FIFO status in rvals
 
-    def write_fifo_data(self, data):
-        # TODO: Document flags
-        self.write_fifo(bytearray([0xE1, len(data) + 1, 0x13]) + data)
+    def write_fifo_data(self, data, flags=Fifoflags.RAW | Fifoflags.PKTSTART | Fifoflags.PKTEND):
+        # FIFO DATA command: length (including the flags byte), flags, data
+        # A packet larger than the FIFO is written as several commands: PKTSTART on the first, PKTEND on the last
+        self.write_fifo(bytearray([0xE1, len(data) + 1, flags]) + data)
 
     def read_fifo(self, count):
         addr_wvals = bytearray([Reg.FIFODATA]) + bytearray(count)
         rvals = bytearray(len(addr_wvals))
-        with self._bus as spi: spi.write_readinto(addr_wvals, rvals)
+        self._write_readinto(addr_wvals, rvals)
         return rvals[1:]
@@ -1,18 +1,88 @@
 import logging
 import queue
+import threading
 import time
-from communications.ax5043_manager.ax5043_driver import Reg, Pwrmode, Bits, Fifocmd, Chunk, DataChunk
+from concurrent.futures import Future
+from communications.ax5043_manager.ax5043_driver import (
+    Reg, Pwrmode, Bits, Irq, Fifocmd, Fifoflags, Rxflags, Chunk, DataChunk, FIFO_SIZE, FIFO_DATA_HEADER)
+from communications.ax5043_manager.link_metrics import LinkMetrics, Metric
+
+# The first byte of a packet is its length (including itself)
+MAX_MESSAGE_LENGTH = 254
+# The next part of a packet is written once more than this many bytes of the FIFO are free
+FIFO_THRESHOLD = 128
+# Preamble (repeat raw 0xAA to generate 272 alternating bits)
+PREAMBLE = bytes([0x62, 0x38, 0x21, 0xAA])
+# Sync word (undocumented command to write 0xCCAACCAA)
+SYNC_WORD = bytes([0xA1, 0x18, 0xCC, 0xAA, 0xCC, 0xAA])
+
+
+class ConstantBackoff:
+    """Waits the same [delay] seconds between polls of the radio"""
+    def __init__(self, delay=0.01):
+        self.delay = delay
+
+    def reset(self): pass
+
+    def next(self):
+        return self.delay
+
+
+class ExponentialBackoff:
+    """Polls again after [initial] seconds when the radio made progress, and waits [factor] times longer
+    after each poll that did not, up to [maximum] seconds"""
+    def __init__(self, initial=0.001, maximum=0.1, factor=2.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.delay = initial
+
+    def reset(self):
+        self.delay = self.initial
+
+    def next(self):
+        delay = self.delay
+        self.delay = min(self.delay * self.factor, self.maximum)
+        return delay
+
+
+class TxRequest:
+    """A message waiting to be transmitted and the future completed once it has left the radio"""
+    def __init__(self, msg, future=None):
+        self.msg = msg
+        self.future = Future() if future is None else future
+
+    def fail(self, err):
+        # Returns True if the request had not completed yet
+        if self.future.done():
+            return False
+        self.future.set_exception(err if isinstance(err, Exception) else RuntimeError(err))
+        return True
+
 
 class Manager:
-    def __init__(self, driver):
+    """State machine of the AX5043. Call dispatch() every control cycle, or start() to dispatch from a
+    background thread.
+    [driver]: Ax5043 (or MockAx5043)
+    [backoff]: strategy for the wait between dispatches of the background thread and between register polls
+    [clock], [sleep]: time source, replaceable for tests"""
+    def __init__(self, driver, backoff=None, clock=time.monotonic, sleep=time.sleep):
         self.driver = driver
         self.tx_enabled = False
         self.rx_enabled = False
         self.reset_requested = False
-        self.inbox = queue.Queue()  # TODO: consider SimpleQueue (requires Python 3.7)
+        self.inbox = queue.Queue()  # TxRequest, or bytearray for callers that do not need completion
         self.outbox = queue.Queue()
-        # TODO: metrics
+        self.backoff = ExponentialBackoff() if backoff is None else backoff
+        self.clock = clock
+        self.sleep = sleep
+        # Dispatches from the background thread and from callers must not interleave SPI transactions
+        self.lock = threading.RLock()
+        self.thread = None
+        self.running = False
+        self.metrics = LinkMetrics(clock)
         self.state = Manager.Initializing(self)
+        self.metrics.enter_state('Initializing')
 
         # TODO: try-except?
         self.state.enter()
@@ -27,26 +97,83 @@ class Manager:
             logging.error('Exception exiting state %s: %s',
                           self.state.__class__.__name__, e)
             self.state = Manager.Error(self, e)
+        self.metrics.enter_state(self.state.__class__.__name__)
         try:
             self.state.enter()
         except Exception as e:
             logging.error('Exception entering state %s: %s',
                           self.state.__class__.__name__, e)
             self.state = Manager.Error(self, e)
+            self.metrics.enter_state('Error')
             # Any exceptions raised by Error.enter() will not be caught
             self.state.enter()
             return
 
     def dispatch(self):
-        if self.reset_requested:
-            logging.info('Resetting')
-            self.transition(Manager.Initializing(self))
-        else:
+        """Runs one step of the current state. Returns True if the radio made progress (so it is worth
+        dispatching again right away)"""
+        with self.lock:
+            if self.reset_requested:
+                logging.info('Resetting')
+                self.reset_requested = False
+                self.transition(Manager.Initializing(self))
+                return True
             try:
-                self.state.dispatch()
+                return bool(self.state.dispatch())
             except Exception as e:
                 logging.error('Exception dispatching state %s: %s',
                               self.state.__class__.__name__, e)
+                return False
+
+    def transmit(self, msg):
+        """Queues [msg] for transmission and returns a concurrent.futures.Future that is set to the number of
+        bytes sent once the packet has left the radio, or to an exception if it was aborted"""
+        if len(msg) > MAX_MESSAGE_LENGTH:
+            raise ValueError('Message of %d bytes is longer than %d bytes' % (len(msg), MAX_MESSAGE_LENGTH))
+        request = TxRequest(msg)
+        self.inbox.put(request)
+        return request.future
+
+    def next_request(self):
+        request = self.inbox.get()
+        return request if isinstance(request, TxRequest) else TxRequest(request)
+
+    def abort_pending(self, err='Transmission aborted'):
+        """Fails every message still waiting in the inbox with [err]. Returns how many were dropped"""
+        # Under the lock so that Transmitting never blocks on an inbox emptied after should_transmit()
+        with self.lock:
+            aborted = 0
+            while True:
+                try:
+                    request = self.inbox.get_nowait()
+                except queue.Empty:
+                    return aborted
+                if isinstance(request, TxRequest) and request.fail(err):
+                    self.metrics.count(Metric.TX_FAILURES)
+                aborted += 1
+
+    def start(self):
+        """Dispatches from a background thread until stop(), backing off while the radio has nothing to do"""
+        if self.thread is not None:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='ax5043', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while self.running:
+            if self.dispatch():
+                self.backoff.reset()
+            if self.is_faulted():
+                logging.error('Radio manager faulted')
+                self.reset_requested = True
+            self.sleep(self.backoff.next())
 
     def enable_pa(self, enabled):
         # TODO: enable power amp
@@ -59,25 +186,37 @@ class Manager:
     def is_faulted(self):
         return isinstance(self.state, Manager.Error)
 
+    def sample_link(self):
+        # Reads RSSI, BGNDRSSI and TRKRFFREQ (0x040-0x04F) in one burst, right after a packet was received
+        regs = self.driver.read_burst(Reg.RSSI, Reg.TRKRFFREQ0 - Reg.RSSI + 1)
+        rssi = regs[0] - 0x100 if regs[0] & 0x80 else regs[0]
+        i = Reg.TRKRFFREQ2 - Reg.RSSI
+        rf_freq_offset = ((regs[i] & 0x0F) << 16) | (regs[i + 1] << 8) | regs[i + 2]
+        if rf_freq_offset & 0x80000:
+            rf_freq_offset -= 0x100000
+        self.metrics.sample_rx(rssi, regs[Reg.BGNDRSSI - Reg.RSSI], rf_freq_offset)
+
     def poll(self, reg, mask, target=None, timeout=0.1):
+        """Waits for (register [reg] & [mask]) == [target], sleeping between reads"""
         if target is None: target = mask
-        start_time = time.monotonic()
+        start_time = self.clock()
+        backoff = ExponentialBackoff(initial=0.0005, maximum=0.01)
         val = self.driver.read(reg)
         while (val & mask) != target:
-            val = self.driver.read(reg)
-            dt = time.monotonic() - start_time
+            dt = self.clock() - start_time
             if dt > timeout:
                 raise RuntimeError('Timeout (%s > %s) polling for register %02X, '
                                    'mask %02X, to reach %02X (last value was %02X)'
                                    % (dt, timeout, reg, mask, target, val))
+            self.sleep(backoff.next())
+            val = self.driver.read(reg)
         return val
 
     def post(self):
-        rev = self.driver.read(Reg.SILICONREVISION)
+        rev, s = self.driver.read_burst(Reg.SILICONREVISION, 2)
         if rev != 0x51:
             logging.error('Expected rev 0x51, but got %02X' % rev)
             return False
-        s = self.driver.read(Reg.SCRATCH)
         if s != 0xC5:
             logging.error('Expected initial scratch to be 0xC5, but got %02X' % s)
             return False
@@ -95,6 +234,7 @@ class Manager:
 
         def enter(self): pass
         def exit(self): pass
+        # Returns True if the state made progress
         def dispatch(self): pass
 
     class Initializing(State):
@@ -109,9 +249,15 @@ class Manager:
             logging.info('POST passed')
 
         def dispatch(self):
-            self.mgr.driver.execute(setup_cmds)
-            self.mgr.driver.execute(datarate_cmds)
+            drv = self.mgr.driver
+            # Learn the reset values so unchanged registers are skipped, then send the
+            # configuration as a few bursts of contiguous registers
+            drv.refresh_shadow(config_regs)
+            with drv.transaction():
+                drv.execute(setup_cmds)
+                drv.execute(datarate_cmds)
             self.mgr.transition(Manager.Autoranging(self.mgr))
+            return True
 
     class Autoranging(State):
         MAX_POLL_COUNT = 10
@@ -135,7 +281,7 @@ class Manager:
             except Exception as e:
                 logging.warning(e)
                 return
-            
+
             # Set RNG_START
             self.mgr.driver.execute({Reg.PLLRANGINGA: Bits.RNG_START | 0x08})
             self.started = True
@@ -158,9 +304,10 @@ class Manager:
                 self.mgr.transition(Manager.Error(self.mgr, 'RNGERR'))
             elif not (pllranging & Bits.RNG_START):
                 self.mgr.transition(Manager.Idle(self.mgr))
+                return True
             else:
                 self.poll_count += 1
-                if self.poll_count > MAX_POLL_COUNT:
+                if self.poll_count > self.MAX_POLL_COUNT:
                     self.mgr.transition(Manager.Error(self.mgr, 'RNG_START'))
 
     class Idle(State):
@@ -172,16 +319,31 @@ class Manager:
 
         def dispatch(self):
             if self.mgr.should_transmit():
-                msg = self.mgr.inbox.get()
-                self.mgr.transition(Manager.Transmitting(self.mgr, msg))
+                self.mgr.transition(Manager.Transmitting(self.mgr, self.mgr.next_request()))
+                return True
             elif self.mgr.rx_enabled:
                 self.mgr.transition(Manager.Receiving(self.mgr))
+                return True
 
     class Transmitting(State):
-        def __init__(self, mgr, msg):
+        # Each dispatch reads at most a couple of registers and moves the packet along by one phase, so
+        # packets larger than the FIFO are streamed without blocking the caller:
+        # STARTING: wait for the voltage regulator, then write preamble, sync word and the first part of the packet
+        # COMMITTING: wait for the crystal oscillator, then commit the FIFO
+        # SENDING: write the next part of the packet whenever more than FIFO_THRESHOLD bytes are free
+        # DRAINING: wait for the radio to finish sending
+        STARTING, COMMITTING, SENDING, DRAINING = range(4)
+        STARTUP_TIMEOUT = 0.1  # s for the voltage regulator and crystal oscillator
+        PACKET_TIMEOUT = 30  # s to send one packet (255 bytes at 500 bps take about 4 s)
+
+        def __init__(self, mgr, request):
             super().__init__(mgr)
-            self.msg = msg
- 
+            self.request = request if isinstance(request, TxRequest) else TxRequest(request)
+
+        @property
+        def msg(self):
+            return self.request.msg
+
         def enter(self):
             assert self.mgr.tx_enabled
             logging.info('Transmitting %d bytes', len(self.msg))
@@ -189,44 +351,91 @@ class Manager:
             # Write to PWRMODE to avoid errata
             drv.set_pwrmode(Pwrmode.FIFOON)
             # Set Tx-specific configs
-            drv.execute({Reg.PLLVCODIV: 0x24, Reg.TUNE_F18: 0x06})
+            drv.execute({Reg.PLLVCODIV: 0x24, Reg.TUNE_F18: 0x06,
+                         Reg.FIFOTHRESH1: FIFO_THRESHOLD >> 8, Reg.FIFOTHRESH0: FIFO_THRESHOLD & 0xFF})
             drv.set_pwrmode(Pwrmode.FULLTX)
             self.mgr.enable_pa(True)
-            # Before writing to the FIFO, wait for voltage regulator to finish starting up
-            self.mgr.poll(Reg.POWSTAT, Bits.SVMODEM)
-            # Write to FIFO
-            # Preamble (repeat raw 0xAA to generate 272 alternating bits)
-            drv.write_fifo(bytearray([0x62, 0x38, 0x21, 0xAA]))
-            # Sync word (undocumented command to write 0xCCAACCAA)
-            drv.write_fifo(bytearray([0xA1, 0x18, 0xCC, 0xAA, 0xCC, 0xAA]))
-            # Data (no framing, full packet)
             # First byte must be length of message (including itself)
-            drv.write_fifo_data(bytearray([len(self.msg) + 1]) + self.msg)
-            # Wait until crystal oscillator is running
-            self.mgr.poll(Reg.XTALSTATUS, Bits.XTAL_RUN)
-            # Commit FIFO
-            drv.execute({Reg.FIFOSTAT: Fifocmd.COMMIT})
-            # TODO: msg larger than fifo
+            self.packet = bytearray([len(self.msg) + 1]) + self.msg
+            self.offset = 0
+            self.phase = self.STARTING
+            self.deadline = self.mgr.clock() + self.STARTUP_TIMEOUT
 
         def dispatch(self):
             if not self.mgr.tx_enabled:
-                # TODO: abort notice?
-                logging.warn('Transmission aborted')
+                logging.warning('Transmission aborted')
+                self.fail_request('Transmission aborted')
                 self.mgr.transition(Manager.Idle(self.mgr))
-            # Wait until transmission is done (TODO: 0-timeout)
-            #radiostate = self.mgr.driver.poll(Reg.RADIOSTATE, 0xFF, 0)
-            radiostate = self.mgr.driver.read(Reg.RADIOSTATE)
-            if radiostate == 0:
-                if self.mgr.should_transmit():
-                    # No transmission to avoid powering down PA on exit
-                    self.msg = self.mgr.inbox.get()
-                    self.enter()
-                elif self.mgr.rx_enabled:
-                    self.mgr.transition(Manager.Receiving(self.mgr))
-                else:
-                    self.mgr.transition(Manager.Idle(self.mgr))
+                return True
+            drv = self.mgr.driver
+            if self.phase == self.STARTING:
+                # Before writing to the FIFO, wait for voltage regulator to finish starting up
+                if not drv.read(Reg.POWSTAT) & Bits.SVMODEM:
+                    return self.check_deadline('SVMODEM')
+                drv.write_fifo(PREAMBLE)
+                drv.write_fifo(SYNC_WORD)
+                self.write_part(FIFO_SIZE - len(PREAMBLE) - len(SYNC_WORD))
+                self.phase = self.COMMITTING
+            if self.phase == self.COMMITTING:
+                # Wait until crystal oscillator is running
+                if not drv.read(Reg.XTALSTATUS) & Bits.XTAL_RUN:
+                    return self.check_deadline('XTAL_RUN')
+                drv.execute({Reg.FIFOSTAT: Fifocmd.COMMIT})
+                self.phase = self.SENDING if self.offset < len(self.packet) else self.DRAINING
+                self.deadline = self.mgr.clock() + self.PACKET_TIMEOUT
+                return True
+            if self.phase == self.SENDING:
+                irq = drv.read_16(Reg.IRQREQUEST1)
+                if irq & Irq.FIFOERROR:
+                    return self.fail('FIFO error')
+                if not irq & Irq.FIFOTHRFREE:
+                    return self.check_deadline('FIFO space')
+                self.write_part(FIFO_THRESHOLD)
+                drv.execute({Reg.FIFOSTAT: Fifocmd.COMMIT})
+                if self.offset == len(self.packet):
+                    self.phase = self.DRAINING
+                return True
+            # Wait until transmission is done
+            if drv.read(Reg.RADIOSTATE) != 0:
+                return self.check_deadline('end of transmission')
+            self.request.future.set_result(len(self.msg))
+            self.mgr.metrics.count(Metric.TX_PACKETS)
+            self.mgr.metrics.count(Metric.TX_BYTES, len(self.msg))
+            if self.mgr.should_transmit():
+                # No transmission to avoid powering down PA on exit
+                self.request = self.mgr.next_request()
+                self.enter()
+            elif self.mgr.rx_enabled:
+                self.mgr.transition(Manager.Receiving(self.mgr))
+            else:
+                self.mgr.transition(Manager.Idle(self.mgr))
+            return True
+
+        def write_part(self, space):
+            """Writes as much of the packet as fits in [space] bytes of the FIFO"""
+            end = min(len(self.packet), self.offset + space - FIFO_DATA_HEADER)
+            flags = Fifoflags.RAW
+            if self.offset == 0: flags |= Fifoflags.PKTSTART
+            if end == len(self.packet): flags |= Fifoflags.PKTEND
+            self.mgr.driver.write_fifo_data(self.packet[self.offset:end], flags)
+            self.offset = end
+
+        def check_deadline(self, waiting_for):
+            if self.mgr.clock() > self.deadline:
+                self.fail('Timeout waiting for %s' % waiting_for)
+            return False
+
+        def fail(self, err):
+            self.fail_request(err)
+            self.mgr.transition(Manager.Error(self.mgr, err))
+            return False
+
+        def fail_request(self, err):
+            if self.request.fail(err):
+                self.mgr.metrics.count(Metric.TX_FAILURES)
 
         def exit(self):
+            self.fail_request('Transmission interrupted')
             self.mgr.enable_pa(False)
             self.mgr.driver.set_pwrmode(Pwrmode.STANDBY)
 
@@ -249,12 +458,13 @@ class Manager:
         def dispatch(self):
             # TODO: poll radiostate for whether currently receiving?
             if self.mgr.should_transmit():
-                msg = self.mgr.inbox.get()
-                self.mgr.transition(Manager.Transmitting(self.mgr, msg))
+                self.mgr.transition(Manager.Transmitting(self.mgr, self.mgr.next_request()))
+                return True
             elif not self.mgr.rx_enabled:
                 self.mgr.transition(Manager.Idle(self.mgr))
+                return True
             else:
-                self.drain_fifo()
+                return self.drain_fifo()
 
         def exit(self):
             self.mgr.driver.set_pwrmode(Pwrmode.STANDBY)
@@ -263,32 +473,43 @@ class Manager:
             self.mgr.driver.execute({Reg.FIFOSTAT: Fifocmd.CLEAR_DATA_FLAGS})
 
         def drain_fifo(self):
+            """Reads and parses whatever is in the FIFO. Returns True if anything was read"""
             fifocount = self.mgr.driver.read_16(Reg.FIFOCOUNT1)
             if fifocount > 0:
+                self.mgr.metrics.fifo_level(fifocount)
                 self.data += self.mgr.driver.read_fifo(fifocount)
                 while len(self.data) > 0:
                     try:
                         (chunk, self.data) = Chunk.from_bytes(self.data)
                     except Exception as e:
                         logging.error(e)
+                        self.mgr.metrics.count(Metric.RX_FIFO_ERRORS)
                         self.bad_fifo = True
                         self.mgr.transition(Manager.Receiving(self.mgr))
-                        return
+                        return True
                     logging.debug('Parsed chunk %s', chunk)
                     # TODO: metadata
-                    if isinstance(chunk, DataChunk): 
+                    if isinstance(chunk, DataChunk):
                         # TODO: multipart
                         logging.info('Received %d bytes', len(chunk.data))
                         assert len(chunk.data) > 0
                         # First byte is packet length (including itself)
-                        if chunk.data[0] == len(chunk.data):
+                        if chunk.flags & Rxflags.CRCFAIL:
+                            logging.error('CRC failed')
+                            self.mgr.metrics.count(Metric.RX_CRC_ERRORS)
+                        elif chunk.data[0] == len(chunk.data):
                             self.mgr.outbox.put(chunk.data[1:])
+                            self.mgr.metrics.count(Metric.RX_PACKETS)
+                            self.mgr.metrics.count(Metric.RX_BYTES, len(chunk.data) - 1)
+                            self.mgr.sample_link()
                         else:
                             logging.error('First byte (%d) does not match length (%d)', chunk.data[0], len(chunk.data))
+                            self.mgr.metrics.count(Metric.RX_LENGTH_ERRORS)
                             # TODO: What next?
                     elif chunk is None:
                         # TODO: abort if not making progress
                         break
+            return fifocount > 0
 
     class Error(State):
         def __init__(self, mgr, err):
@@ -430,3 +651,5 @@ datarate_cmds = {
     Reg.TXRATE0: 0xAF,
     Reg.TUNE_F35: 0x12,
 }
+
+config_regs = sorted(set(setup_cmds) | set(datarate_cmds))
@@ -0,0 +1,82 @@
+from array import array
+from enum import IntEnum, unique
+import time
+from communications.ax5043_manager.ax5043_driver import FIFO_SIZE
+
+@unique
+class Metric(IntEnum):
+    # Index into LinkMetrics.counters
+    TX_PACKETS = 0
+    TX_BYTES = 1
+    TX_FAILURES = 2
+    RX_PACKETS = 3
+    RX_BYTES = 4
+    RX_CRC_ERRORS = 5
+    RX_LENGTH_ERRORS = 6  # first byte of the packet does not match its length
+    RX_FIFO_ERRORS = 7  # FIFO contents could not be parsed into chunks
+
+# Manager states, in the order of LinkMetrics.state_time
+STATES = ('Initializing', 'Autoranging', 'Idle', 'Transmitting', 'Receiving', 'Error')
+# Bins of the FIFO fill level histogram, each FIFO_SIZE / FIFO_BINS bytes wide
+FIFO_BINS = 8
+# Received packets whose RSSI, background RSSI and RF frequency offset are kept
+RX_SAMPLES = 16
+
+class LinkMetrics:
+    # Counts of everything the radio link does, kept in fixed-size arrays so they can be
+    # read by Telemetry and downlinked without growing or going through the logs
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.reset()
+
+    def reset(self):
+        self.counters = array('L', [0] * len(Metric))
+        self.state_time = array('d', [0.0] * len(STATES))  # seconds spent in each state
+        self.fifo_fill = array('L', [0] * FIFO_BINS)
+        # Ring buffers of the last RX_SAMPLES received packets
+        self.rssi = array('b', [0] * RX_SAMPLES)  # dB
+        self.bgnd_rssi = array('B', [0] * RX_SAMPLES)
+        self.rf_freq_offset = array('l', [0] * RX_SAMPLES)  # TRKRFFREQ, signed 20 bits
+        self.rx_samples = 0
+        self.state = None
+        self.state_start = self.clock()
+
+    def count(self, metric, n=1):
+        self.counters[metric] += n
+
+    def enter_state(self, name):
+        # Adds the time since the last transition to the state being left
+        now = self.clock()
+        if self.state in STATES:
+            self.state_time[STATES.index(self.state)] += now - self.state_start
+        self.state = name
+        self.state_start = now
+
+    def fifo_level(self, count):
+        self.fifo_fill[min(count * FIFO_BINS // FIFO_SIZE, FIFO_BINS - 1)] += 1
+
+    def sample_rx(self, rssi, bgnd_rssi, rf_freq_offset):
+        i = self.rx_samples % RX_SAMPLES
+        self.rssi[i] = rssi
+        self.bgnd_rssi[i] = bgnd_rssi
+        self.rf_freq_offset[i] = rf_freq_offset
+        self.rx_samples += 1
+
+    def recent(self, samples):
+        # Values of a ring buffer that have been filled, oldest first
+        n = min(self.rx_samples, RX_SAMPLES)
+        start = self.rx_samples % RX_SAMPLES if self.rx_samples > RX_SAMPLES else 0
+        return [samples[(start + i) % RX_SAMPLES] for i in range(n)]
+
+    def snapshot(self):
+        # Copy of every metric, with the time in the current state included
+        state_time = list(self.state_time)
+        if self.state in STATES:
+            state_time[STATES.index(self.state)] += self.clock() - self.state_start
+        snapshot = {metric.name.lower(): self.counters[metric] for metric in Metric}
+        snapshot.update(state_time=dict(zip(STATES, state_time)),
+                        fifo_fill=list(self.fifo_fill),
+                        rssi=self.recent(self.rssi),
+                        bgnd_rssi=self.recent(self.bgnd_rssi),
+                        rf_freq_offset=self.recent(self.rf_freq_offset))
+        return snapshot
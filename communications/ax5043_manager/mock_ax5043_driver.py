@@ -1,29 +1,106 @@
-from ax5043_driver import Ax5043
+import time
+from ax5043_driver import Ax5043, Reg, Bits, Irq, Fifocmd, Pwrmode, FIFO_SIZE
 
-# Ideas:
-# * Writes replace read_defaults
-# * FIFO utilities
 class MockAx5043(Ax5043):
-    def __init__(self):
+    """Register-level stand-in for the AX5043.
+    Writes replace read_defaults, autoranging finishes as soon as it is started, and the FIFO is simulated:
+    committed bytes are sent at [bitrate] bits per second of [clock] while in FULLTX
+    (instantly if bitrate is None), and appended to transmitted."""
+    def __init__(self, bitrate=None, clock=time.monotonic):
         super().__init__(None)
         self.read_defaults = rst_values.copy()
         self.read_queue = {}
+        self.bitrate = bitrate
+        self.clock = clock
+        self.fifo = bytearray()
+        self.committed = 0  # bytes at the front of the FIFO that have been committed
+        self.transmitted = bytearray()
+        self.fifo_error = False
+        self.last_drain = clock()
+        self.credit = 0.0  # bytes the radio could have sent since the last drain
 
-    def execute(self, cmds): pass
+    def execute(self, cmds):
+        for addr, value in cmds.items():
+            if addr == Reg.FIFOSTAT:
+                if value == Fifocmd.COMMIT:
+                    self.drain()
+                    self.committed = len(self.fifo)
+                elif value == Fifocmd.CLEAR_DATA_FLAGS:
+                    self.fifo.clear()
+                    self.committed = 0
+                    self.fifo_error = False
+            elif addr == Reg.PLLRANGINGA:
+                self.read_defaults[addr] = value & ~Bits.RNG_START
+            else:
+                self.read_defaults[addr] = value
+
+    def drain(self):
+        now = self.clock()
+        if (self.read_defaults[Reg.PWRMODE] & 0x0F) == Pwrmode.FULLTX and self.committed > 0:
+            if self.bitrate is None:
+                count = self.committed
+            else:
+                self.credit += (now - self.last_drain) * self.bitrate / 8
+                count = min(int(self.credit), self.committed)
+                self.credit -= count
+            self.transmitted += self.fifo[:count]
+            del self.fifo[:count]
+            self.committed -= count
+        if self.committed == 0:
+            self.credit = 0.0
+        self.last_drain = now
 
     def read(self, addr):
+        self.drain()
         if addr in self.read_queue:
             return self.read_queue.pop(addr)
+        elif addr == Reg.RADIOSTATE:
+            return 0x06 if self.committed else 0x00  # TX or IDLE
         else:
             return self.read_defaults[addr]
 
-    def read_16(self, addr): return 0x0000
-    def read_fifo(self, count): return bytearray(count)
-    def write_fifo(self, values): pass
+    def read_burst(self, addr, count):
+        return bytearray(self.read(a) if a in self.read_defaults else 0 for a in range(addr, addr + count))
+
+    def read_16(self, addr):
+        self.drain()
+        if addr == Reg.FIFOCOUNT1:
+            return len(self.fifo)
+        elif addr == Reg.FIFOFREE1:
+            return FIFO_SIZE - len(self.fifo)
+        elif addr == Reg.IRQREQUEST1:
+            threshold = (self.read_defaults[Reg.FIFOTHRESH1] << 8) | self.read_defaults[Reg.FIFOTHRESH0]
+            irq = 0
+            if self.fifo: irq |= Irq.FIFONOTEMPTY
+            if len(self.fifo) < FIFO_SIZE: irq |= Irq.FIFONOTFULL
+            if FIFO_SIZE - len(self.fifo) > threshold: irq |= Irq.FIFOTHRFREE
+            if self.fifo_error: irq |= Irq.FIFOERROR
+            if self.read_defaults[Reg.XTALSTATUS] & Bits.XTAL_RUN: irq |= Irq.XTALREADY
+            return irq
+        return 0x0000
+
+    def read_fifo(self, count):
+        data = self.fifo[:count]
+        del self.fifo[:count]
+        self.committed = max(0, self.committed - count)
+        return data + bytearray(count - len(data))
+
+    def write_fifo(self, values):
+        self.drain()
+        if len(self.fifo) + len(values) > FIFO_SIZE:
+            self.fifo_error = True
+            values = values[:FIFO_SIZE - len(self.fifo)]
+        self.fifo += values
+
+    def receive(self, msg, flags=0x03, length=None):
+        """Puts a received packet carrying [msg] into the FIFO as a FIFO DATA chunk with [flags].
+        [length] overrides the length byte of the packet"""
+        packet = bytearray([len(msg) + 1 if length is None else length]) + msg
+        self.fifo += bytearray([0xE1, len(packet) + 1, flags]) + packet
 
 rst_values = {
     0x000: 0x51,
-    0x001: 0x7d,
+    0x001: 0xc5,
     0x002: 0x60,
     0x003: 0xf7,
     0x004: 0x77,
@@ -1,5 +1,97 @@
 import unittest
 from ax5043_driver import *
+from ax5043_manager import setup_cmds, datarate_cmds, config_regs
+
+class FakeBus:
+    # Decodes AX5043 SPI transactions into a register map
+    def __init__(self, regs=None):
+        self.regs = dict(regs or {})
+        self.transactions = []
+
+    def __enter__(self): return self
+    def __exit__(self, *args): pass
+
+    def decode(self, buf):
+        if buf[0] & 0x70 == 0x70:
+            return ((buf[0] & 0x0F) << 8) | buf[1], 2
+        return buf[0] & 0x7F, 1
+
+    def write(self, buf):
+        addr, n = self.decode(buf)
+        self.transactions.append(('write', addr, len(buf) - n))
+        for i, value in enumerate(buf[n:]):
+            self.regs[addr + i] = value
+
+    def write_readinto(self, wbuf, rbuf):
+        addr, n = self.decode(wbuf)
+        if wbuf[0] & 0x80:
+            self.write(wbuf)
+            return
+        self.transactions.append(('read', addr, len(wbuf) - n))
+        for i in range(len(wbuf) - n):
+            rbuf[n + i] = self.regs.get(addr + i, 0)
+
+class TestTransactions(unittest.TestCase):
+    def test_contiguous_writes_are_one_burst(self):
+        bus = FakeBus()
+        drv = Ax5043(bus)
+        drv.execute({Reg.FREQA3: 0x09, Reg.FREQA2: 0x1D, Reg.FREQA1: 0x55, Reg.FREQA0: 0x55})
+        self.assertEqual(bus.transactions, [('write', Reg.FREQA3, 4)])
+
+    def test_redundant_writes_are_skipped(self):
+        bus = FakeBus()
+        drv = Ax5043(bus)
+        drv.execute({Reg.MODULATION: 0x04, Reg.ENCODING: 0x03})
+        drv.execute({Reg.MODULATION: 0x04, Reg.ENCODING: 0x02})
+        self.assertEqual(bus.transactions[1:], [('write', Reg.ENCODING, 1)])
+        # Side effects: always written
+        drv.set_pwrmode(Pwrmode.STANDBY)
+        drv.set_pwrmode(Pwrmode.STANDBY)
+        self.assertEqual(len(bus.transactions), 4)
+        # Shadow is forgotten on reset
+        drv.reset()
+        drv.execute({Reg.MODULATION: 0x04})
+        self.assertEqual(bus.transactions[-1], ('write', Reg.MODULATION, 1))
+
+    def test_burst_read(self):
+        bus = FakeBus({Reg.RSSI: 0xBD, Reg.BGNDRSSI: 0x80, Reg.TRKDATARATE2: 0x01})
+        drv = Ax5043(bus)
+        values = drv.read_burst(Reg.RSSI, Reg.TRKDATARATE2 - Reg.RSSI + 1)
+        self.assertEqual(values[0], 0xBD)
+        self.assertEqual(values[-1], 0x01)
+        self.assertEqual(bus.transactions, [('read', Reg.RSSI, 6)])
+
+    def test_transaction_defers_until_volatile_write(self):
+        bus = FakeBus()
+        drv = Ax5043(bus)
+        with drv.transaction():
+            drv.execute({Reg.PLLVCODIV: 0x24})
+            drv.execute({Reg.PLLVCODIV: 0x25})
+            self.assertEqual(bus.transactions, [])
+            drv.set_pwrmode(Pwrmode.FULLTX)
+            drv.execute({Reg.TUNE_F18: 0x02})
+        self.assertEqual([addr for _, addr, _ in bus.transactions], [Reg.PLLVCODIV, Reg.PWRMODE, Reg.TUNE_F18])
+        self.assertEqual(bus.regs[Reg.PLLVCODIV], 0x25)
+
+    def test_configuration_is_a_few_bursts(self):
+        bus = FakeBus()
+        drv = Ax5043(bus)
+        drv.refresh_shadow(config_regs)
+        with drv.transaction():
+            drv.execute(setup_cmds)
+            drv.execute(datarate_cmds)
+        expected = dict(setup_cmds)
+        expected.update(datarate_cmds)
+        for addr, value in expected.items():
+            self.assertEqual(bus.regs.get(addr, 0), value)
+        # Without the shadow copy and transaction this took 57 writes
+        self.assertLessEqual(len(bus.transactions), 30)
+        # Applying the same configuration again writes nothing
+        count = len(bus.transactions)
+        with drv.transaction():
+            drv.execute(setup_cmds)
+            drv.execute(datarate_cmds)
+        self.assertEqual(len(bus.transactions), count)
 
 class TestChunk(unittest.TestCase):
     def test_from_bytes(self):
@@ -1,8 +1,26 @@
 import unittest
 import logging
-from ax5043_manager import Manager
+from ax5043_manager import Manager, ConstantBackoff, MAX_MESSAGE_LENGTH
 from mock_ax5043_driver import MockAx5043
-from ax5043_driver import Reg, Bits
+from ax5043_driver import Reg, Bits, Fifoflags, Rxflags, FIFO_SIZE
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def sent_chunks(transmitted):
+    # Skip preamble and sync word, then split the FIFO DATA commands into (flags, data)
+    chunks = []
+    i = 10
+    while i < len(transmitted):
+        assert transmitted[i] == 0xE1
+        length = transmitted[i + 1]
+        chunks.append((transmitted[i + 2], transmitted[i + 3:i + 2 + length]))
+        i += 2 + length
+    return chunks
 
 class TestManager(unittest.TestCase):
     def test_autorange_slow_xtal(self):
@@ -50,6 +68,112 @@ class TestManager(unittest.TestCase):
         mgr.dispatch()
         self.assertFalse(mgr.is_faulted())
 
+    def test_tx_streams_packet_larger_than_fifo(self):
+        clock = FakeClock()
+        mock = MockAx5043(bitrate=500, clock=clock)
+        mock.read_defaults[Reg.POWSTAT] |= Bits.SVMODEM
+        mgr = Manager(mock, clock=clock)
+        mgr.dispatch()
+        mgr.dispatch()
+        mgr.tx_enabled = True
+        msg = bytearray(range(MAX_MESSAGE_LENGTH))
+        future = mgr.transmit(msg)
+        self.assertFalse(future.done())
+        for _ in range(1000):
+            if future.done(): break
+            mgr.dispatch()
+            clock.now += 0.1
+        self.assertEqual(future.result(timeout=0), len(msg))
+        self.assertTrue(isinstance(mgr.state, Manager.Idle))
+        self.assertFalse(mock.fifo_error)
+        chunks = sent_chunks(mock.transmitted)
+        self.assertGreater(len(mock.transmitted), FIFO_SIZE)
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(chunks[0][0] & Fifoflags.PKTSTART)
+        self.assertTrue(chunks[-1][0] & Fifoflags.PKTEND)
+        self.assertEqual(b''.join(data for flags, data in chunks), bytearray([len(msg) + 1]) + msg)
+
+    def test_tx_timeout_fails_future(self):
+        clock = FakeClock()
+        mock = MockAx5043(clock=clock)
+        mgr = Manager(mock, clock=clock)
+        mgr.dispatch()
+        mgr.dispatch()
+        mgr.tx_enabled = True
+        future = mgr.transmit(bytearray([0xCA, 0xFE]))
+        mgr.dispatch()
+        # Voltage regulator never starts
+        clock.now += 1
+        mgr.dispatch()
+        self.assertTrue(mgr.is_faulted())
+        self.assertIsInstance(future.exception(timeout=0), RuntimeError)
+
+    def test_transmit_returns_future(self):
+        mock = MockAx5043()
+        mock.read_defaults[Reg.POWSTAT] |= Bits.SVMODEM
+        mgr = Manager(mock, backoff=ConstantBackoff(0.001))
+        mgr.tx_enabled = True
+        mgr.start()
+        try:
+            futures = [mgr.transmit(bytearray([i] * 100)) for i in range(3)]
+            self.assertEqual([f.result(timeout=5) for f in futures], [100, 100, 100])
+        finally:
+            mgr.stop()
+        # Preamble, sync word and one FIFO DATA command per packet
+        self.assertEqual(len(mock.transmitted), 3 * (10 + 3 + 101))
+
+    def test_abort_pending_fails_queued_futures(self):
+        mock = MockAx5043()
+        mgr = Manager(mock)
+        futures = [mgr.transmit(bytearray([i])) for i in range(2)]
+        mgr.inbox.put(bytearray([0xCA, 0xFE]))
+        self.assertEqual(mgr.abort_pending('Radio closed'), 3)
+        self.assertTrue(mgr.inbox.empty())
+        for future in futures:
+            self.assertIsInstance(future.exception(timeout=0), RuntimeError)
+        self.assertEqual(mgr.abort_pending(), 0)
+
+    def test_link_metrics(self):
+        clock = FakeClock()
+        mock = MockAx5043(clock=clock)
+        mock.read_defaults[Reg.POWSTAT] |= Bits.SVMODEM
+        mock.read_defaults[Reg.RSSI] = 0xBD
+        mock.read_defaults[Reg.BGNDRSSI] = 0x40
+        mock.read_defaults[Reg.TRKRFFREQ2] = 0x0F
+        mock.read_defaults[Reg.TRKRFFREQ1] = 0xFF
+        mock.read_defaults[Reg.TRKRFFREQ0] = 0xFE
+        mgr = Manager(mock, clock=clock)
+        mgr.dispatch()
+        mgr.dispatch()
+        mgr.tx_enabled = True
+        mgr.rx_enabled = True
+        future = mgr.transmit(bytearray(10))
+        while not future.done():
+            mgr.dispatch()
+        clock.now += 2
+        mgr.dispatch()
+        self.assertTrue(isinstance(mgr.state, Manager.Receiving))
+
+        mock.receive(bytearray([0xCA, 0xFE]))
+        mock.receive(bytearray([0xBA, 0xBE]), flags=0x03 | Rxflags.CRCFAIL)
+        mock.receive(bytearray([0x12, 0x34]), length=7)
+        mgr.dispatch()
+        self.assertEqual(mgr.outbox.get_nowait(), bytearray([0xCA, 0xFE]))
+        self.assertTrue(mgr.outbox.empty())
+
+        metrics = mgr.metrics.snapshot()
+        self.assertEqual(metrics['tx_packets'], 1)
+        self.assertEqual(metrics['tx_bytes'], 10)
+        self.assertEqual(metrics['rx_packets'], 1)
+        self.assertEqual(metrics['rx_bytes'], 2)
+        self.assertEqual(metrics['rx_crc_errors'], 1)
+        self.assertEqual(metrics['rx_length_errors'], 1)
+        self.assertEqual(metrics['rssi'], [-67])
+        self.assertEqual(metrics['bgnd_rssi'], [0x40])
+        self.assertEqual(metrics['rf_freq_offset'], [-2])
+        self.assertEqual(sum(metrics['fifo_fill']), 1)
+        self.assertAlmostEqual(metrics['state_time']['Receiving'], 2)
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     unittest.main()
@@ -0,0 +1,239 @@
+"""bulk_downlink.py: segmented downlink of files too large for a single downlink frame
+(NEMO rate data and histograms, logs, OpNav products).
+
+A file offered for downlink becomes a transfer with a 16 bit file id. The file is sent as BULK_SEGMENT_SIZE byte
+segments, each in its own BulkSegment downlink carrying the file id, the segment sequence number, the total number
+of segments and the CRC-32 of the segment data. Segments are read from disk one at a time when they are transmitted.
+The ground station asks for lost or corrupted segments again with a BulkRetransmit command (a bitmap of segments
+starting at a given sequence number) and ends the transfer with BulkComplete.
+Transfer state is saved to BULK_STATE_FILE so transfers resume where they stopped after a reboot."""
+import json
+import os
+from zlib import crc32
+
+from utils.constants import (
+    FMEnum,
+    NormalCommandEnum,
+    BULK_SEGMENT_SIZE,
+    BULK_BITMAP_SIZE,
+    BULK_STATE_FILE,
+    FILE_ID,
+    SEGMENT_SEQ,
+    SEGMENT_COUNT,
+    SEGMENT_CRC,
+    SEGMENT_DATA,
+    FILE_SIZE,
+)
+from utils.exceptions import DownlinkUnpackingException
+from utils.log import get_log
+
+logger = get_log()
+
+
+def bitmap_from_segments(base_seq: int, segments, size: int = BULK_BITMAP_SIZE) -> bytes:
+    """Returns the retransmit bitmap for [segments] relative to [base_seq]; bit i (MSB first) is segment base_seq + i"""
+    bitmap = bytearray(size)
+    for seq in segments:
+        i = seq - base_seq
+        if 0 <= i < size * 8:
+            bitmap[i // 8] |= 0x80 >> (i % 8)
+    return bytes(bitmap)
+
+
+def segments_from_bitmap(base_seq: int, bitmap: bytes):
+    """Returns the segment sequence numbers set in a retransmit [bitmap]"""
+    return [base_seq + i for i in range(len(bitmap) * 8) if bitmap[i // 8] & (0x80 >> (i % 8))]
+
+
+class BulkTransfer:
+    """One file being downlinked in segments.
+    Only the first [size] bytes (the size when the file was offered) are sent, so files that are still being
+    appended to can be transferred."""
+
+    def __init__(self, file_id: int, path: str, size: int, next_seq: int = 0, retransmit=()):
+        self.file_id = file_id
+        self.path = path
+        self.size = size
+        self.segment_count = max(1, -(-size // BULK_SEGMENT_SIZE))
+        self.next_seq = next_seq  # next segment to send for the first time
+        self.retransmit = set(retransmit)  # segments the ground station asked for again
+
+    def pending(self) -> bool:
+        return self.next_seq < self.segment_count or bool(self.retransmit)
+
+    def pop_next_seq(self):
+        """Returns the next segment to send, retransmissions first, or None if every segment has been sent"""
+        if self.retransmit:
+            seq = min(self.retransmit)
+            self.retransmit.discard(seq)
+            return seq
+        if self.next_seq < self.segment_count:
+            self.next_seq += 1
+            return self.next_seq - 1
+        return None
+
+    def read_segment(self, seq: int, f) -> bytes:
+        """Reads segment [seq] from the open file [f]"""
+        offset = seq * BULK_SEGMENT_SIZE
+        f.seek(offset)
+        return f.read(max(0, min(BULK_SEGMENT_SIZE, self.size - offset)))
+
+    def to_dict(self):
+        return {"file_id": self.file_id, "path": self.path, "size": self.size, "next_seq": self.next_seq,
+                "retransmit": sorted(self.retransmit)}
+
+    @staticmethod
+    def from_dict(d: dict):
+        return BulkTransfer(d["file_id"], d["path"], d["size"], d["next_seq"], d["retransmit"])
+
+
+class BulkDownlinkManager:
+    """Keeps the bulk transfers of the satellite and packs their segments for CommsMode.
+    Transfers are sent one at a time in the order they were offered.
+    [downlink_handler]: DownlinkHandler used to pack BulkSegment downlinks
+    [state_file]: where transfer state is kept across reboots"""
+
+    def __init__(self, downlink_handler, state_file: str = BULK_STATE_FILE):
+        self.downlink_handler = downlink_handler
+        self.state_file = state_file
+        self.transfers = dict()  # file id -> BulkTransfer, in the order offered
+        self.next_file_id = 0
+        self._file = None  # open handle of the transfer being streamed
+        self._file_path = None
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.state_file):
+            return
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+            self.next_file_id = state["next_file_id"]
+            for d in state["transfers"]:
+                transfer = BulkTransfer.from_dict(d)
+                self.transfers[transfer.file_id] = transfer
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Could not resume bulk transfers from {self.state_file}: {e}")
+            return
+        if self.transfers:
+            logger.info(f"Resuming bulk transfers {list(self.transfers)}")
+
+    def save(self):
+        """Writes the transfer state, atomically so a reboot mid-write keeps the previous state"""
+        state = {"next_file_id": self.next_file_id, "transfers": [t.to_dict() for t in self.transfers.values()]}
+        os.makedirs(os.path.dirname(self.state_file) or ".", exist_ok=True)
+        tmp = self.state_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_file)
+
+    def offer(self, path: str) -> BulkTransfer:
+        """Queues the file at [path] for downlink and returns its transfer"""
+        size = os.path.getsize(path)
+        while self.next_file_id in self.transfers:
+            self.next_file_id = (self.next_file_id + 1) % 2 ** 16
+        transfer = BulkTransfer(self.next_file_id, path, size)
+        self.transfers[transfer.file_id] = transfer
+        self.next_file_id = (self.next_file_id + 1) % 2 ** 16
+        self.save()
+        logger.info(f"Bulk transfer {transfer.file_id}: {path} ({size} bytes, {transfer.segment_count} segments)")
+        return transfer
+
+    def offer_downlink(self, counter: int, transfer: BulkTransfer) -> bytes:
+        """Packs the acknowledgement telling the ground station the id and size of a new transfer"""
+        return self.downlink_handler.pack_downlink(
+            counter, FMEnum.Normal.value, NormalCommandEnum.BulkDownlinkFile.value,
+            **{FILE_ID: transfer.file_id, SEGMENT_COUNT: transfer.segment_count, FILE_SIZE: transfer.size})
+
+    def pending(self) -> bool:
+        return any(transfer.pending() for transfer in self.transfers.values())
+
+    def next_segment(self, counter: int):
+        """Packs the next segment to downlink, or returns None if no transfer has segments left to send"""
+        for transfer in self.transfers.values():
+            seq = transfer.pop_next_seq()
+            if seq is None:
+                continue
+            try:
+                data = transfer.read_segment(seq, self._open(transfer.path))
+            except OSError as e:
+                logger.error(f"Dropping bulk transfer {transfer.file_id}, cannot read {transfer.path}: {e}")
+                self.complete(transfer.file_id)
+                return self.next_segment(counter)
+            return self.downlink_handler.pack_downlink(
+                counter, FMEnum.Normal.value, NormalCommandEnum.BulkSegment.value,
+                **{FILE_ID: transfer.file_id, SEGMENT_SEQ: seq, SEGMENT_COUNT: transfer.segment_count,
+                   SEGMENT_CRC: crc32(data), SEGMENT_DATA: data})
+        self.close()
+        return None
+
+    def retransmit(self, file_id: int, base_seq: int, bitmap: bytes):
+        """Queues the segments set in [bitmap] to be sent again"""
+        transfer = self.transfers.get(file_id)
+        if transfer is None:
+            logger.warning(f"Retransmit requested for unknown bulk transfer {file_id}")
+            return
+        segments = [seq for seq in segments_from_bitmap(base_seq, bitmap) if seq < transfer.segment_count]
+        transfer.retransmit.update(segments)
+        self.save()
+
+    def complete(self, file_id: int):
+        """Forgets a transfer the ground station has fully received"""
+        transfer = self.transfers.pop(file_id, None)
+        if transfer is not None and transfer.path == self._file_path:
+            self.close()
+        self.save()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self._file_path = None
+
+    def _open(self, path: str):
+        """Keeps the file being streamed open between segments"""
+        if self._file_path != path:
+            self.close()
+            self._file = open(path, "rb")
+            self._file_path = path
+        return self._file
+
+
+class BulkReassembler:
+    """Ground side of a bulk transfer: collects BulkSegment downlinks of one file, checks their CRCs and builds the
+    retransmit bitmap of the segments still missing"""
+
+    def __init__(self, file_id: int):
+        self.file_id = file_id
+        self.segment_count = None
+        self.segments = dict()
+        self.corrupted = 0
+
+    def add(self, kwargs: dict) -> bool:
+        """Adds the unpacked arguments of a BulkSegment downlink. Returns False if the segment was corrupted"""
+        if kwargs[FILE_ID] != self.file_id:
+            raise DownlinkUnpackingException(f"Segment of file {kwargs[FILE_ID]} added to file {self.file_id}")
+        if crc32(kwargs[SEGMENT_DATA]) != kwargs[SEGMENT_CRC]:
+            self.corrupted += 1
+            return False
+        self.segment_count = kwargs[SEGMENT_COUNT]
+        self.segments[kwargs[SEGMENT_SEQ]] = kwargs[SEGMENT_DATA]
+        return True
+
+    def missing(self):
+        if self.segment_count is None:
+            return []
+        return [seq for seq in range(self.segment_count) if seq not in self.segments]
+
+    def retransmit_bitmap(self):
+        """Returns (first missing segment, bitmap) for a BulkRetransmit command, or None if nothing is missing"""
+        missing = self.missing()
+        if not missing:
+            return None
+        return missing[0], bitmap_from_segments(missing[0], missing)
+
+    def complete(self) -> bool:
+        return self.segment_count is not None and not self.missing()
+
+    def data(self) -> bytes:
+        return b"".join(self.segments[seq] for seq in range(self.segment_count))
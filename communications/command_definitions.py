@@ -8,68 +8,54 @@ if TYPE_CHECKING:
 # It lets your IDE know what type(self.parent) is, without causing any circular imports at runtime.
 
 from datetime import datetime
-from utils.constants import FMEnum, NormalCommandEnum, SafetyCommandEnum, CommandCommandEnum, TestCommandEnum
+from utils.constants import FMEnum, NormalCommandEnum, SafetyCommandEnum, CommandCommandEnum, TestCommandEnum, \
+    DownlinkPriority
 from utils.constants import LowBatterySafetyCommandEnum as LBSCEnum
 import os
+import struct
 import time
 from threading import Thread
 from utils.constants import INTERVAL, STATE, DELAY, NAME, VALUE, NUM_BLOCKS, HARD_SET, PARAMETERS_JSON_PATH, a, b, M, \
     team_identifier, START, PULSE_DT, PULSE_NUM, PULSE_DURATION, REG_ADDRESS, REG_VALUE, REG_SIZE, T_START, T_STOP, \
-    DECIMATION_FACTOR
+    DECIMATION_FACTOR, FILE_ID, SEGMENT_SEQ, RETRANSMIT_BITMAP, CISLUNAR_BASE_DIR, RADIO_STATE_TIME, RADIO_FIFO_FILL, \
+    RADIO_RSSI, RADIO_BGND_RSSI, RADIO_RF_FREQ_OFFSET, VERIFICATION_PRN_WORDS, VERIFICATION_HEADER_SIZE, \
+    VERIFICATION_BLOCK_SIZE, VERIFICATION_BLOCK
 from json import load, dump
 from utils.exceptions import CommandArgException
 
 import os
 import utils.parameters as params
 
-def verification(**kwargs):
+# header and PRN data field of a verification block, all big endian uint32
+VERIFICATION_STRUCT = struct.Struct(">%dI" % (VERIFICATION_HEADER_SIZE // 4 + VERIFICATION_PRN_WORDS))
+
+
+def verification_blocks(num_blocks: int, clock=time.time):
     """CQC Comms Verification
     For more info see https://cornell.app.box.com/file/766365097328
-    Assuming a data rate of 50 bits/second, 30 minutes of data transmission gives 78 data blocks"""
-    num_blocks = kwargs.get(NUM_BLOCKS)
-
-    data_block_sequence_num = 0
-    team_bytes = team_identifier.to_bytes(4, 'big')
-    data_transmission_sequence = bytes()
-
-    for x in range(num_blocks):
-        # header calculation:
-        sequence_bytes = data_block_sequence_num.to_bytes(4, 'big')
-        # get current time
-        timestamp = time.time()  # each block has its own timestamp
-        # extract seconds and milliseconds from timestamp:
-        seconds_int = int(timestamp)
-        seconds_bytes = seconds_int.to_bytes(4, 'big')
-        ms_bytes = int((timestamp - seconds_int) * (10 ** 6)).to_bytes(4, 'big')
-
-        # concatenate header
-        header = team_bytes + sequence_bytes + seconds_bytes + ms_bytes
-
-        operating_period_base_seed = team_identifier ^ seconds_int  # team identifier xor with timestamp seconds
-        block_seed = operating_period_base_seed ^ data_block_sequence_num  # xor previous with data block sequence num
-
-        prn_length = 128 // 4  # integer division
-        prn = [int()] * (prn_length + 1)  # preallocate memory for storing prn data
-        prn[0] = block_seed  # x0 is the block seed
-
-        for i in range(1, prn_length + 1):
+    Assuming a data rate of 50 bits/second, 30 minutes of data transmission gives 78 data blocks
+    Yields the data blocks one at a time, each stamped with the time it is generated.
+    Each block is packed into the same preallocated buffer, so generating n blocks takes O(n) time
+    and constant memory"""
+    block = bytearray(VERIFICATION_BLOCK_SIZE)
+    words = [0] * (VERIFICATION_HEADER_SIZE // 4 + VERIFICATION_PRN_WORDS)
+    words[0] = team_identifier
+    for sequence_num in range(num_blocks):
+        timestamp = clock()  # each block has its own timestamp
+        seconds = int(timestamp)
+        words[1] = sequence_num
+        words[2] = seconds
+        words[3] = int((timestamp - seconds) * (10 ** 6))
+
+        # team identifier xor timestamp seconds xor data block sequence number; x0 is not included in the PRN
+        x = team_identifier ^ seconds ^ sequence_num
+        for i in range(4, len(words)):
             # algorithm defined in sec 4.4.2 of CommsProc rev 4
-            xn = (a * prn[i - 1] + b) % M
-            # if the mod operator above causes issues, anding with 32-bit 2**32 should do the trick
-            prn[i] = xn
-
-        prn.pop(0)  # get rid of the first value in the PRN, x0 is not included in PRN
-
-        data_field = bytes()
-        for j in prn:
-            data_field += j.to_bytes(4, 'big')  # concatenate prn data into bytes
-
-        data_block = header + data_field
+            x = (a * x + b) % M
+            words[i] = x
 
-        data_transmission_sequence += data_block  # concatenate data block into transmission sequence
-        data_block_sequence_num += 1
-
-    return data_transmission_sequence.hex()  # TODO instead of returning, add to comms queue
+        VERIFICATION_STRUCT.pack_into(block, 0, *words)
+        yield bytes(block)
 
 
 class CommandDefinitions:
@@ -86,7 +72,7 @@ class CommandDefinitions:
             NormalCommandEnum.CritTelem.value: self.gather_critical_telem,
             NormalCommandEnum.BasicTelem.value: self.gather_basic_telem,
             NormalCommandEnum.DetailedTelem.value: self.gather_detailed_telem,
-            NormalCommandEnum.Verification.value: verification,
+            NormalCommandEnum.Verification.value: self.verification,
             NormalCommandEnum.GetParam.value: self.print_parameter,
             NormalCommandEnum.SetOpnavInterval.value: self.set_opnav_interval,
             NormalCommandEnum.ScheduleManeuver.value: self.schedule_maneuver,
@@ -99,6 +85,10 @@ class CommandDefinitions:
             NormalCommandEnum.NemoReboot.value: self.nemo_reboot,
             NormalCommandEnum.NemoProcessRateData.value: self.nemo_process_rate_data,
             NormalCommandEnum.NemoProcessHistograms.value: self.nemo_process_histograms,
+            NormalCommandEnum.BulkDownlinkFile.value: self.bulk_downlink_file,
+            NormalCommandEnum.BulkRetransmit.value: self.bulk_retransmit,
+            NormalCommandEnum.BulkComplete.value: self.bulk_complete,
+            NormalCommandEnum.RadioMetrics.value: self.downlink_radio_metrics,
         }
 
         self.low_battery_commands = {
@@ -268,7 +258,7 @@ class CommandDefinitions:
 
         acknowledgement = self.parent.downlink_handler.pack_downlink(
             self.parent.downlink_counter, FMEnum.Normal.value, NormalCommandEnum.SetParam.value, successful=True)
-        self.parent.downlink_queue.put(acknowledgement)
+        self.parent.downlink_queue.put(acknowledgement, DownlinkPriority.Ack)
 
         self.parent.logger.info(f"Changed constant {name} from {initial_value} to {value}")
 
@@ -330,6 +320,39 @@ class CommandDefinitions:
         # what's defined in section 3.6.1 of https://cornell.app.box.com/file/629596158344 would be a good packet
         return self.parent.telemetry.standard_packet_dict()
 
+    def verification(self, **kwargs):
+        """Queues CQC verification data blocks for downlink, one Verification downlink per block"""
+        for block in verification_blocks(kwargs[NUM_BLOCKS]):
+            downlink = self.parent.downlink_handler.pack_downlink(
+                self.parent.downlink_counter, FMEnum.Normal.value, NormalCommandEnum.Verification.value,
+                **{VERIFICATION_BLOCK: block})
+            self.parent.downlink_queue.put(downlink)
+
+    def gather_radio_metrics(self):
+        """Returns the AX5043 link metrics (see LinkMetrics.snapshot) as RadioMetrics downlink arguments"""
+        metrics = self.parent.telemetry.rad.metrics
+        if not metrics:
+            return None
+        kwargs = {name: value for name, value in metrics.items() if isinstance(value, int)}
+        state_time = [min(int(t), 2 ** 32 - 1) for t in metrics[RADIO_STATE_TIME].values()]
+        kwargs[RADIO_STATE_TIME] = struct.pack(">%dI" % len(state_time), *state_time)
+        kwargs[RADIO_FIFO_FILL] = struct.pack(">%dI" % len(metrics[RADIO_FIFO_FILL]), *metrics[RADIO_FIFO_FILL])
+        for name in (RADIO_RSSI, RADIO_BGND_RSSI, RADIO_RF_FREQ_OFFSET):
+            samples = metrics[name]
+            kwargs[name] = sum(samples) / len(samples) if samples else 0.0
+        return kwargs
+
+    def downlink_radio_metrics(self, **kwargs):
+        self.parent.telemetry.rad.poll()
+        metrics = self.gather_radio_metrics()
+        if metrics is None:
+            self.parent.logger.error("CMD: downlink_radio_metrics() failed, no radio")
+            return
+        downlink = self.parent.downlink_handler.pack_downlink(
+            self.parent.downlink_counter, FMEnum.Normal.value, NormalCommandEnum.RadioMetrics.value, **metrics)
+        # replaces older metrics still waiting for CommsMode
+        self.parent.downlink_queue.put(downlink, DownlinkPriority.Telemetry, coalesce=True)
+
     def gather_detailed_telem(self):
         # here we'd gather as much data about the satellite as possible
         raise NotImplementedError
@@ -529,3 +552,18 @@ class CommandDefinitions:
             self.parent.nemo_manager.process_histograms(t_start, t_stop, decimation_factor)
         else:
             self.parent.logger.error("CMD: nemo_process_histograms() failed, nemo_manager not initialized")
+
+    def bulk_downlink_file(self, **kwargs):
+        path = os.path.abspath(os.path.join(CISLUNAR_BASE_DIR, kwargs[NAME]))
+        if not path.startswith(CISLUNAR_BASE_DIR + os.sep) or not os.path.isfile(path):
+            self.parent.logger.error(f"CMD: bulk_downlink_file() failed, no such file: {kwargs[NAME]}")
+            return
+        transfer = self.parent.bulk_downlink.offer(path)
+        acknowledgement = self.parent.bulk_downlink.offer_downlink(self.parent.downlink_counter, transfer)
+        self.parent.downlink_queue.put(acknowledgement, DownlinkPriority.Ack)
+
+    def bulk_retransmit(self, **kwargs):
+        self.parent.bulk_downlink.retransmit(kwargs[FILE_ID], kwargs[SEGMENT_SEQ], kwargs[RETRANSMIT_BITMAP])
+
+    def bulk_complete(self, **kwargs):
+        self.parent.bulk_downlink.complete(kwargs[FILE_ID])
@@ -1,27 +1,48 @@
 """command_queue_writer.py: a temporary workaround to not having functioning radio drivers. Instead of sending
-commands to the EDU/HITL through the radio board, use this to write commands to a txt file, which is then read by
-main.py's read_command_queue_from_file method """
+commands to the EDU/HITL through the radio board, use this to write commands to command_queue.txt, a named pipe
+read by CommandFileTransport as soon as they are written (or a plain file read when the flight software starts) """
+
+import errno
+import os
 
 from communications.commands import CommandHandler
 from utils.log import get_log
 
 logger = get_log()
 
-ch = CommandHandler()
-
-fm_num = int(0)
-filename = "command_queue.txt"
-command_counter = 1
-
-while fm_num > -1:
-    fm_num = int(input("What flight mode would you like to command in?\n"))
-    if fm_num > -1:
-        command_num = int(input("What command ID would you like to send?\n"))
-        if command_num > -1:
-            kwarg_str = input("Please input any arguments as a valid python dictionary:\n")
-            kwarg_dict = eval(kwarg_str)
-            packed = ch.pack_command(command_counter, fm_num, command_num, **kwarg_dict)
-            file = open(filename, "a")
-            file.write(str(packed.hex()) + "\n")
-            file.close()
-            logger.info(f"Wrote hex bytes {str(packed.hex())}")
+
+def write_command(filename, packed):
+    """Append one hex encoded command to [filename]. Without the flight software reading the pipe there,
+    the command goes to a plain file instead of blocking until it starts"""
+    line = (packed.hex() + "\n").encode()
+    try:
+        fd = os.open(filename, os.O_WRONLY | os.O_NONBLOCK | os.O_APPEND | os.O_CREAT)
+    except OSError as e:
+        if e.errno != errno.ENXIO:
+            raise
+        # a pipe with no reader, left behind by a flight software that did not close it
+        os.unlink(filename)
+        fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+if __name__ == "__main__":
+    ch = CommandHandler()
+
+    fm_num = int(0)
+    filename = "command_queue.txt"
+    command_counter = 1
+
+    while fm_num > -1:
+        fm_num = int(input("What flight mode would you like to command in?\n"))
+        if fm_num > -1:
+            command_num = int(input("What command ID would you like to send?\n"))
+            if command_num > -1:
+                kwarg_str = input("Please input any arguments as a valid python dictionary:\n")
+                kwarg_dict = eval(kwarg_str)
+                packed = ch.pack_command(command_counter, fm_num, command_num, **kwarg_dict)
+                write_command(filename, packed)
+                logger.info(f"Wrote hex bytes {str(packed.hex())}")
@@ -23,6 +23,8 @@ from utils.exceptions import (
 from utils.struct import (
     pack_unsigned_short,
     unpack_unsigned_short,
+    unpack_frame_header,
+    FrameCodec,
     pack_unsigned_int,
     packer_dict
 )
@@ -55,9 +57,71 @@ def unpack_command_bytes(data: bytes):
     return mac, counter, mode, command_id, data[DATA_OFFSET:]
 
 
+class CommandFrame:
+    """A received command, parsed in place: wraps a memoryview of the received buffer instead of copying it.
+    The header is unpacked the first time one of its fields is read and the arguments are decoded by the
+    command's codec the first time kwargs is read; both are cached, so a frame is decoded at most once"""
+    __slots__ = ("data", "codec", "_header", "_kwargs")
+
+    def __init__(self, data, codec=None):
+        self.data = memoryview(data)
+        self.codec = codec
+        self._header = None
+        self._kwargs = None
+
+    @property
+    def header(self):
+        """(mac, counter, mode, command id, data length)"""
+        if self._header is None:
+            self._header = unpack_frame_header(self.data)
+        return self._header
+
+    @property
+    def mac(self):
+        return self.header[0]
+
+    @property
+    def counter(self):
+        return self.header[1]
+
+    @property
+    def mode(self):
+        return self.header[2]
+
+    @property
+    def command_id(self):
+        return self.header[3]
+
+    @property
+    def kwargs(self):
+        if self._kwargs is None:
+            self._kwargs = self.codec.unpack(self.data)
+        return self._kwargs
+
+    def decode(self):
+        """Decodes the header and arguments now (instead of on first use), raising if the frame is malformed.
+        Returns the frame"""
+        self.unpacked()
+        return self
+
+    def unpacked(self):
+        """Returns the same tuple as CommandHandler.unpack_command"""
+        return self.mac, self.counter, self.mode, self.command_id, self.kwargs
+
+    def __bytes__(self):
+        return bytes(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return f"<CommandFrame(Mode={self.mode}, CommandID={self.command_id}, counter={self.counter})>"
+
+
 class CommandHandler:
     def __init__(self):
         self.command_dict = dict()
+        self.codecs = dict()  # mode -> command id -> FrameCodec
         self.packers = dict()
         self.unpackers = dict()
         # Packers and unpackers will always have identical set of keys
@@ -85,49 +149,44 @@ class CommandHandler:
         self.unpackers[arg] = unpacker
 
     def pack_command(self, counter: int, mode: int, command_id: int, **kwargs) -> bytes:
-        func_args, buffer_size = self.command_dict[mode][command_id]
-        data_buffer = bytearray(buffer_size)
-        offset = 0
         try:
-            for arg in func_args:
-                off = self.packers[arg](data_buffer, offset, kwargs[arg])
-                offset += off
-            return pack_command_bytes(counter, mode, command_id, data_buffer)
+            codec = self.codecs[mode][command_id]
+        except KeyError as exc:
+            raise CommandPackingException(
+                f"KeyError occurred, no such command: {command_id} for mode: {mode} "
+                f"KeyError was: {str(exc)}"
+            )
+        try:
+            return codec.pack(counter, kwargs)
         except StructError as exc:
             raise CommandPackingException(str(exc))
         except KeyError as exc:
-            if arg is not None:
-                raise CommandPackingException(
-                    f"KeyError occured for arg: {arg}, using Mode: {mode}; CommandID: {command_id} "
-                    f"KeyError was: {str(exc)}"
-                )
-            else:
-                raise CommandPackingException(
-                    f"KeyError occurred, no such command: {command_id} for mode: {mode} "
-                    f"KeyError was: {str(exc)}"
-                )
+            raise CommandPackingException(
+                f"KeyError occured for arg: {str(exc)}, using Mode: {mode}; CommandID: {command_id}"
+            )
 
-    def unpack_command(self, data: bytes):
-        
+    def parse_command(self, data) -> CommandFrame:
+        """Checks that [data] is a complete frame of a known command and wraps it in a CommandFrame
+        without copying or decoding the arguments. A CommandFrame is returned as is"""
+        if isinstance(data, CommandFrame):
+            return data
+        frame = CommandFrame(data)
         try:
-            mac, counter, mode, command_id, arg_data = unpack_command_bytes(data)
-            func_args, buffer_size = self.command_dict[mode][command_id]
+            mac, counter, mode, command_id, data_len = frame.header
+            frame.codec = self.codecs[mode][command_id]
         except:
             raise CommandUnpackingException(
                 'Unknown command received.'
             )
-        if (buffer_size + DATA_OFFSET) != len(data):
+        if frame.codec.frame_size != len(frame) or data_len != frame.codec.size:
             raise CommandUnpackingException(
-                f"Received command with data len: {len(data)}, but expected length: {buffer_size}; "
+                f"Received command with data len: {len(frame)}, but expected length: {frame.codec.size}; "
                 f"for command with Mode: {mode}, CommandID: {command_id}"
             )
-        offset = 0
-        kwargs = dict()
-        for arg in func_args:
-            off, value = self.unpackers[arg](arg_data, offset)
-            kwargs[arg] = value
-            offset += off
-        return mac, counter, mode, command_id, kwargs
+        return frame
+
+    def unpack_command(self, data: bytes):
+        return self.parse_command(data).unpacked()
     
     def register_commands(self):
         for mode_id, mode_name in FLIGHT_MODE_DICT.items():
@@ -138,6 +197,18 @@ class CommandHandler:
                 
                 command_dict[command_id] = command_data_tuple
                 self.command_dict[mode_id] = command_dict 
+                self.register_frame_codec(mode_id, command_id)
+
+    def register_frame_codec(self, mode_id: int, command_id: int):
+        """Compiles the serializer for one command, once its arguments have registered codecs"""
+        command_args, buffer_size = self.command_dict[mode_id][command_id]
+        try:
+            codec = FrameCodec(mode_id, command_id, command_args, buffer_size, self.packers, self.unpackers)
+        except (KeyError, ValueError) as exc:
+            raise SerializationException(
+                f"Cannot compile command Mode: {mode_id}, CommandID: {command_id}: {str(exc)}"
+            )
+        self.codecs.setdefault(mode_id, dict())[command_id] = codec
 
     #Used only for testing
     def register_new_command(self, mode_id:int, command_id:int, **kwargs):
@@ -168,6 +239,7 @@ class CommandHandler:
             command_args = list(kwargs.keys())
             command_data_tuple = (command_args, totalBytes)
             self.command_dict[mode_id][command_id] = (command_args, totalBytes)
+            self.register_frame_codec(mode_id, command_id)
 
         except:
             raise SerializationException()
\ No newline at end of file
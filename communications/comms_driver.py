@@ -1,7 +1,14 @@
-from queue import Queue
+from queue import Queue, Full
 from threading import Thread
+from concurrent.futures import Future
 from socketserver import UDPServer, BaseRequestHandler
+from collections import deque
+import asyncio
+import random
 import socket
+from utils.log import get_log
+
+logger = get_log()
 
 
 HOSTNAME = "127.0.0.1"
@@ -21,11 +28,9 @@ class Comms:
         self.listening_thread = Thread(target=self.read_telemetry_forever)
         self.listening_thread.start()
 
-    # Override this method to assure safety for specific implementation
+    # Override this method to stop read_telemetry_forever and release the link
     def stop(self):
-        print("Halting comms thread...")
-        if self.listening_thread.is_alive() is True:
-            self.listening_thread.terminate()
+        raise NotImplementedError
 
     def send_packet(self, packet: bytes):
         raise NotImplementedError
@@ -84,6 +89,226 @@ class IPComms(Comms):
             sock.close()
 
 
+class LinkSimulator:
+    """Simulated radio link applied to the packets one end of AsyncIPComms sends
+    [latency]: one way delay of every packet in seconds
+    [loss]: probability that a packet is lost
+    [bitrate]: bits per second, packets wait for the ones before them to be sent; None for no limit
+    [seed]: seed of the loss random generator, for reproducible runs"""
+
+    def __init__(self, latency=0.0, loss=0.0, bitrate=None, seed=None):
+        self.latency = latency
+        self.loss = loss
+        self.bitrate = bitrate
+        self.random = random.Random(seed)
+        self.busy_until = 0.0
+
+    def delay(self, size, now):
+        """Returns how long after [now] a packet of [size] bytes arrives, or None if it is lost"""
+        arrival = now
+        if self.bitrate is not None:
+            arrival = max(now, self.busy_until) + size * 8 / self.bitrate
+            self.busy_until = arrival
+        if self.loss and self.random.random() < self.loss:
+            return None
+        return arrival - now + self.latency
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, comms):
+        self.comms = comms
+
+    def datagram_received(self, data, addr):
+        self.comms.datagram_received(data)
+
+    def error_received(self, exc):
+        logger.error(f"UDP comms error: {exc}")
+
+    def pause_writing(self):
+        self.comms.writing_paused = True
+
+    def resume_writing(self):
+        self.comms.writing_paused = False
+        self.comms.loop.call_soon(self.comms.flush)
+
+
+class AsyncIPComms(Comms):
+    """UDP stand-in for the radio, running an asyncio event loop in the listening thread.
+    One socket is bound for the lifetime of the object and used for both directions.
+    Packets are sent from the event loop, so send_packet and transmit never block the caller, and packets queued
+    together are sent in one pass of the loop.
+    Received packets go into [queue]. When it is full they wait in a backlog of [max_backlog] packets
+    and the socket is not read (the OS drops what does not fit in its buffer, like the radio would)
+    [receiver]: if set, received packets are passed to receiver(packet) in the event loop thread instead of [queue]
+    (how the flight software's IP transport receives commands)
+    [link]: LinkSimulator for the packets sent from this end, or None for a perfect link
+    [receive_buffer]: requested socket receive buffer in bytes (the OS may cap it, e.g. net.core.rmem_max)"""
+
+    BACKPRESSURE_RETRY = 0.01  # s between attempts to put into a full queue
+    SEND_BATCH = 64  # packets sent per pass of the event loop, so receiving is not starved
+
+    def __init__(
+        self,
+        *,
+        queue: Queue = None,
+        receiver=None,
+        server_host: str = HOSTNAME,
+        server_port: int = PORT,
+        client_host: str = HOSTNAME,
+        client_port: int = PORT,
+        link: LinkSimulator = None,
+        max_backlog: int = 1024,
+        receive_buffer: int = 2 ** 22,
+    ):
+        super().__init__(queue=queue)
+        self.receiver = receiver
+        self.server_address = (server_host, server_port)
+        self.client_address = (client_host, client_port)
+        self.link = link
+        self.max_backlog = max_backlog
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+        self.sock.bind(self.server_address)
+        self.loop = asyncio.new_event_loop()
+        self.stopped = self.loop.create_future()
+        self.transport = None
+        self.outgoing = deque()  # (packet, Future or None) appended from any thread, sent from the event loop
+        self.flush_scheduled = False
+        self.writing_paused = False
+        self.backlog = deque()  # received packets waiting for space in the queue
+        self.reading_paused = False
+        self.retry_scheduled = False
+        self.sent = 0
+        self.received = 0
+        self.lost = 0
+        self.dropped = 0
+
+    def read_telemetry_forever(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.loop.close()
+
+    async def serve(self):
+        self.transport, _ = await self.loop.create_datagram_endpoint(lambda: _DatagramProtocol(self), sock=self.sock)
+        # send what was queued before the socket was ready
+        self.flush()
+        try:
+            await self.stopped
+        finally:
+            self.transport.close()
+            self.transport = None
+            while self.outgoing:
+                _, future = self.outgoing.popleft()
+                if future is not None:
+                    future.set_exception(RuntimeError("IP comms stopped"))
+            # let the transport close the socket
+            await asyncio.sleep(0)
+
+    def stop(self):
+        if getattr(self, "listening_thread", None) is None:
+            self.sock.close()
+            self.loop.close()
+            return
+        self.loop.call_soon_threadsafe(self._set_stopped)
+        self.listening_thread.join()
+
+    def _set_stopped(self):
+        if not self.stopped.done():
+            self.stopped.set_result(None)
+
+    def send_packet(self, packet: bytes):
+        """Queues [packet] for the event loop and returns right away. Safe to call from any thread"""
+        self._queue_packet(packet, None)
+
+    def transmit(self, packet: bytes) -> Future:
+        """Downlink sink with the interface of Radio.transmit: queues [packet] and returns a
+        concurrent.futures.Future set to its length once it has been handed to the socket (or lost on the
+        simulated link, which the sender cannot tell apart)"""
+        future = Future()
+        if self.loop.is_closed():
+            future.set_exception(RuntimeError("IP comms stopped"))
+            return future
+        self._queue_packet(packet, future)
+        return future
+
+    def _queue_packet(self, packet, future):
+        self.outgoing.append((bytes(packet), future))
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon_threadsafe(self.flush)
+
+    def flush(self):
+        """Sends every queued packet (runs in the event loop)"""
+        self.flush_scheduled = False
+        if self.transport is None:
+            return
+        for _ in range(self.SEND_BATCH):
+            if not self.outgoing or self.writing_paused:
+                return
+            packet, future = self.outgoing.popleft()
+            self.sent += 1
+            if self.link is None:
+                self._sendto(packet, future)
+                continue
+            delay = self.link.delay(len(packet), self.loop.time())
+            if delay is None:
+                self.lost += 1
+                if future is not None:
+                    future.set_result(len(packet))
+            elif delay > 0:
+                self.loop.call_later(delay, self._sendto, packet, future)
+            else:
+                self._sendto(packet, future)
+        if self.outgoing and not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self.flush)
+
+    def _sendto(self, packet, future):
+        if self.transport is None:  # stopped while the packet was delayed by the link
+            if future is not None:
+                future.set_exception(RuntimeError("IP comms stopped"))
+            return
+        self.transport.sendto(packet, self.client_address)
+        if future is not None:
+            future.set_result(len(packet))
+
+    def datagram_received(self, data: bytes):
+        self.received += 1
+        if self.receiver is not None:
+            self.receiver(data)
+            return
+        if len(self.backlog) >= self.max_backlog:
+            self.dropped += 1
+            return
+        self.backlog.append(data)
+        self.deliver()
+
+    def deliver(self):
+        """Moves the backlog into the queue, pausing the socket while the queue is full"""
+        self.retry_scheduled = False
+        while self.backlog:
+            try:
+                self.queue.put_nowait(self.backlog[0])
+            except Full:
+                if not self.reading_paused:
+                    self.reading_paused = True
+                    self.transport.pause_reading()
+                if not self.retry_scheduled:
+                    self.retry_scheduled = True
+                    self.loop.call_later(self.BACKPRESSURE_RETRY, self.deliver)
+                return
+            self.backlog.popleft()
+        if self.reading_paused:
+            self.reading_paused = False
+            self.transport.resume_reading()
+
+    def stats(self):
+        return {"sent": self.sent, "received": self.received, "lost": self.lost, "dropped": self.dropped,
+                "backlog": len(self.backlog), "queued": len(self.outgoing)}
+
+
 class AX5043Comms(Comms):
     def __init__(self, *, queue: Queue):
         super().__init__(queue=queue)
@@ -100,14 +325,14 @@ class AX5043Comms(Comms):
 # to handle command parsing
 class CommunicationsSystem:
     def __init__(
-        self, *, queue: Queue, use_ax5043=True, host=None, port=None,
+        self, *, queue: Queue, use_ax5043=True, host=None, port=None, link=None,
     ):
         if use_ax5043 is True:
             self.comms = AX5043Comms(queue=queue)
         else:
             host = host if host is not None else HOSTNAME
             port = port if port is not None else PORT
-            self.comms = IPComms(queue=queue, server_host=host, server_port=port)
+            self.comms = AsyncIPComms(queue=queue, server_host=host, server_port=port, link=link)
 
     def listen(self):
         self.comms.listen()
@@ -1,4 +1,8 @@
+from collections import deque
+from queue import Empty
 from struct import error as StructError
+from threading import Lock
+from time import monotonic
 from sys import maxsize, float_info
 import utils.struct as us
 
@@ -13,7 +17,8 @@ from utils.constants import (
     MAC_LENGTH,
     MAC,
     COUNTER_OFFSET,
-    COUNTER_SIZE
+    COUNTER_SIZE,
+    DownlinkPriority
 )
 from utils.exceptions import (
     SerializationException,
@@ -23,6 +28,8 @@ from utils.exceptions import (
 from utils.struct import (
     pack_unsigned_short,
     unpack_unsigned_short,
+    unpack_frame_header,
+    FrameCodec,
     packer_dict
 )
 
@@ -55,10 +62,76 @@ def unpack_downlink_bytes(data: bytes):
         )
     return mac, counter, mode, downlink_id, data[DATA_OFFSET:]
 
+
+class DownlinkQueue:
+    """Priority queue of packed downlinks, drop-in for the Queue methods used on downlink_queue.
+    Downlinks are transmitted by priority class (DownlinkPriority, lowest first) and in order of arrival within a class.
+    Downlinks put with [coalesce] replace any queued downlink with the same (mode, downlink id),
+    so e.g. only the newest BasicTelem packet is waiting when CommsMode gets to transmit.
+    [scheduler], [activity_name]: if given, the activity is released whenever a downlink is queued"""
+
+    def __init__(self, scheduler=None, activity_name: str = None, clock=monotonic):
+        self.scheduler = scheduler
+        self.activity_name = activity_name
+        self.clock = clock
+        self._lock = Lock()
+        self._queues = {priority: deque() for priority in DownlinkPriority}
+        self._coalesced = dict()  # (mode, downlink id) -> queued entry
+        self.put_count = {priority: 0 for priority in DownlinkPriority}
+        self.replaced_count = {priority: 0 for priority in DownlinkPriority}
+
+    def put(self, downlink: bytes, priority=DownlinkPriority.Normal, coalesce: bool = False):
+        """Queues [downlink] in [priority] class. Returns True if it replaced an older downlink of the same kind"""
+        priority = DownlinkPriority(priority)
+        key = (downlink[MODE_OFFSET], downlink[ID_OFFSET])
+        entry = [downlink, self.clock(), priority, key if coalesce else None]
+        replaced = False
+        with self._lock:
+            if coalesce:
+                old = self._coalesced.pop(key, None)
+                if old is not None:
+                    self._queues[old[2]].remove(old)
+                    self.replaced_count[old[2]] += 1
+                    replaced = True
+                self._coalesced[key] = entry
+            self._queues[priority].append(entry)
+            self.put_count[priority] += 1
+        if self.scheduler is not None:
+            self.scheduler.release(self.activity_name)
+        return replaced
+
+    def get(self) -> bytes:
+        """Removes and returns the next downlink to transmit. Raises queue.Empty if the queue is empty"""
+        with self._lock:
+            for queue in self._queues.values():
+                if queue:
+                    entry = queue.popleft()
+                    if entry[3] is not None:
+                        del self._coalesced[entry[3]]
+                    return entry[0]
+        raise Empty
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def qsize(self) -> int:
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self) -> dict:
+        """Returns {priority class name: (depth, age of the oldest queued downlink in seconds, downlinks queued,
+        downlinks replaced by newer ones)} for telemetry"""
+        now = self.clock()
+        with self._lock:
+            return {priority.name: (len(queue), now - queue[0][1] if queue else 0.0,
+                                    self.put_count[priority], self.replaced_count[priority])
+                    for priority, queue in self._queues.items()}
+
  
 class DownlinkHandler:
     def __init__(self):
         self.downlink_dict = dict()
+        self.codecs = dict()  # mode -> downlink id -> FrameCodec
         self.packers = dict()
         self.unpackers = dict()
         # Packers and unpackers will always have identical set of keys
@@ -86,50 +159,38 @@ class DownlinkHandler:
         self.packers[arg] = packer
         self.unpackers[arg] = unpacker
 
-    def pack_downlink(self, counter:int, mode: int, downlink_id: int, **kwargs) -> bytes:
-        func_args, buffer_size = self.downlink_dict[mode][downlink_id]
-        data_buffer = bytearray(buffer_size)
-        offset = 0
+    def pack_downlink(self, counter: int, mode: int, downlink_id: int, **kwargs) -> bytes:
+        try:
+            codec = self.codecs[mode][downlink_id]
+        except KeyError as exc:
+            raise DownlinkPackingException(
+                f"KeyError occurred, no such downlink: {downlink_id} for mode: {mode} "
+                f"KeyError was: {str(exc)}"
+            )
         try:
-            for arg in func_args:
-                off = self.packers[arg](data_buffer, offset, kwargs[arg])
-                offset += off
-            return pack_downlink_bytes(counter, mode, downlink_id, data_buffer)
+            return codec.pack(counter, kwargs)
         except StructError as exc:
             raise DownlinkPackingException(str(exc))
         except KeyError as exc:
-            if arg is not None:
-                raise DownlinkPackingException(
-                    f"KeyError occured for arg: {arg}, using Mode: {mode}; DownlinkID: {downlink_id} "
-                    f"KeyError was: {str(exc)}"
-                )
-            else:
-                raise DownlinkPackingException(
-                    f"KeyError occurred, no such downlink: {downlink_id} for mode: {mode} "
-                    f"KeyError was: {str(exc)}"
-                )
+            raise DownlinkPackingException(
+                f"KeyError occured for arg: {str(exc)}, using Mode: {mode}; DownlinkID: {downlink_id}"
+            )
 
     def unpack_downlink(self, data: bytes):
         
         try:
-            mac, counter, mode, downlink_id, arg_data = unpack_downlink_bytes(data)
-            func_args, buffer_size = self.downlink_dict[mode][downlink_id]
+            mac, counter, mode, downlink_id, data_len = unpack_frame_header(data)
+            codec = self.codecs[mode][downlink_id]
         except:
             raise DownlinkUnpackingException(
-                f'Unknown downlink received. Mode: {mode}, Downlink ID: {downlink_id}'
+                f'Unknown downlink received. Data: {bytes(data[:DATA_OFFSET]).hex()}'
             )
-        if (buffer_size + DATA_OFFSET) != len(data):
+        if codec.frame_size != len(data) or data_len != codec.size:
             raise DownlinkUnpackingException(
-                f"Received downlink with data len: {len(data)}, but expected length: {buffer_size}; "
+                f"Received downlink with data len: {len(data)}, but expected length: {codec.size}; "
                 f"for command with Mode: {mode}, DownlinkID: {downlink_id}"
             )
-        offset = 0
-        kwargs = dict()
-        for arg in func_args:
-            off, value = self.unpackers[arg](arg_data, offset)
-            kwargs[arg] = value
-            offset += off
-        return mac, counter, mode, downlink_id, kwargs
+        return mac, counter, mode, downlink_id, codec.unpack(data)
     
     def register_downlinks(self):
         for mode_id, mode_name in FLIGHT_MODE_DICT.items():
@@ -140,6 +201,18 @@ class DownlinkHandler:
                 
                 downlink_dict[downlink_id] = downlink_data_tuple
                 self.downlink_dict[mode_id] = downlink_dict 
+                self.register_frame_codec(mode_id, downlink_id)
+
+    def register_frame_codec(self, mode_id: int, downlink_id: int):
+        """Compiles the serializer for one downlink, once its arguments have registered codecs"""
+        downlink_args, buffer_size = self.downlink_dict[mode_id][downlink_id]
+        try:
+            codec = FrameCodec(mode_id, downlink_id, downlink_args, buffer_size, self.packers, self.unpackers)
+        except (KeyError, ValueError) as exc:
+            raise SerializationException(
+                f"Cannot compile downlink Mode: {mode_id}, DownlinkID: {downlink_id}: {str(exc)}"
+            )
+        self.codecs.setdefault(mode_id, dict())[downlink_id] = codec
 
     #Used only for testing
     def register_new_downlink(self, mode_id:int, downlink_id:int, **kwargs):
@@ -167,6 +240,7 @@ class DownlinkHandler:
             downlink_args = list(kwargs.keys())
             downlink_data_tuple = (downlink_args, totalBytes)
             self.downlink_dict[mode_id][downlink_id] = downlink_data_tuple
+            self.register_frame_codec(mode_id, downlink_id)
 
         except:
             raise SerializationException()
\ No newline at end of file
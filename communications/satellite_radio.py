@@ -6,7 +6,6 @@ from sys import maxsize, float_info
 
 #Transimission Imports
 import logging
-import time
 import board
 import busio
 from adafruit_bus_device.spi_device import SPIDevice
@@ -21,8 +20,9 @@ class Radio():
 
         self.driver = Ax5043(SPIDevice(busio.SPI(board.SCK, MOSI=board.MOSI, MISO=board.MISO)))
         self.mgr = Manager(self.driver)
+        # The manager dispatches from its own thread, so transmissions do not block the flight software
+        self.mgr.start()
         self.last_transmit_time = datetime.today()
-        self.last_telemetry_time = datetime.today()
 
     # Monitor radio health, request reset if faulted
     def monitorHealth(self):
@@ -35,7 +35,8 @@ class Radio():
     def receiveSignal(self):
 
         self.mgr.rx_enabled = True
-        self.mgr.dispatch()
+        if not self.mgr.running:
+            self.mgr.dispatch()
         self.monitorHealth()
         
         if self.mgr.outbox.empty():
@@ -44,27 +45,29 @@ class Radio():
             return self.mgr.outbox.get()
 
     #Downlink given bytearray to ground station
+    #Returns right away with a concurrent.futures.Future that completes once the signal has been sent
     def transmit(self, signal:bytearray):
 
         self.mgr.tx_enabled = True
-        self.mgr.inbox.put(signal)
+        future = self.mgr.transmit(signal)
+        self.monitorHealth()
 
-        cycles = 0
+        self.last_transmit_time = datetime.today()
+        return future
 
-        while True:
-           
-            self.mgr.dispatch()
-            self.monitorHealth()
+    #Stops the transmission in progress and fails the futures of every queued one
+    #Returns the number of queued transmissions dropped
+    def abort_transmissions(self, err='Transmission aborted'):
 
-            cycles += 1
-            # After 5s, break for clean shutdown
-            # (TODO: use interrupt handler to ensure clean shutdown when killed,
-            # or monitor transmitting state and exit when complete)
-            if cycles >= 5: break
-            time.sleep(1)
+        self.mgr.tx_enabled = False
+        return self.mgr.abort_pending(err)
 
+    def close(self):
+        self.mgr.stop()
         self.mgr.tx_enabled = False
         self.mgr.rx_enabled = False
+        # Fails a transmission in progress, then anything still queued
         self.mgr.dispatch()
-        
-        self.last_transmit_time = datetime.today()
\ No newline at end of file
+        aborted = self.mgr.abort_pending('Radio closed')
+        if aborted:
+            logging.warning(f'Dropped {aborted} queued transmissions when closing the radio')
@@ -0,0 +1,285 @@
+"""transport.py: every route a command can take into the flight software, behind one interface.
+
+A Transport either has a file descriptor (fileno()) that the TransportMultiplexer waits on with select, and
+read() is called when it becomes readable, or it pushes frames itself through the deliver callback it is opened
+with (for sources that already have their own thread, like the AX5043 manager).
+The multiplexer waits on all transports at once in its own thread and hands every frame to the command pipeline
+as soon as it arrives, so the main loop never polls for input.
+
+To add a transport, write a Transport subclass and a factory for it in TRANSPORT_FACTORIES."""
+import errno
+import os
+import selectors
+import socket
+import stat
+from collections import deque
+from threading import Thread
+
+from utils.log import get_log
+
+logger = get_log()
+
+
+class Transport:
+    """Source of raw command frames.
+    [trusted]: frames from this transport skip the MAC and counter checks (local injection only)"""
+
+    name = "transport"
+    trusted = False
+
+    def open(self, deliver):
+        """Starts the transport. [deliver](frame) hands a frame to the multiplexer from any thread"""
+        self.deliver = deliver
+
+    def fileno(self):
+        """File descriptor to wait on, or None if the transport calls deliver itself"""
+        return None
+
+    def read(self):
+        """Returns the frames available now. Only called when fileno() is readable"""
+        return []
+
+    def close(self):
+        pass
+
+
+class TransportMultiplexer:
+    """Waits on every transport at once and calls [handler](frame, transport) for each frame, in its own thread.
+    Frames delivered by transports without a file descriptor wake the selector through a socket pair."""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.transports = []
+        self.selector = selectors.DefaultSelector()
+        self._wakeup_read, self._wakeup_write = socket.socketpair()
+        self._wakeup_read.setblocking(False)
+        self._wakeup_write.setblocking(False)
+        self.selector.register(self._wakeup_read, selectors.EVENT_READ, None)
+        self._pending = deque()  # (frame, transport) pushed by transports
+        self.thread = None
+        self.running = False
+        self.frames = 0
+
+    def add(self, transport: Transport):
+        transport.open(lambda frame: self._push(frame, transport))
+        fd = transport.fileno()
+        if fd is not None:
+            self.selector.register(fd, selectors.EVENT_READ, transport)
+        self.transports.append(transport)
+        logger.info(f"Listening for commands on {transport.name}")
+
+    def _push(self, frame, transport):
+        self._pending.append((frame, transport))
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            self._wakeup_write.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            pass  # a wakeup is already pending
+
+    def run_once(self, timeout=None):
+        """Waits up to [timeout] seconds (forever if None) for frames and handles them. Returns how many"""
+        handled = 0
+        for key, _ in self.selector.select(timeout):
+            transport = key.data
+            if transport is None:
+                try:
+                    while self._wakeup_read.recv(4096):
+                        pass
+                except (BlockingIOError, InterruptedError):
+                    pass
+                continue
+            try:
+                frames = transport.read()
+            except Exception as e:
+                logger.error(f"Reading from {transport.name} failed: {e}")
+                continue
+            for frame in frames:
+                handled += self._handle(frame, transport)
+        while self._pending:
+            frame, transport = self._pending.popleft()
+            handled += self._handle(frame, transport)
+        return handled
+
+    def _handle(self, frame, transport):
+        self.frames += 1
+        try:
+            self.handler(frame, transport)
+        except Exception as e:
+            logger.error(f"Handling frame from {transport.name} failed: {e}")
+        return 1
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.running = True
+        self.thread = Thread(target=self._run, name="transports", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while self.running:
+            self.run_once()
+
+    def stop(self):
+        self.running = False
+        self.wakeup()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for transport in self.transports:
+            transport.close()
+        self.selector.close()
+        self._wakeup_read.close()
+        self._wakeup_write.close()
+
+
+class RadioTransport(Transport):
+    """Packets received by the AX5043. The manager's service thread fills its outbox; a thread blocked on the
+    outbox delivers them, so nothing polls the radio"""
+
+    name = "radio"
+
+    def __init__(self, radio):
+        self.radio = radio
+        self.thread = None
+
+    def open(self, deliver):
+        super().open(deliver)
+        self.radio.mgr.rx_enabled = True
+        self.thread = Thread(target=self._run, name="radio-rx", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            packet = self.radio.mgr.outbox.get()
+            if packet is None:
+                return
+            self.deliver(bytes(packet))
+
+    def close(self):
+        if self.thread is not None:
+            self.radio.mgr.outbox.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+class CommandFileTransport(Transport):
+    """Hex encoded commands, one per line, written to a named pipe at [path] (see command_queue_writer.py).
+    A temporary workaround to not having radio board access. The pipe is only read when select says it has
+    data, and a write end is kept open so writers closing it does not make it readable forever.
+    Commands left in a regular file at [path] (written while the flight software was not running) are read once
+    and the file replaced by the pipe. The pipe is removed on close so writers fall back to the file."""
+
+    name = "command file"
+    trusted = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fd = None
+        self.keepalive_fd = None
+        self.buffer = bytearray()
+
+    def open(self, deliver):
+        super().open(deliver)
+        if os.path.exists(self.path) and not stat.S_ISFIFO(os.stat(self.path).st_mode):
+            with open(self.path) as f:
+                for hex_line in f:
+                    if hex_line.strip():
+                        deliver(bytes.fromhex(hex_line))
+            os.remove(self.path)
+        if not os.path.exists(self.path):
+            os.mkfifo(self.path)
+        self.fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        self.keepalive_fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        try:
+            self.buffer += os.read(self.fd, 4096)
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        *lines, rest = self.buffer.split(b"\n")
+        self.buffer = bytearray(rest)
+        frames = []
+        for line in lines:
+            try:
+                if line.strip():
+                    frames.append(bytes.fromhex(line.decode()))
+            except ValueError:
+                logger.error(f"Ignoring malformed line in {self.path}: {bytes(line)}")
+        return frames
+
+    def close(self):
+        if self.fd is not None:
+            # before closing, so a writer that finds no reader cannot have replaced it with a file yet
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+        for fd in (self.fd, self.keepalive_fd):
+            if fd is not None:
+                os.close(fd)
+        self.fd = self.keepalive_fd = None
+
+
+class IPTransport(Transport):
+    """Command frames in UDP datagrams received by AsyncIPComms, the radio stand-in for load testing with a ground
+    station simulator. AsyncIPComms delivers them from its event loop thread"""
+
+    name = "ip"
+
+    def __init__(self, comms):
+        self.comms = comms
+
+    def open(self, deliver):
+        super().open(deliver)
+        self.comms.receiver = deliver
+        self.comms.listen()
+
+    def close(self):
+        self.comms.stop()
+
+
+class LoopbackTransport(Transport):
+    """Frames injected in process with send(), e.g. by HITL tests"""
+
+    name = "loopback"
+
+    def __init__(self, trusted: bool = False):
+        self.trusted = trusted
+
+    def send(self, frame: bytes):
+        self.deliver(bytes(frame))
+
+
+def radio_transport(parent):
+    return RadioTransport(parent.radio) if parent.radio is not None else None
+
+
+def command_file_transport(parent):
+    return CommandFileTransport(parent.command_file)
+
+
+def ip_transport(parent):
+    return IPTransport(parent.ip_comms) if parent.ip_comms is not None else None
+
+
+# Factories of the transports main starts; each takes the MainSatelliteThread and returns a Transport or None
+TRANSPORT_FACTORIES = [radio_transport, command_file_transport, ip_transport]
+
+
+def build_transports(parent, factories=TRANSPORT_FACTORIES):
+    transports = []
+    for factory in factories:
+        try:
+            transport = factory(parent)
+        except Exception as e:
+            logger.error(f"Could not start transport {factory.__name__}: {e}")
+            continue
+        if transport is not None:
+            transports.append(transport)
+    return transports
@@ -1,7 +1,8 @@
 import drivers.power.power_controller as power_controller
 import drivers.power.power_structs as ps
+from drivers.power.hk_cache import HkCache
 from enum import Enum
-from utils.constants import GomOutputs
+from utils.constants import GomOutputs, GOM_HK_MAX_AGE
 import utils.parameters as params
 
 logger = ps.gom_logger
@@ -21,39 +22,43 @@ class Hk(Enum):
 class Gomspace:
     def __init__(self):
         self.pc = power_controller.Power()
+        self.hk_cache = HkCache({
+            Hk.DEFAULT.value: self.pc.get_hk_1,
+            Hk.EPS.value: self.pc.get_hk_2,
+            Hk.VI.value: self.pc.get_hk_2_vi,
+            Hk.OUT.value: self.pc.get_hk_out,
+            Hk.WDT.value: self.pc.get_hk_wdt,
+            Hk.BASIC.value: self.pc.get_hk_2_basic,
+            Hk.CONFIG.value: self.pc.config_get,
+            Hk.CONFIG2.value: self.pc.config2_get,
+        }, GOM_HK_MAX_AGE)
 
     def tick_wdt(self):
         """Resets dedicated WDT"""
         return self.pc.reset_wdt()
 
-    def get_health_data(self, level=Hk.DEFAULT.value):
+    def get_health_data(self, level=Hk.DEFAULT.value, max_age=None):
         """Returns a struct containing housekeeping data.
             The level parameter specifies which command gets sent to the P31u and what data you get back.
             level must be either one of the following: \n
             ["default", "eps", "vi", "out", "wdt", "basic", "config", "config2"]\n
             If no argument is provided, returns the same as "default" \n
             Every option returns a different struct, the documentation for which can be found in power_structs.py or in
-            the GomSpace NanoPower P31u manual"""
-
-        hk_dict = {
-            Hk.DEFAULT.value: self.pc.get_hk_1,
-            Hk.EPS.value: self.pc.get_hk_2,
-            Hk.VI.value: self.pc.get_hk_2_vi,
-            Hk.OUT.value: self.pc.get_hk_out,
-            Hk.WDT.value: self.pc.get_hk_wdt,
-            Hk.BASIC.value: self.pc.get_hk_2_basic,
-            Hk.CONFIG.value: self.pc.config_get,
-            Hk.CONFIG2.value: self.pc.config2_get,
-        }
+            the GomSpace NanoPower P31u manual \n
+            The struct is served from memory unless it is older than [max_age] seconds (by default the level's
+            GOM_HK_MAX_AGE). max_age=0 always reads it from the P31u"""
 
         try:
-            logger.debug("Getting health data %s from get_health_data" % level)
-            return hk_dict[level.lower()]()
+            return self.hk_cache.get(level.lower(), max_age)
         except KeyError:
             logger.warning(
                 "Invalid argument in get_health_data. Getting default health data"
             )
-            return self.pc.get_hk_1()
+            return self.hk_cache.get(Hk.DEFAULT.value, max_age)
+
+    def i2c_transactions_per_minute(self):
+        """Number of I2C transactions with the P31u in the last minute"""
+        return self.pc.transactions.per_minute()
 
     def set_output(self, channel, value, delay=0):
         """Sets a single controllable output either on or off.
@@ -62,17 +67,20 @@ class Gomspace:
             value must be either 1 (on) or 0 (off)"""
 
         self.pc.set_single_output(channel, value, delay)
+        self.hk_cache.invalidate()
 
     def all_off(self):
         """Turns off all controllable outputs on the Gomspace"""
         logger.debug("Turning off all controllable outputs")
         self.set_PA(False)
         self.pc.set_output(0)
+        self.hk_cache.invalidate()
 
     def hard_reset(self, passcode):
         """Performs a hard reset of the P31u, including cycling permanent 5V and 3.3V and battery outputs"""
         logger.info("Performing hard reset soon with passcode %s", passcode)
         self.pc.hard_reset(are_you_sure=passcode)
+        self.hk_cache.invalidate()
 
     def display_all(self):
         """Prints Housekeeping, config, and config2 data"""
@@ -98,6 +106,7 @@ class Gomspace:
     def set_electrolysis(self, status: bool, delay=0):
         """Switches on if [status] is true, off otherwise, with a delay of [delay] seconds."""
         self.pc.electrolyzer(status, delay=delay)
+        self.hk_cache.invalidate()
 
     def lna(self, on: bool):
         """Turns the receiving amplifier on (True)/off (False)"""
@@ -115,13 +124,13 @@ class Gomspace:
         """Turns on/off the power circuit for the PA"""
         self.pc.set_PA(on)
 
-    def is_electrolyzing(self):
+    def is_electrolyzing(self, max_age=None):
         """Returns status of electrolyzer"""
-        output_struct = self.get_health_data(level=Hk.OUT.value)
+        output_struct = self.get_health_data(level=Hk.OUT.value, max_age=max_age)
         return bool(output_struct.output[GomOutputs.electrolyzer.value])
 
-    def read_battery_percentage(self):
-        battery_data = self.get_health_data(level=Hk.VI.value)
+    def read_battery_percentage(self, max_age=None):
+        battery_data = self.get_health_data(level=Hk.VI.value, max_age=max_age)
         battery_voltage = battery_data.vbatt
         vmin = params.GOM_VOLTAGE_MIN
         vmax = params.GOM_VOLTAGE_MAX
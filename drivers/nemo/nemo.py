@@ -11,6 +11,7 @@ import datetime
 from pathlib import Path
 from time import sleep
 
+import numpy as np
 import pigpio
 from adafruit_blinka.agnostic import board_id
 if board_id != 'GENERIC_LINUX_PC':
@@ -27,6 +28,9 @@ class I2CDevice:
     Simple class to represent I2C devices.
     """
 
+    # Largest read the device serves in one transaction
+    MAX_READ_SIZE = 32
+
     def __init__(self, dev_addr=0x13, log=True):
         """Class constructor"""
         if board_id != 'GENERIC_LINUX_PC':
@@ -73,6 +77,33 @@ class I2CDevice:
             self._log.info(f'_read_register(0x{reg_address:02X}, {size}): {values}')
         return list(values)
 
+    def _read_registers_into(self, reg_address, buffer, chunk_size=None, fifo=False):
+        """
+        Read len(buffer) bytes from device into buffer, holding the bus for all transactions.
+        :param chunk_size: bytes per transaction, at most MAX_READ_SIZE
+        :param fifo: if True every transaction reads reg_address, otherwise each continues at the next address
+        """
+        if chunk_size is None:
+            chunk_size = self.MAX_READ_SIZE
+        while not self._bus.try_lock():
+            pass
+        try:
+            for start in range(0, len(buffer), chunk_size):
+                end = min(start + chunk_size, len(buffer))
+                address = reg_address if fifo else reg_address + start
+                self._bus.writeto_then_readfrom(self._dev_addr, bytes([address]), buffer, in_start=start, in_end=end)
+        except OSError as error:
+            if error.errno == 121:
+                raise I2CTransactionFailure('Read failure')
+            else:
+                raise
+        finally:
+            self._bus.unlock()
+
+        if self._log is not None:
+            self._log.info(f'_read_registers_into(0x{reg_address:02X}, {len(buffer)}): {buffer}')
+        return buffer
+
     def _write_register(self, reg_address, values):
         """Read registers to device"""
         if self._log is not None:
@@ -222,9 +253,7 @@ class Domino(I2CDevice):
     def bins(self):
         """Get histogram bins for detector.
         Returns a list of bins from smallest width to largest."""
-        bins = self._read_register(self._reg_bin_0, 32)
-        bins += self._read_register(self._reg_bin_0 + 32, 32)
-        return bins
+        return list(self._read_registers_into(self._reg_bin_0, bytearray(64)))
 
 
 class Nemo(I2CDevice):
@@ -625,34 +654,37 @@ class Nemo(I2CDevice):
         """Reset (delete) all accumulated rate data from device"""
         self._write_register(self.REG_RATE_AVAILABLE_L, [0x00])
 
+    def read_rate_data(self):
+        """Drain the rate data available on the device in as few transactions as possible.
+        Returned as a (N x 3) uint8 array of (det0, det1, veto) rates, a view of one buffer"""
+        available = self.rate_available
+        rate_data_raw = bytearray(available - available % 3)
+
+        # keep every transaction a whole number of (det0, det1, veto) entries
+        chunk_size = self.MAX_READ_SIZE - self.MAX_READ_SIZE % 3
+        self._read_registers_into(self.REG_RATE, rate_data_raw, chunk_size=chunk_size, fifo=True)
+
+        return np.frombuffer(rate_data_raw, dtype=np.uint8).reshape(-1, 3)
+
     @property
     def rate_data(self):
         """Get all available rate data from device.
         Returned as tuple of lists (det0_rates, det1_rates, veto_rates)"""
-
-        det0_rates = []
-        det1_rates = []
-        veto_rates = []
-
-        while self.rate_available >= 3:
-            rate_data_raw = self._read_register(
-                self.REG_RATE,
-                min(self.rate_available, 30))
-
-            det0_rates.extend(rate_data_raw[0::3])
-            det1_rates.extend(rate_data_raw[1::3])
-            veto_rates.extend(rate_data_raw[2::3])
-
-        return (det0_rates, det1_rates, veto_rates)
+        rates = self.read_rate_data()
+        return (rates[:, 0].tolist(), rates[:, 1].tolist(), rates[:, 2].tolist())
 
     @property
     def veto_bins(self):
         """Get histogram bins for veto counts.
         Returns a list of bins from smallest width to largest."""
-        bins = self._read_register(self.REG_VETO_BIN_0, 32)
-        bins += self._read_register(self.REG_VETO_BIN_0 + 32, 32)
-        return bins
-
+        return list(self._read_registers_into(self.REG_VETO_BIN_0, bytearray(64)))
+
+    def read_histograms(self):
+        """Get the det0, det1 and veto histogram bins in one pass over the bus.
+        Returned as a (3 x 64) uint8 array, bins from smallest width to largest"""
+        bins = bytearray(self.REG_VETO_BIN_63 - self.REG_D0_BIN_0 + 1)
+        self._read_registers_into(self.REG_D0_BIN_0, bins)
+        return np.frombuffer(bins, dtype=np.uint8).reshape(3, -1)
 
 if __name__ == "__main__":
     nemo = Nemo()
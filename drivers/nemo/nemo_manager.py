@@ -13,6 +13,7 @@ import logging
 
 from . import nemo
 from . import util
+from . import summarizer
 
 
 class NemoManager(Thread):
@@ -36,15 +37,50 @@ class NemoManager(Thread):
 
         self._config_file = util.RotatingFileManager(
             os.path.join(self._data_dir, 'config'),
-            self._config.config_rotate_period)
+            self._config.config_rotate_period,
+            buffer_size=self._config.file_buffer_size,
+            flush_period=self._config.file_flush_period)
 
         self._rate_data_file = util.RotatingFileManager(
             os.path.join(self._data_dir, 'rate_data'),
-            self._config.rate_data_rotate_period)
+            self._config.rate_data_rotate_period,
+            buffer_size=self._config.file_buffer_size,
+            flush_period=self._config.file_flush_period)
 
         self._histogram_file = util.RotatingFileManager(
             os.path.join(self._data_dir, 'histogram'),
-            self._config.histogram_rotate_period)
+            self._config.histogram_rotate_period,
+            buffer_size=self._config.file_buffer_size,
+            flush_period=self._config.file_flush_period)
+
+        self._summary_file = util.RotatingFileManager(
+            os.path.join(self._data_dir, 'summary'),
+            self._config.config_rotate_period,
+            buffer_size=self._config.file_buffer_size,
+            flush_period=self._config.file_flush_period)
+
+        self._burst_rate_data_file = util.RotatingFileManager(
+            os.path.join(self._data_dir, 'burst_rate_data'),
+            self._config.rate_data_rotate_period,
+            buffer_size=self._config.file_buffer_size,
+            flush_period=self._config.file_flush_period)
+
+        self._burst_histogram_file = util.RotatingFileManager(
+            os.path.join(self._data_dir, 'burst_histogram'),
+            self._config.histogram_rotate_period,
+            buffer_size=self._config.file_buffer_size,
+            flush_period=self._config.file_flush_period)
+
+        self._summarizer = summarizer.Summarizer(
+            self._summary_file,
+            self._burst_rate_data_file,
+            self._burst_histogram_file,
+            summary_period=self._config.summary_period,
+            window=self._config.summary_window,
+            change_threshold=self._config.change_threshold,
+            change_drift=self._config.change_drift,
+            burst_pre_packets=self._config.burst_pre_packets,
+            burst_post_packets=self._config.burst_post_packets)
 
         self.set_config(**self._config.get_public_dict())
 
@@ -75,10 +111,22 @@ class NemoManager(Thread):
             return (datetime.datetime.now() - self._t_last_data).total_seconds()
         return None
 
+    @property
+    def _files(self):
+        return (self._config_file, self._rate_data_file, self._histogram_file, self._summary_file,
+                self._burst_rate_data_file, self._burst_histogram_file)
+
     def close(self):
         """Cleanly close the object"""
         self._shutdown.set()
 
+    def file_stats(self):
+        """Bytes written to each recent data file, by file name. For telemetry"""
+        stats = dict()
+        for file in self._files:
+            stats.update(file.sizes())
+        return {os.path.basename(fname): size for fname, size in stats.items()}
+
     def pause(self):
         """
         Pause work in the main thread.
@@ -110,17 +158,32 @@ class NemoManager(Thread):
                     # if time to write rate data and histogram to file
                     if (self._sec_since_last_data is None
                             or (self._sec_since_last_data > self._config.data_write_period)):
-                        self._rate_data_file.write(bytes(util.RateDataPacket(self._nemo)))
-                        self._histogram_file.write(bytes(util.HistogramPacket(self._nemo)))
+                        rate_packet = util.RateDataPacket(self._nemo)
+                        histogram_packet = util.HistogramPacket(self._nemo)
+                        self._rate_data_file.write(bytes(rate_packet))
+                        self._histogram_file.write(bytes(histogram_packet))
                         self._t_last_data = datetime.datetime.now()
                         logging.info('Wrote rate data and histogram')
 
+                        self._summarizer.add(rate_packet, histogram_packet)
+
+                    # if time to summarize the data written since the last summary
+                    if self._summarizer.summary_due():
+                        self._summarizer.summarize()
+                        logging.info('Wrote summary')
+
+                    for file in self._files:
+                        file.flush_if_due()
+
                     time.sleep(0.25)
 
                 except nemo.I2CTransactionFailure:
                     logging.error('Nemo I2C transaction failure in NemoManager tread')
                     time.sleep(1)
 
+        for file in self._files:
+            file.close()
+
     def write_register(self, reg_address, values):
         """Direct write of register on NEMO. Allows low-level diagnostics on-orbit."""
         try:
@@ -203,6 +266,7 @@ class NemoManager(Thread):
             if 'config_rotate_period' in kwargs:
                 self._config.set(config_rotate_period=kwargs['config_rotate_period'])
                 self._config_file.period = kwargs['config_rotate_period']
+                self._summary_file.period = kwargs['config_rotate_period']
 
             if 'data_write_period' in kwargs:
                 self._config.set(data_write_period=kwargs['data_write_period'])
@@ -210,10 +274,47 @@ class NemoManager(Thread):
             if 'rate_data_rotate_period' in kwargs:
                 self._config.set(rate_data_rotate_period=kwargs['rate_data_rotate_period'])
                 self._rate_data_file.period = kwargs['rate_data_rotate_period']
+                self._burst_rate_data_file.period = kwargs['rate_data_rotate_period']
 
             if 'histogram_rotate_period' in kwargs:
                 self._config.set(histogram_rotate_period=kwargs['histogram_rotate_period'])
                 self._histogram_file.period = kwargs['histogram_rotate_period']
+                self._burst_histogram_file.period = kwargs['histogram_rotate_period']
+
+            if 'file_buffer_size' in kwargs:
+                self._config.set(file_buffer_size=kwargs['file_buffer_size'])
+                for file in self._files:
+                    file.buffer_size = kwargs['file_buffer_size']
+
+            if 'file_flush_period' in kwargs:
+                self._config.set(file_flush_period=kwargs['file_flush_period'])
+                for file in self._files:
+                    file.flush_period = kwargs['file_flush_period']
+
+            if 'summary_period' in kwargs:
+                self._config.set(summary_period=kwargs['summary_period'])
+                self._summarizer.summary_period = kwargs['summary_period']
+
+            if 'summary_window' in kwargs:
+                self._config.set(summary_window=kwargs['summary_window'])
+                if self._summarizer.window != kwargs['summary_window']:
+                    self._summarizer.window = kwargs['summary_window']
+
+            if 'change_threshold' in kwargs:
+                self._config.set(change_threshold=kwargs['change_threshold'])
+                self._summarizer.change_threshold = kwargs['change_threshold']
+
+            if 'change_drift' in kwargs:
+                self._config.set(change_drift=kwargs['change_drift'])
+                self._summarizer.change_drift = kwargs['change_drift']
+
+            if 'burst_pre_packets' in kwargs:
+                self._config.set(burst_pre_packets=kwargs['burst_pre_packets'])
+                self._summarizer.burst_pre_packets = kwargs['burst_pre_packets']
+
+            if 'burst_post_packets' in kwargs:
+                self._config.set(burst_post_packets=kwargs['burst_post_packets'])
+                self._summarizer.burst_post_packets = kwargs['burst_post_packets']
 
             self._config.save()
         except nemo.I2CTransactionFailure:
@@ -244,34 +345,27 @@ class NemoManager(Thread):
 
     def process_rate_data(self, t_start, t_stop, decimation_factor):
         """Process already saved rate data into a lower resolution."""
-        input_packets = util.RateDataPacket.from_file(
+        self._rate_data_file.flush()
+        input_records = util.RateDataPacket.read_array(
             os.path.join(self._data_dir, 'rate_data_*T*Z'),
             sc_time_min=t_start,
-            sc_time_max=t_stop,
-            sort=True)
+            sc_time_max=t_stop)
 
         fname = f'lores_rate_data_{t_start}_{t_stop}_{decimation_factor}'
         with open(os.path.join(self._data_dir, fname), 'wb') as file:
-            for i in range(0, len(input_packets), decimation_factor):
-                output_packet = util.LoResRateDataPacket(input_packets[i:i + decimation_factor])
-                file.write(bytes(output_packet))
+            file.write(util.LoResRateDataPacket.decimate(input_records, decimation_factor).tobytes())
 
     def process_histograms(self, t_start, t_stop, decimation_factor):
         """Process already saved histograms into a lower resolution."""
-        input_packets = util.HistogramPacket.from_file(
+        self._histogram_file.flush()
+        input_records = util.HistogramPacket.read_array(
             os.path.join(self._data_dir, 'histogram_*T*Z'),
             sc_time_min=t_start,
-            sc_time_max=t_stop,
-            sort=True)
+            sc_time_max=t_stop)
 
         fname = f'lores_histogram_{t_start}_{t_stop}_{decimation_factor}'
         with open(os.path.join(self._data_dir, fname), 'wb') as file:
-            for i in range(0, len(input_packets), decimation_factor):
-                output_packet = util.LoResHistogramPacket(
-                    input_packets[i:i + decimation_factor])
-
-                file.write(bytes(output_packet))
-
+            file.write(util.LoResHistogramPacket.decimate(input_records, decimation_factor).tobytes())
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+"""
+Onboard summaries of Nemo data, so that most of the mission can be downlinked without full resolution data
+"""
+
+import collections
+import logging
+import math
+import threading
+import time
+
+import numpy as np
+
+from . import util
+
+# Rate channels, in the order of RateDataPacket.rate_data
+CHANNELS = ('det0', 'det1', 'veto')
+
+# Rate samples the change point detector sees after starting or a change point before it looks for changes
+CHANGE_WARMUP = 30
+
+
+class Summarizer:
+    """
+    Keeps rolling statistics of the rate data and histograms written by NemoManager.
+
+    Every summary_period seconds a SummaryPacket is written with, per channel, the rate mean and maximum since the
+    last summary, rate percentiles over the last `window` samples, moments of the histogram and the change points
+    found. Change points are found with a two-sided CUSUM of each rate against its moving average, in units of
+    the Poisson standard deviation. The average is learned again after every change point. Around each change
+    point the full resolution packets are written to the burst files: burst_pre_packets from before and
+    burst_post_packets from after.
+    Safe to use from several threads: NemoManager adds packets from its thread while commands reconfigure it.
+    """
+
+    def __init__(self, summary_file, burst_rate_data_file, burst_histogram_file, summary_period=3600, window=360,
+                 change_threshold=8.0, change_drift=1.0, burst_pre_packets=3, burst_post_packets=3,
+                 clock=time.time):
+        """
+        Summarizer class constructor
+        :param summary_file: RotatingFileManager SummaryPackets are written to
+        :param burst_rate_data_file: RotatingFileManager full resolution rate data around events is written to
+        :param burst_histogram_file: RotatingFileManager full resolution histograms around events are written to
+        :param summary_period: seconds between summaries
+        :param window: number of rate samples the percentiles are computed over
+        :param change_threshold: CUSUM value (in standard deviations) at which a change point is detected
+        :param change_drift: deviation (in standard deviations) the CUSUM ignores every sample
+        """
+        self._summary_file = summary_file
+        self._burst_rate_data_file = burst_rate_data_file
+        self._burst_histogram_file = burst_histogram_file
+        self.summary_period = summary_period
+        self.change_threshold = change_threshold
+        self.change_drift = change_drift
+        self.burst_post_packets = burst_post_packets
+        self._clock = clock
+        self._lock = threading.RLock()
+
+        self._burst_pre = collections.deque(maxlen=burst_pre_packets)
+        self._burst_remaining = 0
+
+        # change point detector state, per channel
+        self._baseline = np.zeros(3)
+        self._cusum_high = np.zeros(3)
+        self._cusum_low = np.zeros(3)
+        self._samples_seen = np.zeros(3, dtype=int)  # since the last change point
+
+        self.window = window
+        self.serial_number = 0
+        self._reset_interval(self._clock())
+
+    @property
+    def window(self):
+        return self._window.shape[1]
+
+    @window.setter
+    def window(self, window):
+        """Changing the window forgets the samples in it"""
+        with self._lock:
+            self._window = np.zeros((3, window), dtype=np.uint8)
+            self._window_count = 0
+
+    @property
+    def burst_pre_packets(self):
+        return self._burst_pre.maxlen
+
+    @burst_pre_packets.setter
+    def burst_pre_packets(self, burst_pre_packets):
+        with self._lock:
+            self._burst_pre = collections.deque(self._burst_pre, maxlen=burst_pre_packets)
+
+    def _reset_interval(self, now):
+        self._t_start = int(now)
+        self._rate_sum = np.zeros(3, dtype=np.uint64)
+        self._rate_max = np.zeros(3, dtype=np.uint8)
+        self._num_samples = 0
+        self._bins = np.zeros((3, util.HistogramPacket.NUM_BINS), dtype=np.uint64)
+        self._change_points = np.zeros(3, dtype=np.uint8)
+        self._last_change = 0
+
+    def add(self, rate_packet, histogram_packet):
+        """
+        Add the packets NemoManager just wrote.
+        Returns the names of the channels a change point was detected in.
+        """
+        rates = np.array(rate_packet.rate_data, dtype=np.uint8)[:, :rate_packet.num_samples]
+        bins = np.array([histogram_packet.det0_bins, histogram_packet.det1_bins, histogram_packet.veto_bins],
+                        dtype=np.uint64)
+
+        with self._lock:
+            self.serial_number = rate_packet.serial_number
+            self._add_rates(rates)
+            self._bins += bins
+
+            changed = self._detect_changes(rates, rate_packet.sc_time)
+            self._capture_burst(rate_packet, histogram_packet, trigger=bool(changed))
+        return changed
+
+    def _add_rates(self, rates):
+        n = rates.shape[1]
+        if n == 0:
+            return
+        self._rate_sum += rates.sum(axis=1, dtype=np.uint64)
+        self._rate_max = np.maximum(self._rate_max, rates.max(axis=1))
+        self._num_samples += n
+
+        # ring buffer of the last `window` samples
+        window = self.window
+        index = (self._window_count + np.arange(n)) % window
+        self._window[:, index[-window:]] = rates[:, -window:]
+        self._window_count += n
+
+    def _detect_changes(self, rates, sc_time):
+        changed = set()
+        for sample in rates.T.astype(float):
+            # running mean until the window fills, then a moving average over about the window
+            self._samples_seen += 1
+            alpha = 1.0 / np.minimum(self._samples_seen, self.window)
+
+            sigma = np.sqrt(np.maximum(self._baseline, 1.0))
+            z = (sample - self._baseline) / sigma
+            self._cusum_high = np.maximum(0.0, self._cusum_high + z - self.change_drift)
+            self._cusum_low = np.maximum(0.0, self._cusum_low - z - self.change_drift)
+            self._baseline += alpha * (sample - self._baseline)
+
+            learning = self._samples_seen < CHANGE_WARMUP
+            self._cusum_high[learning] = 0.0
+            self._cusum_low[learning] = 0.0
+
+            detected = (self._cusum_high > self.change_threshold) | (self._cusum_low > self.change_threshold)
+            for ch in np.flatnonzero(detected):
+                changed.add(CHANNELS[ch])
+                if self._change_points[ch] < 0xFF:
+                    self._change_points[ch] += 1
+                self._last_change = sc_time
+                # learn the new level from scratch
+                self._samples_seen[ch] = 0
+                self._cusum_high[ch] = self._cusum_low[ch] = 0.0
+
+        if changed:
+            logging.info(f'Nemo change point in {sorted(changed)} at {sc_time}')
+        return sorted(changed)
+
+    def _capture_burst(self, rate_packet, histogram_packet, trigger):
+        if trigger:
+            while self._burst_pre:
+                self._write_burst(*self._burst_pre.popleft())
+            self._burst_remaining = self.burst_post_packets + 1  # this packet too
+
+        if self._burst_remaining > 0:
+            self._write_burst(rate_packet, histogram_packet)
+            self._burst_remaining -= 1
+        else:
+            self._burst_pre.append((rate_packet, histogram_packet))
+
+    def _write_burst(self, rate_packet, histogram_packet):
+        self._burst_rate_data_file.write(bytes(rate_packet))
+        self._burst_histogram_file.write(bytes(histogram_packet))
+
+    def summary_due(self, now=None):
+        if now is None:
+            now = self._clock()
+        return now - self._t_start >= self.summary_period
+
+    def summary_record(self):
+        """Current statistics as a SummaryPacket.DTYPE record"""
+        with self._lock:
+            record = np.zeros(1, dtype=util.SummaryPacket.DTYPE)[0]
+            record['sc_time'] = int(self._clock())
+            record['serial_number'] = self.serial_number
+            record['t_start'] = self._t_start
+            record['num_samples'] = min(self._num_samples, 0xFFFF)
+            if self._num_samples:
+                record['rate_mean'] = self._rate_sum / self._num_samples
+            record['rate_max'] = self._rate_max
+
+            filled = self._window[:, :min(self._window_count, self.window)]
+            if filled.shape[1]:
+                record['rate_percentiles'] = np.percentile(filled, util.SummaryPacket.PERCENTILES, axis=1).T
+
+            counts = self._bins.sum(axis=1)
+            record['hist_counts'] = np.minimum(counts, 0xFFFFFFFF)
+            bin_numbers = np.arange(self._bins.shape[1])
+            for ch in range(3):
+                if counts[ch] == 0:
+                    continue
+                weights = self._bins[ch] / counts[ch]
+                mean = (weights * bin_numbers).sum()
+                variance = (weights * (bin_numbers - mean) ** 2).sum()
+                record['hist_mean'][ch] = mean
+                record['hist_std'][ch] = math.sqrt(variance)
+                if variance > 0:
+                    record['hist_skew'][ch] = (weights * (bin_numbers - mean) ** 3).sum() / variance ** 1.5
+
+            record['change_points'] = self._change_points
+            record['last_change'] = self._last_change
+        return record
+
+    def summarize(self):
+        """Write a SummaryPacket of the statistics since the last summary and start a new interval"""
+        with self._lock:
+            packet = util.SummaryPacket(self)
+            self._summary_file.write(bytes(packet))
+            self._reset_interval(self._clock())
+        return packet
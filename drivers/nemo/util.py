@@ -5,10 +5,17 @@ Utilities for working with Nemo data v3.4
 """
 
 import os
+import io
+import time
 import datetime
 import struct
 import glob
 import json
+import collections
+import mmap
+import threading
+
+import numpy as np
 
 from .nemo import Nemo, Domino
 
@@ -41,6 +48,16 @@ class Configuration:
         "data_write_period": 200,
         "rate_data_rotate_period": 3600,
         "histogram_rotate_period": 3600,
+
+        "file_buffer_size": 4096,
+        "file_flush_period": 600,
+
+        "summary_period": 3600,
+        "summary_window": 360,
+        "change_threshold": 8.0,
+        "change_drift": 1.0,
+        "burst_pre_packets": 3,
+        "burst_post_packets": 3,
     }
 
     def __init__(self, config_fname='config.json', **kwargs):
@@ -96,26 +113,141 @@ class Configuration:
 class RotatingFileManager:
     """
     Rotates through different file names based on current time and rotation period.
+    Keeps the current file open and buffered between writes. Buffered data is flushed and fsync'd
+    at least every flush_period seconds and when rotating or closing, which bounds what a power loss can lose.
+    Safe to use from several threads: NemoManager writes from its thread while commands flush and reconfigure
+    the files and telemetry reads their sizes.
     """
 
-    def __init__(self, basename, period, dt_format='_%Y%m%dT%H%M%SZ'):
+    # Number of most recent files whose sizes are kept in bytes_written
+    FILE_HISTORY = 24
+
+    def __init__(self, basename, period, dt_format='_%Y%m%dT%H%M%SZ', buffer_size=io.DEFAULT_BUFFER_SIZE,
+                 flush_period=600, clock=time.time):
         """
         RotatingFileManager class constructor
         :param basename: string base file name. May be either full path or relative.
         :param period: file rotation period in seconds
+        :param buffer_size: bytes buffered in memory before they are written to the file
+        :param flush_period: maximum seconds between flushes (0 flushes on every write)
+        :param clock: function returning the current epoch time in seconds
         """
         self._basename = basename
-        self.period = period
+        self._period = period
         self._dt_format = dt_format
+        self._buffer_size = buffer_size
+        self._flush_period = flush_period
+        self._clock = clock
+        self._lock = threading.RLock()
+
+        self._file = None
+        self._fname = None
+        self._next_rotation = None
+        self._next_flush = None
+
+        # file name -> size in bytes, for telemetry. Read it with sizes()
+        self.bytes_written = collections.OrderedDict()
+
+    @property
+    def period(self):
+        return self._period
+
+    @period.setter
+    def period(self, period):
+        """Changing the period starts a new file on the next write"""
+        with self._lock:
+            self._period = period
+            self._next_rotation = None
+
+    @property
+    def buffer_size(self):
+        return self._buffer_size
+
+    @buffer_size.setter
+    def buffer_size(self, buffer_size):
+        """The new buffer size is used from the next file on"""
+        with self._lock:
+            self._buffer_size = buffer_size
+
+    @property
+    def flush_period(self):
+        return self._flush_period
+
+    @flush_period.setter
+    def flush_period(self, flush_period):
+        """A shorter period also applies to the data buffered now"""
+        with self._lock:
+            self._flush_period = flush_period
+            if self._next_flush is not None:
+                self._next_flush = min(self._next_flush, self._clock() + flush_period)
 
     def write(self, data):
         """Write data to current file."""
-        with open(self._current_fname(), 'ab+') as file:
-            file.write(data)
+        with self._lock:
+            now = self._clock()
+            if self._next_rotation is None or now >= self._next_rotation:
+                self._rotate(now)
+
+            self._file.write(data)
+            self.bytes_written[self._fname] += len(data)
+
+            self.flush_if_due(now)
+
+    def flush_if_due(self, now=None):
+        """Flush the current file if flush_period has passed since the last flush"""
+        with self._lock:
+            if self._file is None:
+                return
+            if now is None:
+                now = self._clock()
+            if now >= self._next_flush:
+                self.flush()
+
+    def flush(self):
+        """Write buffered data to the file and sync it to disk"""
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._next_flush = self._clock() + self._flush_period
+
+    def close(self):
+        """Flush and close the current file"""
+        with self._lock:
+            if self._file is not None:
+                self.flush()
+                self._file.close()
+                self._file = None
+            self._next_rotation = None
+
+    def sizes(self):
+        """List of (file name, bytes written) of the recent files, oldest first"""
+        with self._lock:
+            return list(self.bytes_written.items())
+
+    @property
+    def current_fname(self):
+        """Name of the file being written, or None before the first write"""
+        return self._fname
+
+    def _rotate(self, now):
+        self.close()
 
-    def _current_fname(self):
-        epoch_time = datetime.datetime.now().timestamp()
-        epoch_time_rounded = int(epoch_time - (epoch_time % self.period))
+        epoch_time_rounded = int(now - (now % self._period))
+        self._next_rotation = epoch_time_rounded + self._period
+        self._fname = self._fname_for(epoch_time_rounded)
+
+        self._file = open(self._fname, 'ab', buffering=self._buffer_size)
+        # appending to a file from before a restart continues its count
+        self.bytes_written[self._fname] = self._file.tell()
+        self.bytes_written.move_to_end(self._fname)
+        while len(self.bytes_written) > self.FILE_HISTORY:
+            self.bytes_written.popitem(last=False)
+
+        self._next_flush = now + self._flush_period
+
+    def _fname_for(self, epoch_time_rounded):
         dt_rounded = datetime.datetime.fromtimestamp(epoch_time_rounded, tz=datetime.timezone.utc)
         return os.path.join(self._basename + dt_rounded.strftime(self._dt_format))
 
@@ -149,6 +281,10 @@ class NemoPacketBase:
         :para: sc_time_max: Maximum sc_time of packets to return (inclusive)
         :para: sort: If true, return list of packets sorted by sc_time ascending
         """
+        if hasattr(cls, 'DTYPE'):
+            records = cls.read_array(filename, sc_time_min, sc_time_max, sort=sort)
+            return [cls(record.tobytes()) for record in records]
+
         if sc_time_min is None:
             sc_time_min = 0
 
@@ -171,6 +307,70 @@ class NemoPacketBase:
 
         return packets
 
+    @classmethod
+    def read_array(cls, filename, sc_time_min=None, sc_time_max=None, sort=True):
+        """
+        Return the packets read from the given filename as a NumPy structured array of dtype DTYPE.
+        Files rotated by RotatingFileManager that start after sc_time_max (by the time in their name) are not
+        opened, and files whose last packet is before sc_time_min are skipped after reading that packet.
+        The others are memory-mapped and decoded in one step.
+        :param: filename: Can contain wildcards to parse multiple files
+        :para: sc_time_min: Minimum sc_time of packets to return (inclusive)
+        :para: sc_time_max: Maximum sc_time of packets to return (inclusive)
+        :para: sort: If true, return packets sorted by sc_time ascending
+        """
+        if sc_time_min is None:
+            sc_time_min = 0
+
+        if sc_time_max is None:
+            sc_time_max = (2**32) - 1
+
+        arrays = []
+        for name in glob.glob(filename):
+            start = _file_start_time(name)
+            if start is not None and start - SC_TIME_SLACK > sc_time_max:
+                continue
+            arrays.append(cls._read_file_array(name, sc_time_min, sc_time_max))
+
+        # concatenate converts to native byte order, keep the on-disk layout so records can be written back as is
+        records = np.concatenate(arrays).astype(cls.DTYPE) if arrays else np.empty(0, dtype=cls.DTYPE)
+        if sort:
+            records = records[np.argsort(records['sc_time'], kind='stable')]
+        return records
+
+    @classmethod
+    def _read_file_array(cls, name, sc_time_min, sc_time_max):
+        with open(name, 'rb') as file:
+            count = os.fstat(file.fileno()).st_size // cls.DTYPE.itemsize
+            if count == 0:
+                return np.empty(0, dtype=cls.DTYPE)
+
+            # packets are appended as they are made, so the last one is the newest
+            file.seek((count - 1) * cls.DTYPE.itemsize)
+            if np.frombuffer(file.read(cls.DTYPE.itemsize), dtype=cls.DTYPE)['sc_time'][0] < sc_time_min:
+                return np.empty(0, dtype=cls.DTYPE)
+
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                records = np.frombuffer(data, dtype=cls.DTYPE, count=count)
+                sc_time = records['sc_time']
+                selected = records[(sc_time >= sc_time_min) & (sc_time <= sc_time_max)]  # copied out of the map
+                del records, sc_time
+        return selected
+
+
+# Seconds a packet's sc_time may precede the start of the file it was written to
+# (it is timestamped before its data is read from NEMO)
+SC_TIME_SLACK = 60
+
+
+def _file_start_time(name, dt_format='%Y%m%dT%H%M%SZ'):
+    """Epoch time encoded in the name of a file written by RotatingFileManager, or None"""
+    try:
+        dt = datetime.datetime.strptime(name.rsplit('_', 1)[-1], dt_format)
+    except ValueError:
+        return None
+    return dt.replace(tzinfo=datetime.timezone.utc).timestamp()
+
 
 class ConfigPacket(NemoPacketBase):
     """Packet definition for storing and retrieving Configuration Data"""
@@ -324,6 +524,9 @@ class RateDataPacket(NemoPacketBase):
     NUM_SAMPLES = 20
     FORMAT_CODE = '>IBHHhh' + ('B' * 3 * NUM_SAMPLES)
     PACKET_SIZE = struct.calcsize(FORMAT_CODE)
+    DTYPE = np.dtype([('sc_time', '>u4'), ('serial_number', 'u1'), ('last_reset', '>u2'), ('clock', '>u2'),
+                      ('det0_temp_int16', '>i2'), ('det1_temp_int16', '>i2'),
+                      ('rate_data', 'u1', (3, NUM_SAMPLES))])
 
     def __init__(self, arg):
         """Constructor"""
@@ -343,6 +546,7 @@ class RateDataPacket(NemoPacketBase):
                 list(packet_unpacked[(6 + self.NUM_SAMPLES * 0):(6 + self.NUM_SAMPLES * 1)]),
                 list(packet_unpacked[(6 + self.NUM_SAMPLES * 1):(6 + self.NUM_SAMPLES * 2)]),
                 list(packet_unpacked[(6 + self.NUM_SAMPLES * 2):(6 + self.NUM_SAMPLES * 3)])]
+            self.num_samples = self.NUM_SAMPLES
 
         else:
             nemo = arg
@@ -354,15 +558,15 @@ class RateDataPacket(NemoPacketBase):
             self.det0_temp_int16 = nemo.det0.temp_int16
             self.det1_temp_int16 = nemo.det1.temp_int16
 
-            rate_data = list(nemo.rate_data)
-            for i in range(len(rate_data)):
-                # trim execess old data
-                rate_data[i] = rate_data[i][-self.NUM_SAMPLES:]
+            # trim execess old data
+            rates = nemo.read_rate_data()[-self.NUM_SAMPLES:]
 
-                # pad with zeros if not enough data
-                rate_data[i] = rate_data[i] + ((self.NUM_SAMPLES - len(rate_data[i])) * [0])
+            # pad with zeros if not enough data
+            rate_data = np.zeros((3, self.NUM_SAMPLES), dtype=np.uint8)
+            rate_data[:, :len(rates)] = rates.T
 
-            self.rate_data = rate_data
+            self.rate_data = rate_data.tolist()
+            self.num_samples = len(rates)
 
             self.packet = struct.pack(
                 self.FORMAT_CODE,
@@ -403,6 +607,9 @@ class LoResRateDataPacket(NemoPacketBase):
     NUM_SAMPLES = 20
     FORMAT_CODE = '>IBHHBh' + ('H' * 3 * NUM_SAMPLES)
     PACKET_SIZE = struct.calcsize(FORMAT_CODE)
+    DTYPE = np.dtype([('sc_time', '>u4'), ('serial_number', 'u1'), ('clock_0', '>u2'), ('clock_1', '>u2'),
+                      ('decimation_factor', 'u1'), ('det0_temp_int16', '>i2'),
+                      ('rate_data', '>u2', (3, NUM_SAMPLES))])
 
     def __init__(self, arg):
         """Constructor"""
@@ -457,6 +664,38 @@ class LoResRateDataPacket(NemoPacketBase):
                 *self.rate_data[1],
                 *self.rate_data[2])
 
+    @classmethod
+    def decimate(cls, records, decimation_factor):
+        """
+        Array version of building one LoResRateDataPacket from every decimation_factor RateDataPackets.
+        :param records: RateDataPacket.DTYPE array sorted by sc_time
+        :return: DTYPE array, one record per group of decimation_factor records (the last may be smaller)
+        """
+        if len(records) % decimation_factor:
+            # the full groups are reduced together, the smaller last group on its own
+            full = len(records) - len(records) % decimation_factor
+            lores = np.concatenate([cls.decimate(records[:full], decimation_factor),
+                                    cls.decimate(records[full:], len(records) - full)])
+            return lores.astype(cls.DTYPE)  # concatenate converts to native byte order
+
+        num_groups = len(records) // decimation_factor
+        lores = np.zeros(num_groups, dtype=cls.DTYPE)
+        if num_groups == 0:
+            return lores
+        grouped = records.reshape(num_groups, decimation_factor)
+        lores['sc_time'] = grouped['sc_time'][:, -1]
+        lores['serial_number'] = grouped['serial_number'][:, -1]
+        lores['clock_0'] = grouped['clock'][:, 0]
+        lores['clock_1'] = grouped['clock'][:, -1]
+        lores['decimation_factor'] = decimation_factor
+        lores['det0_temp_int16'] = grouped['det0_temp_int16'][:, -1]
+
+        # each channel's samples from the newest packet to the oldest, summed in runs of decimation_factor
+        rates = grouped['rate_data'][:, ::-1].astype(np.uint32)  # (group, packet, channel, sample)
+        rates = rates.transpose(0, 2, 1, 3).reshape(num_groups, 3, cls.NUM_SAMPLES, decimation_factor)
+        lores['rate_data'] = rates.sum(axis=3)
+        return lores
+
     def __eq__(self, other):
         if not isinstance(other, __class__):
             return NotImplemented
@@ -484,6 +723,9 @@ class HistogramPacket(NemoPacketBase):
     NUM_BINS = 64
     FORMAT_CODE = '>IBH' + ('B' * 3 * NUM_BINS)
     PACKET_SIZE = struct.calcsize(FORMAT_CODE)
+    DTYPE = np.dtype([('sc_time', '>u4'), ('serial_number', 'u1'), ('clock', '>u2'),
+                      ('det0_bins', 'u1', (NUM_BINS,)), ('det1_bins', 'u1', (NUM_BINS,)),
+                      ('veto_bins', 'u1', (NUM_BINS,))])
 
     def __init__(self, arg):
         """Constructor"""
@@ -506,9 +748,7 @@ class HistogramPacket(NemoPacketBase):
             self.sc_time = int(datetime.datetime.now().timestamp())
             self.serial_number = nemo.serial_number
             self.clock = nemo.clock
-            self.det0_bins = nemo.det0.bins
-            self.det1_bins = nemo.det1.bins
-            self.veto_bins = nemo.veto_bins
+            self.det0_bins, self.det1_bins, self.veto_bins = nemo.read_histograms().tolist()
             nemo.reset_bins()
 
             self.packet = struct.pack(
@@ -545,6 +785,9 @@ class LoResHistogramPacket(NemoPacketBase):
     NUM_BINS = 64
     FORMAT_CODE = '>IBHHB' + ('H' * 3 * NUM_BINS)
     PACKET_SIZE = struct.calcsize(FORMAT_CODE)
+    DTYPE = np.dtype([('sc_time', '>u4'), ('serial_number', 'u1'), ('clock_0', '>u2'), ('clock_1', '>u2'),
+                      ('decimation_factor', 'u1'), ('det0_bins', '>u2', (NUM_BINS,)),
+                      ('det1_bins', '>u2', (NUM_BINS,)), ('veto_bins', '>u2', (NUM_BINS,))])
 
     def __init__(self, arg):
         """Constructor"""
@@ -594,6 +837,33 @@ class LoResHistogramPacket(NemoPacketBase):
                 *self.det1_bins,
                 *self.veto_bins)
 
+    @classmethod
+    def decimate(cls, records, decimation_factor):
+        """
+        Array version of building one LoResHistogramPacket from every decimation_factor HistogramPackets.
+        :param records: HistogramPacket.DTYPE array sorted by sc_time
+        :return: DTYPE array, one record per group of decimation_factor records (the last may be smaller)
+        """
+        if len(records) % decimation_factor:
+            full = len(records) - len(records) % decimation_factor
+            lores = np.concatenate([cls.decimate(records[:full], decimation_factor),
+                                    cls.decimate(records[full:], len(records) - full)])
+            return lores.astype(cls.DTYPE)  # concatenate converts to native byte order
+
+        num_groups = len(records) // decimation_factor
+        lores = np.zeros(num_groups, dtype=cls.DTYPE)
+        if num_groups == 0:
+            return lores
+        grouped = records.reshape(num_groups, decimation_factor)
+        lores['sc_time'] = grouped['sc_time'][:, -1]
+        lores['serial_number'] = grouped['serial_number'][:, -1]
+        lores['clock_0'] = grouped['clock'][:, 0]
+        lores['clock_1'] = grouped['clock'][:, -1]
+        lores['decimation_factor'] = decimation_factor
+        for bins in ('det0_bins', 'det1_bins', 'veto_bins'):
+            lores[bins] = grouped[bins].sum(axis=1, dtype=np.uint32)
+        return lores
+
     def __eq__(self, other):
         if not isinstance(other, __class__):
             return NotImplemented
@@ -615,3 +885,46 @@ class LoResHistogramPacket(NemoPacketBase):
                     other.det0_bins,
                     other.det1_bins,
                     other.veto_bins))
+
+
+class SummaryPacket(NemoPacketBase):
+    """Packet definition for onboard summaries of rate data and histograms (see summarizer.py)"""
+
+    PERCENTILES = (10, 50, 90)
+    FORMAT_CODE = '>IBIH' + '3f3B9f' + '3I3f3f3f' + '3BI'
+    PACKET_SIZE = struct.calcsize(FORMAT_CODE)
+    DTYPE = np.dtype([('sc_time', '>u4'), ('serial_number', 'u1'), ('t_start', '>u4'), ('num_samples', '>u2'),
+                      ('rate_mean', '>f4', (3,)), ('rate_max', 'u1', (3,)),
+                      ('rate_percentiles', '>f4', (3, len(PERCENTILES))),
+                      ('hist_counts', '>u4', (3,)), ('hist_mean', '>f4', (3,)), ('hist_std', '>f4', (3,)),
+                      ('hist_skew', '>f4', (3,)), ('change_points', 'u1', (3,)), ('last_change', '>u4')])
+
+    def __init__(self, arg):
+        """Constructor"""
+
+        if isinstance(arg, bytes):
+            self.packet = arg
+            record = np.frombuffer(self.packet, dtype=self.DTYPE)[0]
+        else:
+            summarizer = arg
+            record = summarizer.summary_record()
+            self.packet = record.tobytes()
+
+        self.sc_time = int(record['sc_time'])
+        self.serial_number = int(record['serial_number'])
+        self.t_start = int(record['t_start'])
+        self.num_samples = int(record['num_samples'])
+        self.rate_mean = record['rate_mean'].tolist()  # det0, det1, veto
+        self.rate_max = record['rate_max'].tolist()
+        self.rate_percentiles = record['rate_percentiles'].tolist()  # per channel, at PERCENTILES
+        self.hist_counts = record['hist_counts'].tolist()  # det0, det1, veto
+        self.hist_mean = record['hist_mean'].tolist()  # moments of the bin number
+        self.hist_std = record['hist_std'].tolist()
+        self.hist_skew = record['hist_skew'].tolist()
+        self.change_points = record['change_points'].tolist()
+        self.last_change = int(record['last_change'])
+
+    def __eq__(self, other):
+        if not isinstance(other, __class__):
+            return NotImplemented
+        return self.packet == other.packet
@@ -0,0 +1,74 @@
+# hk_cache.py
+#
+# Desc: Gomspace housekeeping structs served from memory. Each struct is read from the P31u again only once it is
+#       older than the max age configured for it (GOM_HK_MAX_AGE) or given by the caller, so several readers in one
+#       loop share one I2C transaction
+#
+
+from collections import deque
+from time import monotonic
+
+
+class TransactionCounter:
+    """Counts events (I2C transactions) and how many happened in the last minute"""
+
+    WINDOW = 60.0  # seconds
+
+    def __init__(self, clock=monotonic):
+        self.clock = clock
+        self.total = 0
+        self._times = deque()
+
+    def count(self):
+        self.total += 1
+        self._times.append(self.clock())
+        self._expire()
+
+    def per_minute(self):
+        self._expire()
+        return len(self._times)
+
+    def _expire(self):
+        cutoff = self.clock() - self.WINDOW
+        while self._times and self._times[0] <= cutoff:
+            self._times.popleft()
+
+
+class HkCache:
+    """Latest value of each housekeeping struct and when it was read.
+    [readers]: level -> function reading that struct from the device
+    [max_ages]: level -> seconds a cached struct may be served for. Levels without one are always read"""
+
+    def __init__(self, readers: dict, max_ages: dict, clock=monotonic):
+        self.readers = readers
+        self.max_ages = max_ages
+        self.clock = clock
+        self._cache = dict()  # level -> (struct, time read)
+        self.reads = {level: 0 for level in readers}  # device reads per level
+        self.hits = {level: 0 for level in readers}  # reads served from the cache per level
+
+    def get(self, level, max_age=None):
+        """Returns the struct for [level], read again if it is older than [max_age] seconds
+        (default the level's max age, 0 to always read). Raises KeyError for an unknown level"""
+        reader = self.readers[level]
+        if max_age is None:
+            max_age = self.max_ages.get(level, 0)
+        entry = self._cache.get(level)
+        if entry is not None and max_age > 0 and self.clock() - entry[1] <= max_age:
+            self.hits[level] += 1
+            return entry[0]
+
+        value = reader()
+        self._cache[level] = (value, self.clock())
+        self.reads[level] += 1
+        return value
+
+    def age(self, level):
+        """Seconds since [level] was read, None if it never was"""
+        entry = self._cache.get(level)
+        return None if entry is None else self.clock() - entry[1]
+
+    def invalidate(self, *levels):
+        """Forgets [levels] (all if none are given), e.g. after changing outputs"""
+        for level in levels or list(self._cache):
+            self._cache.pop(level, None)
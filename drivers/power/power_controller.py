@@ -13,6 +13,7 @@
 
 import pigpio
 import drivers.power.power_structs as ps
+from drivers.power.hk_cache import TransactionCounter
 from utils.constants import GomOutputs
 import utils.parameters as params
 from utils.exceptions import PowerException, PowerInputError, PowerReadError
@@ -104,6 +105,7 @@ class Power:
         )
         self._pi = pigpio.pi()  # initialize pigpio object
         self._dev = self._pi.i2c_open(bus, addr, flags)  # initialize i2c device
+        self.transactions = TransactionCounter()  # I2C transactions with the P31u
 
         # initialize GPIO outputs
         self._pi.set_mode(RF_RX_EN, pigpio.OUTPUT)
@@ -130,12 +132,14 @@ class Power:
     # TODO: Implement PowerWriteError once we switch to new I2C library
     def write(self, cmd, values):
         ps.gom_logger.debug("Writing to register %s with byte list %s", cmd, values)
+        self.transactions.count()
         self._pi.i2c_write_device(self._dev, bytearray([cmd] + values))
 
     # reads [bytes] number of bytes from the device and returns a bytearray
     def read(self, num_bytes):
         # first two read bytes -> [command][error code][data]
         ps.gom_logger.debug("Reading %s bytes from the device", num_bytes)
+        self.transactions.count()
         (x, r) = self._pi.i2c_read_device(self._dev, num_bytes + 2)
         ps.gom_logger.debug("Read %s, and %s from device", x, r)
         if r[1] != 0:
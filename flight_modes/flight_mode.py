@@ -13,6 +13,7 @@ from datetime import datetime
 from multiprocessing import Process
 import subprocess
 from queue import Empty
+from concurrent.futures import wait
 
 from utils.constants import (  # noqa F401
     BOOTUP_SEPARATION_DELAY,
@@ -42,11 +43,16 @@ from utils.constants import (  # noqa F401
     HK_TEMP_1, HK_TEMP_2, HK_TEMP_3, HK_TEMP_4, GYRO_TEMP, THERMOCOUPLER_TEMP,
     CURRENT_IN_1, CURRENT_IN_2, CURRENT_IN_3,
     VBOOST_1, VBOOST_2, VBOOST_3, SYSTEM_CURRENT, BATTERY_VOLTAGE,
-    PROP_TANK_PRESSURE, HARD_SET, TIME, SUCCESSFUL
+    PROP_TANK_PRESSURE, HARD_SET, TIME, SUCCESSFUL,
+    FILE_ID, SEGMENT_SEQ, RETRANSMIT_BITMAP, SEGMENT_COUNT, SEGMENT_CRC, SEGMENT_DATA, FILE_SIZE,
+    BULK_SEGMENT_SIZE, BULK_BITMAP_SIZE, RADIO_TX_PACKETS, RADIO_TX_BYTES, RADIO_TX_FAILURES, RADIO_RX_PACKETS,
+    RADIO_RX_BYTES, RADIO_RX_CRC_ERRORS, RADIO_RX_LENGTH_ERRORS, RADIO_RX_FIFO_ERRORS, RADIO_STATE_TIME,
+    RADIO_FIFO_FILL, RADIO_RSSI, RADIO_BGND_RSSI, RADIO_RF_FREQ_OFFSET, VERIFICATION_BLOCK, VERIFICATION_BLOCK_SIZE
 )
 
 import utils.parameters as params
 from utils.log import get_log
+from communications.ax5043_manager.ax5043_manager import Manager
 
 from utils.exceptions import UnknownFlightModeException
 
@@ -156,8 +162,9 @@ class FlightMode:
 
                 bogus = False
                 try:
-                    mac, counter, command_fm, command_id, command_kwargs = self.parent.command_handler.unpack_command(
-                        command)
+                    # commands from the radio are already parsed CommandFrames, so this does not decode them again
+                    mac, counter, command_fm, command_id, command_kwargs = self.parent.command_handler.parse_command(
+                        command).unpacked()
                     logger.info(f"Received command {command_fm}:{command_id} with args {str(command_kwargs)}")
                     assert command_fm in self.parent.command_definitions.COMMAND_DICT
                     assert command_id in self.parent.command_definitions.COMMAND_DICT[command_fm]
@@ -185,8 +192,15 @@ class FlightMode:
                 self.parent.commands_to_execute.remove(finished_command)
 
     def poll_inputs(self):
+        self.tick_wdt()
+        self.poll_telemetry()
+
+    def tick_wdt(self):
         self.parent.gom.tick_wdt()
+
+    def poll_telemetry(self):
         self.parent.telemetry.poll()
+        self.write_telemetry()
 
     def completed_task(self):
         self.task_completed = True
@@ -196,7 +210,8 @@ class FlightMode:
         pass
 
     def write_telemetry(self):
-        pass
+        # only queued here, the telemetry writer thread inserts the samples in batches
+        self.parent.telemetry.write_telem()
 
     def __enter__(self):
         logger.info(f"Starting flight mode {self.flight_mode_id}")
@@ -257,7 +272,7 @@ class TestMode(PauseBackgroundMode):
 
     downlink_codecs = {TestCommandEnum.CommsDriver.value: (['gyro1', 'gyro2', 'gyro3'], 12)}
 
-    downlink_arg_unpackers = {
+    downlink_arg_types = {
         'gyro1': 'float',
         'gyro2': 'float',
         'gyro3': 'float',
@@ -308,11 +323,52 @@ class CommsMode(FlightMode):
         if self.electrolyzing:
             self.parent.gom.set_electrolysis(True, delay=params.DEFAULT_ELECTROLYSIS_DELAY)
 
+    def transmit(self, downlink):
+        """Sends [downlink] on the radio and, when it is enabled, on the IP comms stand-in.
+        Returns the futures of the transmissions"""
+        sinks = [sink for sink in (self.parent.radio, self.parent.ip_comms) if sink is not None]
+        self.parent.downlink_counter += 1
+        return [sink.transmit(downlink) for sink in sinks]
+
     def execute_downlinks(self):
+        # The radio queues every downlink and sends them back to back, so the PA stays on until the last one is out
+        futures = []
         while not self.parent.downlink_queue.empty():
-            self.parent.radio.transmit(self.parent.downlink_queue.get())
-            self.parent.downlink_counter += 1
-            sleep(params.DOWNLINK_BUFFER_TIME)
+            futures.extend(self.transmit(self.parent.downlink_queue.get()))
+
+        # then stream bulk transfer segments, still sending anything newly queued first
+        bulk = self.parent.bulk_downlink
+        for _ in range(params.BULK_SEGMENTS_PER_PASS):
+            if not self.parent.downlink_queue.empty():
+                downlink = self.parent.downlink_queue.get()
+            else:
+                downlink = bulk.next_segment(self.parent.downlink_counter)
+                if downlink is None:
+                    break
+            futures.extend(self.transmit(downlink))
+
+        self.wait_for_downlinks(futures)
+        bulk.save()
+
+    def wait_for_downlinks(self, futures):
+        """Waits until the radio has sent every downlink in [futures], or failed to.
+        Downlinks still queued when they should all have been sent are aborted. Returns the number that failed"""
+        # one after another, each within the manager's per packet timeout
+        timeout = len(futures) * Manager.Transmitting.PACKET_TIMEOUT
+        done, not_done = wait(futures, timeout=timeout)
+        failed = len(not_done)
+        for future in done:
+            error = future.exception()
+            if error is not None:
+                failed += 1
+                logger.error(f"Downlink failed: {error}")
+        if not_done:
+            logger.error(f"{len(not_done)} downlinks not sent within {timeout} s, aborting them")
+            if self.parent.radio is not None:
+                self.parent.radio.abort_transmissions('Downlink timed out')
+        if failed:
+            logger.error(f"{failed} of {len(futures)} downlinks failed")
+        return failed
 
     def update_state(self) -> int:
         super_fm = super().update_state()
@@ -320,7 +376,7 @@ class CommsMode(FlightMode):
             return super_fm
 
     def run_mode(self):
-        if not self.parent.downlink_queue.empty():
+        if not self.parent.downlink_queue.empty() or self.parent.bulk_downlink.pending():
             self.enter_transmit_safe_mode()
             self.execute_downlinks()
             self.exit_transmit_safe_mode()
@@ -475,6 +531,10 @@ class NormalMode(FlightMode):
         NormalCommandEnum.NemoReboot.value: ([], 0),
         NormalCommandEnum.NemoProcessRateData.value: ([T_START, T_STOP, DECIMATION_FACTOR], 9),
         NormalCommandEnum.NemoProcessHistograms.value: ([T_START, T_STOP, DECIMATION_FACTOR], 9),
+        NormalCommandEnum.BulkDownlinkFile.value: ([NAME], 64),
+        NormalCommandEnum.BulkRetransmit.value: ([FILE_ID, SEGMENT_SEQ, RETRANSMIT_BITMAP], 8 + BULK_BITMAP_SIZE),
+        NormalCommandEnum.BulkComplete.value: ([FILE_ID], 2),
+        NormalCommandEnum.RadioMetrics.value: ([], 0),
     }
 
     command_arg_types = {
@@ -516,6 +576,9 @@ class NormalMode(FlightMode):
         T_START: 'int',
         T_STOP: 'int',
         DECIMATION_FACTOR: 'uint8',
+        FILE_ID: 'short',
+        SEGMENT_SEQ: 'int',
+        RETRANSMIT_BITMAP: 'bytes',
     }
 
     downlink_codecs = {
@@ -525,7 +588,15 @@ class NormalMode(FlightMode):
                                               VBOOST_1, VBOOST_2, VBOOST_3, SYSTEM_CURRENT, BATTERY_VOLTAGE,
                                               PROP_TANK_PRESSURE], 84),
 
-        NormalCommandEnum.SetParam.value: ([SUCCESSFUL], 1)
+        NormalCommandEnum.SetParam.value: ([SUCCESSFUL], 1),
+        NormalCommandEnum.BulkSegment.value: ([FILE_ID, SEGMENT_SEQ, SEGMENT_COUNT, SEGMENT_CRC, SEGMENT_DATA],
+                                              16 + BULK_SEGMENT_SIZE),
+        NormalCommandEnum.BulkDownlinkFile.value: ([FILE_ID, SEGMENT_COUNT, FILE_SIZE], 14),
+        NormalCommandEnum.RadioMetrics.value: ([RADIO_TX_PACKETS, RADIO_TX_BYTES, RADIO_TX_FAILURES, RADIO_RX_PACKETS,
+                                               RADIO_RX_BYTES, RADIO_RX_CRC_ERRORS, RADIO_RX_LENGTH_ERRORS,
+                                               RADIO_RX_FIFO_ERRORS, RADIO_STATE_TIME, RADIO_FIFO_FILL, RADIO_RSSI,
+                                               RADIO_BGND_RSSI, RADIO_RF_FREQ_OFFSET], 104),
+        NormalCommandEnum.Verification.value: ([VERIFICATION_BLOCK], 2 + VERIFICATION_BLOCK_SIZE),
     }
 
     downlink_arg_types = {
@@ -552,7 +623,27 @@ class NormalMode(FlightMode):
         SYSTEM_CURRENT: 'short',
         BATTERY_VOLTAGE: 'short',
         PROP_TANK_PRESSURE: 'float',
-        SUCCESSFUL: 'bool'
+        SUCCESSFUL: 'bool',
+        FILE_ID: 'short',
+        SEGMENT_SEQ: 'int',
+        SEGMENT_COUNT: 'int',
+        SEGMENT_CRC: 'int',
+        SEGMENT_DATA: 'bytes',
+        FILE_SIZE: 'long',
+        RADIO_TX_PACKETS: 'int',
+        RADIO_TX_BYTES: 'int',
+        RADIO_TX_FAILURES: 'int',
+        RADIO_RX_PACKETS: 'int',
+        RADIO_RX_BYTES: 'int',
+        RADIO_RX_CRC_ERRORS: 'int',
+        RADIO_RX_LENGTH_ERRORS: 'int',
+        RADIO_RX_FIFO_ERRORS: 'int',
+        RADIO_STATE_TIME: 'bytes',
+        RADIO_FIFO_FILL: 'bytes',
+        RADIO_RSSI: 'float',
+        RADIO_BGND_RSSI: 'float',
+        RADIO_RF_FREQ_OFFSET: 'float',
+        VERIFICATION_BLOCK: 'bytes',
     }
 
     def __init__(self, parent):
@@ -592,7 +683,7 @@ class NormalMode(FlightMode):
             return FMEnum.OpNav.value
 
         # if we have data to downlink, change to comms mode
-        if not (self.parent.downlink_queue.empty()):
+        if not (self.parent.downlink_queue.empty()) or self.parent.bulk_downlink.pending():
             return FMEnum.CommsMode.value
 
     def run_mode(self):
@@ -619,6 +710,9 @@ class CommandMode(PauseBackgroundMode):
     def run_mode(self):
         pass  # intentional
 
+    def tick_wdt(self):
+        pass  # intentional: DO NOT TICK THE WDT
+
     def poll_inputs(self):
         # TODO
         raise NotImplementedError  # only check the comms queue
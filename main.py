@@ -2,19 +2,19 @@ import os
 import sys
 from threading import Thread
 from multiprocessing import Process
-from time import sleep, time
+from time import time
 from datetime import datetime, timedelta
 from queue import Queue
 import signal
 from utils.log import get_log
 
 from json import load
-from time import sleep
 
 import utils.constants
 from utils.constants import *
 import utils.parameters as params
 from utils.db import create_sensor_tables_from_path
+from utils.scheduler import Scheduler, WakeupQueue
 
 # from drivers.dummy_sensors import PressureSensor
 from flight_modes.restart_reboot import (
@@ -23,12 +23,14 @@ from flight_modes.restart_reboot import (
 )
 from flight_modes.flight_mode_factory import build_flight_mode
 from communications.commands import CommandHandler
-from communications.downlink import DownlinkHandler
+from communications.downlink import DownlinkHandler, DownlinkQueue
+from communications.bulk_downlink import BulkDownlinkManager
 from communications.command_definitions import CommandDefinitions
+from communications.transport import TransportMultiplexer, build_transports
 from telemetry.telemetry import Telemetry
 from utils.boot_cause import hard_boot
 
-from communications.comms_driver import CommunicationsSystem
+from communications.comms_driver import AsyncIPComms
 from communications.satellite_radio import Radio
 from drivers.gom import Gomspace
 from drivers.gyro import GyroSensor
@@ -47,9 +49,11 @@ class MainSatelliteThread(Thread):
         super().__init__()
         logger.info("Initializing...")
         self.init_parameters()
-        self.command_queue = Queue()
-        self.downlink_queue = Queue()
-        self.FMQueue = Queue()
+        self.scheduler = Scheduler()
+        # new commands and downlinks wake the main loop instead of waiting for the next period
+        self.command_queue = WakeupQueue(self.scheduler, COMMANDS_ACTIVITY)
+        self.downlink_queue = DownlinkQueue(self.scheduler, MODE_ACTIVITY)
+        self.FMQueue = WakeupQueue(self.scheduler, MODE_ACTIVITY)
         self.commands_to_execute = []
         self.downlinks_to_execute = []
         self.telemetry = Telemetry(self)
@@ -58,11 +62,12 @@ class MainSatelliteThread(Thread):
         self.reorientation_list = []
         self.maneuver_queue = Queue()  # maneuver queue
         self.opnav_queue = Queue()   # determine state of opnav success
-        # self.init_comms()
         self.command_handler = CommandHandler()
         self.downlink_handler = DownlinkHandler()
+        self.bulk_downlink = BulkDownlinkManager(self.downlink_handler)
         self.command_counter = 0
         self.downlink_counter = 0
+        self.last_telemetry_time = datetime.today()
         self.command_definitions = CommandDefinitions(self)
         self.last_opnav_run = datetime.now()  # Figure out what to set to for first opnav run
         self.log_dir = LOG_DIR
@@ -78,9 +83,12 @@ class MainSatelliteThread(Thread):
         self.mux = None
         self.camera = None
         self.init_sensors()
+        self.init_comms()
+        self.command_file = COMMAND_FILE
+        self.init_transports()
 
-        # Telemetry
-        self.tlm = Telemetry(self)
+        # Telemetry (one instance, so that one writer owns the database)
+        self.tlm = self.telemetry
 
         # Opnav subprocess variables
         self.opnav_proc_queue = Queue()
@@ -93,12 +101,31 @@ class MainSatelliteThread(Thread):
             os.mkdir(LOG_DIR)
             self.flight_mode = BootUpMode(self)
         self.create_session = create_sensor_tables_from_path(DB_FILE)
+        self.init_scheduler()
+
+    def init_scheduler(self):
+        """Activities run in the order they are added when several are due in the same iteration"""
+        self.scheduler.add_activity(WDT_ACTIVITY, self.tick_wdt, WDT_TICK_PERIOD, WDT_TICK_DEADLINE)
+        self.scheduler.add_activity(TELEMETRY_ACTIVITY, self.poll_telemetry, TELEMETRY_POLL_PERIOD,
+                                    TELEMETRY_POLL_DEADLINE)
+        self.scheduler.add_activity(COMMANDS_ACTIVITY, self.handle_commands, COMMANDS_PERIOD, COMMANDS_DEADLINE)
+        self.scheduler.add_activity(MODE_ACTIVITY, self.run_mode_work, MODE_PERIOD, MODE_DEADLINE)
 
     def init_comms(self):
-        self.comms = CommunicationsSystem(
-            queue=self.command_queue, use_ax5043=False
-        )
-        self.comms.listen()
+        """UDP stand-in for the radio, only when IP_COMMS_ENABLED (never in flight). Commands received on it go through
+        the ip transport and CommsMode sends every downlink to it as well as to the radio"""
+        self.ip_comms = None
+        if IP_COMMS_ENABLED:
+            self.ip_comms = AsyncIPComms(server_port=IP_COMMS_PORT, client_host=IP_COMMS_GROUND_HOST,
+                                         client_port=IP_COMMS_GROUND_PORT)
+            logger.warning("IP comms enabled, this is not a flight configuration")
+
+    def init_transports(self):
+        """Commands from every transport (radio, command file, ...) are received in the multiplexer's thread as
+        they arrive and wake the main loop through command_queue. Transports are listed in TRANSPORT_FACTORIES"""
+        self.transports = TransportMultiplexer(self.receive_command)
+        for transport in build_transports(self):
+            self.transports.add(transport)
 
     def init_parameters(self):
         with open(PARAMETERS_JSON_PATH) as f:
@@ -217,36 +244,44 @@ class MainSatelliteThread(Thread):
         signal.signal(signal.SIGINT, self.handle_sigint)
 
     def poll_inputs(self):
+        self.tick_wdt()
+        self.poll_telemetry()
+
+    def tick_wdt(self):
+        self.flight_mode.tick_wdt()
 
-        self.flight_mode.poll_inputs()
+    def poll_telemetry(self):
+        self.flight_mode.poll_telemetry()
 
         #Telemetry downlink
-        if (datetime.today() - self.radio.last_telemetry_time).total_seconds()/60 >= params.TELEM_DOWNLINK_TIME:
+        if (datetime.today() - self.last_telemetry_time).total_seconds()/60 >= params.TELEM_DOWNLINK_TIME:
             telemetry = self.command_definitions.gather_basic_telem()
             telem_downlink = (
                 self.downlink_handler.pack_downlink(self.downlink_counter, FMEnum.Normal.value,
                                                     NormalCommandEnum.BasicTelem.value, **telemetry))
-            self.downlink_queue.put(telem_downlink)
-            self.radio.last_telemetry_time = datetime.today()
-
-        # Listening for new commands
-        newCommand = self.radio.receiveSignal()
-        if newCommand is not None:
-            try:
-                unpackedCommand = self.command_handler.unpack_command(newCommand)
+            # replaces any older BasicTelem still waiting for CommsMode
+            self.downlink_queue.put(telem_downlink, DownlinkPriority.Telemetry, coalesce=True)
+            self.last_telemetry_time = datetime.today()
 
-                if unpackedCommand[0] == MAC:
-                    if unpackedCommand[1] == self.command_counter + 1:
-                        self.command_queue.put(bytes(newCommand))
-                        self.command_counter += 1
-                    else:
-                        logger.warning('Command with Invalid Counter Received. Counter: ' + str(unpackedCommand[1]))
+    def receive_command(self, frame, transport):
+        """Validates a command [frame] received on [transport] and queues it for execution"""
+        try:
+            # parsed in place; the frame (with its decoded arguments) is what gets queued
+            command = self.command_handler.parse_command(frame)
+
+            if transport.trusted:  # injected locally, so there is no MAC or counter to check
+                self.command_queue.put(command.decode())
+            elif command.mac == MAC:
+                if command.counter == self.command_counter + 1:
+                    # decoded now so that a malformed command is rejected here
+                    self.command_queue.put(command.decode())
+                    self.command_counter += 1
                 else:
-                    logger.warning('Unauthenticated Command Received')
-            except:
-                logger.error('Invalid Command Received')
-        else:
-            logger.debug('Not Received')
+                    logger.warning('Command with Invalid Counter Received. Counter: ' + str(command.counter))
+            else:
+                logger.warning('Unauthenticated Command Received')
+        except:
+            logger.error(f'Invalid Command Received on {transport.name}')
 
     def replace_flight_mode_by_id(self, new_flight_mode_id):
         self.replace_flight_mode(build_flight_mode(self, new_flight_mode_id))
@@ -281,38 +316,33 @@ class MainSatelliteThread(Thread):
             self.commands_to_execute.append(self.command_queue.get())
         self.flight_mode.execute_commands()
 
-    def read_command_queue_from_file(self, filename="communications/command_queue.txt"):
-        """A temporary workaround to not having radio board access"""
-        # check if file exists
-        if os.path.isfile(filename):
-            text_file = open(filename, "r")
-            for hex_line in text_file:
-                self.command_queue.put(bytes.fromhex(hex_line))
-
-            text_file.close()
-            # delete file
-            os.remove(filename)
+    def handle_commands(self):
+        if self.command_queue.empty():
+            return
+        self.execute_commands()  # Set goal or execute command immediately
+        # commands may change the flight mode or queue work for it, so don't wait for the next mode period
+        self.scheduler.release(MODE_ACTIVITY)
 
     # Run the current flight mode
     def run_mode(self):
         with self.flight_mode:
             self.flight_mode.run_mode()
 
+    def run_mode_work(self):
+        self.update_state()
+        self.run_mode()
+
     # Wrap in try finally block to ensure it stays live
     def run(self):
         """This is the main loop of the Cislunar Explorers and runs constantly during flight."""
         try:
-            while True:
-                sleep(5)  # TODO remove when flight modes execute real tasks
-                self.poll_inputs()
-                self.update_state()
-                self.read_command_queue_from_file()
-                self.execute_commands()  # Set goal or execute command immediately
-                self.run_mode()
-
-                # Opnav subprocess management
-                # TODO: This all needs to be moved to the OpNav Flight mode, and should not be in main!!!
+            # Each activity (WDT tick, telemetry, commands, flight mode work) runs on its own period and new
+            # commands wake the loop immediately. See init_scheduler and init_transports
+            self.transports.start()
+            self.scheduler.run_forever()
 
+            # Opnav subprocess management
+            # TODO: This all needs to be moved to the OpNav Flight mode, and should not be in main!!!
 
         finally:
             # TODO handle failure gracefully
@@ -323,12 +353,16 @@ class MainSatelliteThread(Thread):
                 self.shutdown()
 
     def shutdown(self):
+        self.scheduler.stop()
+        self.transports.stop()
         if self.gom is not None:
             self.gom.all_off()
         if self.nemo_manager is not None:
             self.nemo_manager.close()
+        if self.radio is not None:
+            self.radio.close()
+        self.telemetry.close()
         logger.critical("Shutting down flight software")
-        # self.comms.stop()
 
 
 if __name__ == "__main__":
@@ -1,13 +1,14 @@
 from time import time, sleep
+from datetime import datetime
 from os import popen
 import psutil
 from uptime import uptime
 from telemetry.sensor import SynchronousSensor
+from telemetry.writer import TelemetryWriter
 import numpy as np
 from drivers.power.power_structs import eps_hk_t, hkparam_t
 from utils.exceptions import PiSensorError, PressureError, GomSensorError, GyroError, ThermocoupleError
 #from utils.db import GyroModel
-from utils.db import TelemetryModel, create_sensor_tables_from_path
 from utils.constants import MAX_GYRO_RATE, GomOutputs, DB_FILE
 import utils.parameters as params
 
@@ -24,12 +25,15 @@ class GomSensor(SynchronousSensor):
         self.hkparam = hkparam_t()  # hkparam_t struct
         self.percent = float()
         self.is_electrolyzing = bool()
+        self.i2c_per_minute = int()  # I2C transactions with the P31u in the last minute
 
     def poll(self):
         super().poll()
         if self.parent.gom is not None:
+            # each struct is only read from the P31u when it is older than its GOM_HK_MAX_AGE
             self.hk = self.parent.gom.get_health_data(level="eps")
             self.hkparam = self.parent.gom.get_health_data()
+            self.i2c_per_minute = self.parent.gom.i2c_transactions_per_minute()
             battery_voltage = self.hk.vbatt  # mV
             self.percent = (battery_voltage - params.GOM_VOLTAGE_MIN) / \
                            (params.GOM_VOLTAGE_MAX - params.GOM_VOLTAGE_MIN)
@@ -154,6 +158,46 @@ class RtcSensor(SynchronousSensor):
             self.rtc_time = self.parent.rtc.get_time()
 
 
+class RadioSensor(SynchronousSensor):
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.metrics = dict()  # LinkMetrics.snapshot() of the AX5043 manager
+
+    def poll(self):
+        super().poll()
+        if self.parent.radio is not None:
+            self.metrics = self.parent.radio.mgr.metrics.snapshot()
+
+
+class NemoSensor(SynchronousSensor):
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.files = dict()  # bytes written to each recent NEMO data file
+
+    def poll(self):
+        super().poll()
+        if self.parent.nemo_manager is not None:
+            self.files = self.parent.nemo_manager.file_stats()
+
+
+class DownlinkQueueSensor(SynchronousSensor):
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.depth = dict()  # priority class name -> downlinks waiting
+        self.age = dict()  # priority class name -> seconds the oldest waiting downlink has been queued
+        self.queued = dict()  # priority class name -> downlinks queued since boot
+        self.replaced = dict()  # priority class name -> downlinks replaced by a newer one before being sent
+
+    def poll(self):
+        super().poll()
+        if self.parent.downlink_queue is not None:
+            for name, (depth, age, queued, replaced) in self.parent.downlink_queue.stats().items():
+                self.depth[name] = depth
+                self.age[name] = age
+                self.queued[name] = queued
+                self.replaced[name] = replaced
+
+
 class OpNavSensor(SynchronousSensor):
     def __init__(self, parent):
         super().__init__(parent)
@@ -178,11 +222,13 @@ class Telemetry(SynchronousSensor):
         self.rpi = PiSensor(parent)
         self.rtc = RtcSensor(parent)
         self.opn = OpNavSensor(parent)
+        self.rad = RadioSensor(parent)
+        self.nem = NemoSensor(parent)
+        self.dlq = DownlinkQueueSensor(parent)
 
-        self.sensors = [self.gom, self.gyr, self.prs, self.thm, self.rpi, self.rtc]
+        self.sensors = [self.gom, self.gyr, self.prs, self.thm, self.rpi, self.rtc, self.rad, self.nem, self.dlq]
 
-        create_session = create_sensor_tables_from_path(DB_FILE)
-        self.session = create_session()
+        self.writer = TelemetryWriter(DB_FILE)
 
     def poll(self):
         # polls every sensor for the latest telemetry that can be accessed
@@ -272,77 +318,76 @@ class Telemetry(SynchronousSensor):
                 'prs_pressure': self.prs.pressure}
 
     def write_telem(self):
-        try:
-            time_polled = time()
-            gx, gy, gz = GyroSensor.get_rot()  # rot
-            ax, ay, az = GyroSensor.get_acc()  # acc
-            bx, by, bz = GyroSensor.get_mag()  # mag
-
-            telemetry_data = TelemetryModel(
-                time_polled=time_polled,
-                GOM_vboost1=self.gom.hk.vboost[0],
-                GOM_vboost2=self.gom.hk.vboost[1],
-                GOM_vboost3=self.gom.hk.vboost[2],
-                GOM_vbatt=self.gom.hk.vbatt,
-                GOM_curin1=self.gom.hk.curin[0],
-                GOM_curin2=self.gom.hk.curin[1],
-                GOM_curin3=self.gom.hk.curin[2],
-                GOM_cursun=self.gom.hk.cursun,
-                GOM_cursys=self.gom.hk.cursys,
-                GOM_reserved1=self.gom.hk.reserved1,
-                GOM_curout1=self.gom.hk.curout[0],
-                GOM_curout2=self.gom.hk.curout[1],
-                GOM_curout3=self.gom.hk.curout[2],
-                GOM_curout4=self.gom.hk.curout[3],
-                GOM_curout5=self.gom.hk.curout[4],
-                GOM_curout6=self.gom.hk.curout[5],
-                # TODO figure out if this is just one or array
-                # GOM_outputs = Column(Integer),
-                GOM_latchup1=self.gom.hk.latchup[0],
-                GOM_latchup2=self.gom.hk.latchup[1],
-                GOM_latchup3=self.gom.hk.latchup[2],
-                GOM_latchup4=self.gom.hk.latchup[3],
-                GOM_latchup5=self.gom.hk.latchup[4],
-                GOM_latchup6=self.gom.hk.latchup[5],
-                GOM_wdt_i2c_time_left=self.gom.hk.wdt_i2c_time_left,
-                GOM_wdt_gnd_time_left=self.gom.hk.wdt_gnd_time_left,
-                GOM_counter_wdt_i2c=self.gom.hk.counter_wdt_i2c,
-                GOM_counter_wdt_gnd=self.gom.hk.counter_wdt_gnd,
-                GOM_counter_boot=self.gom.hk.counter_boot,
-                GOM_bootcause=self.gom.hk.bootcause,
-                GOM_battmode=self.gom.hk.battmodeColumn,
-                GOM_temp1=self.gom.hk.temp[0],
-                GOM_temp2=self.gom.hk.temp[1],
-                GOM_temp3=self.gom.hk.temp[2],
-                GOM_temp4=self.gom.hk.temp[3],
-                GOM_pptmode=self.gom.hk.pptmode,
-                GOM_reserved2=self.gom.hk.reserved2,
-                RTC_measurement_taken=self.rtc.rtc_time,
-                RPI_cpu=self.cpu,
-                RPI_ram=self.ram,
-                RPI_dsk=self.disk,
-                RPI_tmp=self.tmp,
-                RPI_boot=self.boot_time,
-                RPI_uptime=self.up_time,
-                GYRO_gyr_x=gx,
-                GYRO_gyr_y=gy,
-                GYRO_gyr_z=gz,
-                GYRO_acc_x=ax,
-                GYRO_acc_y=ay,
-                GYRO_acc_z=az,
-                GYRO_mag_x=bx,
-                GYRO_mag_y=by,
-                GYRO_mag_z=bz,
-                GYRO_temperature=self.gyr.tmp,
-                THERMOCOUPLE_pressure=self.thm.tmp,
-                PRESSURE_pressure=self.pressure
-            )
-            self.session.add(telemetry_data)
-            self.session.commit()
-
-        finally:
-            pass
-
+        """Queues the latest polled telemetry for the database. The sample is written by self.writer in a batch
+        with other samples, so this never waits on the SD card"""
+        gx, gy, gz = self.gyr.get_rot()  # rot
+        ax, ay, az = self.gyr.get_acc()  # acc
+        bx, by, bz = self.gyr.get_mag()  # mag
+        hk = self.gom.hk
+
+        return self.writer.write(dict(
+            time_polled=datetime.fromtimestamp(time()),
+            GOM_vboost1=hk.vboost[0],
+            GOM_vboost2=hk.vboost[1],
+            GOM_vboost3=hk.vboost[2],
+            GOM_vbatt=hk.vbatt,
+            GOM_curin1=hk.curin[0],
+            GOM_curin2=hk.curin[1],
+            GOM_curin3=hk.curin[2],
+            GOM_cursun=hk.cursun,
+            GOM_cursys=hk.cursys,
+            GOM_reserved1=hk.reserved1,
+            GOM_curout1=hk.curout[0],
+            GOM_curout2=hk.curout[1],
+            GOM_curout3=hk.curout[2],
+            GOM_curout4=hk.curout[3],
+            GOM_curout5=hk.curout[4],
+            GOM_curout6=hk.curout[5],
+            # TODO figure out if this is just one or array
+            # GOM_outputs = Column(Integer),
+            GOM_latchup1=hk.latchup[0],
+            GOM_latchup2=hk.latchup[1],
+            GOM_latchup3=hk.latchup[2],
+            GOM_latchup4=hk.latchup[3],
+            GOM_latchup5=hk.latchup[4],
+            GOM_latchup6=hk.latchup[5],
+            GOM_wdt_i2c_time_left=hk.wdt_i2c_time_left,
+            GOM_wdt_gnd_time_left=hk.wdt_gnd_time_left,
+            GOM_counter_wdt_i2c=hk.counter_wdt_i2c,
+            GOM_counter_wdt_gnd=hk.counter_wdt_gnd,
+            GOM_counter_boot=hk.counter_boot,
+            GOM_bootcause=hk.bootcause,
+            GOM_battmode=hk.battmode,
+            GOM_temp1=hk.temp[0],
+            GOM_temp2=hk.temp[1],
+            GOM_temp3=hk.temp[2],
+            GOM_temp4=hk.temp[3],
+            GOM_pptmode=hk.pptmode,
+            GOM_reserved2=hk.reserved2,
+            RTC_measurement_taken=datetime.utcfromtimestamp(self.rtc.rtc_time),
+            RPI_cpu=self.rpi.cpu,
+            RPI_ram=self.rpi.ram,
+            RPI_dsk=self.rpi.disk,
+            RPI_tmp=self.rpi.tmp,
+            RPI_boot=self.rpi.boot_time,
+            RPI_uptime=self.rpi.up_time,
+            GYRO_gyr_x=gx,
+            GYRO_gyr_y=gy,
+            GYRO_gyr_z=gz,
+            GYRO_acc_x=ax,
+            GYRO_acc_y=ay,
+            GYRO_acc_z=az,
+            GYRO_mag_x=bx,
+            GYRO_mag_y=by,
+            GYRO_mag_z=bz,
+            GYRO_temperature=self.gyr.tmp,
+            THERMOCOUPLE_pressure=self.thm.tmp,
+            PRESSURE_pressure=self.prs.pressure
+        ))
+
+    def close(self):
+        """Writes any telemetry still queued for the database"""
+        self.writer.close()
 
     def query_telem(self):
         # FIXME
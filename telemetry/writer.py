@@ -0,0 +1,110 @@
+from collections import deque
+from threading import Condition, Lock, Thread
+from time import time
+
+from utils.db import TelemetryModel, SQLAlchemyTableBase, create_wal_engine
+from utils.constants import DB_FILE, TELEM_DB_SYNCHRONOUS
+from utils.log import get_log
+import utils.parameters as params
+
+logger = get_log()
+
+
+class TelemetryWriter:
+    """Batched database sink for telemetry samples.
+    write() only appends the sample to an in-memory ring buffer; a background thread inserts the buffered samples
+    in a single transaction once [batch_size] samples are waiting or [flush_interval] seconds have passed.
+    When the buffer is full the oldest sample is dropped and counted.
+    [path]: database url, the SQLite database is opened in WAL mode
+    [model]: declarative model whose table the samples (dicts of column name -> value) are inserted into
+    [capacity], [batch_size], [flush_interval]: default to the TELEM_* parameters"""
+
+    def __init__(self, path: str = DB_FILE, model=TelemetryModel, capacity: int = None, batch_size: int = None,
+                 flush_interval: float = None, synchronous: str = TELEM_DB_SYNCHRONOUS):
+        self.engine = create_wal_engine(path, synchronous)
+        SQLAlchemyTableBase.metadata.create_all(self.engine, tables=[model.__table__])
+        self.insert = model.__table__.insert()
+
+        capacity = params.TELEM_BUFFER_SIZE if capacity is None else capacity
+        self.batch_size = params.TELEM_WRITE_BATCH_SIZE if batch_size is None else batch_size
+        self.flush_interval = params.TELEM_WRITE_INTERVAL if flush_interval is None else flush_interval
+
+        self.buffer = deque(maxlen=capacity)
+        self._cond = Condition()
+        self._flush_lock = Lock()  # keeps batches in order when close() and the writer thread flush together
+        self._thread = None
+        self._closing = False
+
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        self.last_flush = None
+
+    def write(self, sample: dict):
+        """Queues one sample for the database. Returns False if the oldest queued sample had to be dropped"""
+        with self._cond:
+            if self._closing:
+                raise RuntimeError("TelemetryWriter is closed")
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="TelemetryWriter", daemon=True)
+                self._thread.start()
+            full = len(self.buffer) == self.buffer.maxlen
+            if full:
+                self.dropped += 1
+            self.buffer.append(sample)
+            if len(self.buffer) >= self.batch_size:
+                self._cond.notify()
+        return not full
+
+    def flush(self):
+        """Writes every queued sample in one transaction. Returns the number of samples written"""
+        with self._flush_lock:
+            with self._cond:
+                batch = list(self.buffer)
+                self.buffer.clear()
+            if not batch:
+                return 0
+            try:
+                with self.engine.begin() as connection:
+                    connection.execute(self.insert, batch)
+            except Exception as e:
+                with self._cond:
+                    self.dropped += len(batch)
+                logger.error(f"Failed to write {len(batch)} telemetry samples: {e}")
+                return 0
+            with self._cond:
+                self.written += len(batch)
+                self.batches += 1
+                self.last_flush = time()
+            return len(batch)
+
+    def close(self):
+        """Stops the writer thread after writing every queued sample"""
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        self.flush()
+        self.engine.dispose()
+        stats = self.stats()
+        logger.info(f"Telemetry writer closed: {stats['written']} samples written, {stats['dropped']} dropped")
+
+    def stats(self):
+        """Returns the number of samples queued, dropped, written and the number of batches written"""
+        with self._cond:
+            return {"queued": len(self.buffer),
+                    "dropped": self.dropped,
+                    "written": self.written,
+                    "batches": self.batches,
+                    "last_flush": self.last_flush}
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._closing or len(self.buffer) >= self.batch_size,
+                                    timeout=self.flush_interval)
+                if self._closing:
+                    return
+            self.flush()
@@ -0,0 +1,148 @@
+import os
+from concurrent.futures import Future
+from threading import Timer
+from types import SimpleNamespace
+
+from communications.bulk_downlink import BulkDownlinkManager, BulkReassembler, segments_from_bitmap
+from communications.downlink import DownlinkHandler, DownlinkQueue
+from flight_modes.flight_mode import CommsMode
+from utils.constants import FMEnum, NormalCommandEnum, BULK_SEGMENT_SIZE, SEGMENT_DATA
+
+
+def make_file(tmp_path, size):
+    path = tmp_path / "lores_rate_data_test"
+    data = os.urandom(size)
+    path.write_bytes(data)
+    return str(path), data
+
+
+def drain(bulk, dh, receiver, drop=()):
+    sent = 0
+    while True:
+        downlink = bulk.next_segment(sent)
+        if downlink is None:
+            return sent
+        assert len(downlink) <= 255  # one AX5043 packet
+        mac, counter, mode, downlink_id, kwargs = dh.unpack_downlink(downlink)
+        assert (mode, downlink_id) == (FMEnum.Normal.value, NormalCommandEnum.BulkSegment.value)
+        if sent not in drop:
+            receiver.add(kwargs)
+        sent += 1
+
+
+class TestBulkDownlink:
+    def test_transfer_with_retransmit(self, tmp_path):
+        dh = DownlinkHandler()
+        bulk = BulkDownlinkManager(dh, str(tmp_path / "bulk.json"))
+        path, data = make_file(tmp_path, 10 * BULK_SEGMENT_SIZE + 17)
+        transfer = bulk.offer(path)
+        assert transfer.segment_count == 11
+
+        receiver = BulkReassembler(transfer.file_id)
+        assert drain(bulk, dh, receiver, drop={2, 7}) == 11
+        assert not bulk.pending()
+        assert receiver.missing() == [2, 7]
+
+        base_seq, bitmap = receiver.retransmit_bitmap()
+        assert segments_from_bitmap(base_seq, bitmap)[:2] == [2, 7]
+        bulk.retransmit(transfer.file_id, base_seq, bitmap)
+        assert drain(bulk, dh, receiver) == 2
+
+        assert receiver.complete() and receiver.data() == data
+        bulk.complete(transfer.file_id)
+        assert not bulk.transfers
+
+    def test_corrupted_segment_is_rejected(self, tmp_path):
+        dh = DownlinkHandler()
+        bulk = BulkDownlinkManager(dh, str(tmp_path / "bulk.json"))
+        path, data = make_file(tmp_path, 100)
+        transfer = bulk.offer(path)
+        kwargs = dh.unpack_downlink(bulk.next_segment(0))[4]
+        kwargs[SEGMENT_DATA] = bytes([kwargs[SEGMENT_DATA][0] ^ 0xFF]) + kwargs[SEGMENT_DATA][1:]
+
+        receiver = BulkReassembler(transfer.file_id)
+        assert not receiver.add(kwargs)
+        assert receiver.corrupted == 1 and not receiver.complete()
+
+    def test_resume_after_reboot(self, tmp_path):
+        dh = DownlinkHandler()
+        state_file = str(tmp_path / "bulk.json")
+        bulk = BulkDownlinkManager(dh, state_file)
+        path, data = make_file(tmp_path, 5 * BULK_SEGMENT_SIZE)
+        transfer = bulk.offer(path)
+        receiver = BulkReassembler(transfer.file_id)
+        for counter in range(3):
+            receiver.add(dh.unpack_downlink(bulk.next_segment(counter))[4])
+        bulk.save()
+        bulk.close()
+
+        rebooted = BulkDownlinkManager(dh, state_file)
+        assert rebooted.pending()
+        assert drain(rebooted, dh, receiver) == 2
+        assert receiver.data() == data
+        assert rebooted.offer(path).file_id != transfer.file_id
+
+
+class FakeRadio:
+    """Completes each transmission 10 ms after the previous one, failing the ones in [fail]"""
+
+    def __init__(self, events, fail=()):
+        self.events = events
+        self.fail = fail
+        self.sent = []
+
+    def transmit(self, downlink):
+        future = Future()
+        index = len(self.sent)
+        self.sent.append(downlink)
+
+        def complete():
+            self.events.append("sent")
+            if index in self.fail:
+                future.set_exception(RuntimeError("FIFO error"))
+            else:
+                future.set_result(len(downlink))
+        Timer(0.01 * len(self.sent), complete).start()
+        return future
+
+
+class FakeGom:
+    def __init__(self, events):
+        self.events = events
+
+    def is_electrolyzing(self):
+        return False
+
+    def set_PA(self, on):
+        self.events.append(f"PA {'on' if on else 'off'}")
+
+    def rf_receiving_switch(self, receive):
+        pass
+
+    def rf_transmitting_switch(self, receive):
+        pass
+
+    def lna(self, on):
+        pass
+
+
+class TestCommsMode:
+    def test_pa_stays_on_until_every_downlink_is_sent(self, tmp_path):
+        path, _ = make_file(tmp_path, 3 * BULK_SEGMENT_SIZE)
+        dh = DownlinkHandler()
+        bulk = BulkDownlinkManager(dh, state_file=str(tmp_path / "bulk_state.json"))
+        bulk.offer(path)
+        events = []
+        parent = SimpleNamespace(downlink_queue=DownlinkQueue(), bulk_downlink=bulk, downlink_counter=0,
+                                 radio=FakeRadio(events, fail={1, 5}), ip_comms=None, gom=FakeGom(events))
+        parent.downlink_queue.put(dh.pack_downlink(0, FMEnum.Normal.value, NormalCommandEnum.SetParam.value,
+                                                   successful=True))
+        mode = CommsMode(parent)
+
+        mode.run_mode()
+
+        # the queued downlink and the three segments
+        assert len(parent.radio.sent) == parent.downlink_counter == 4
+        assert events == ["PA on"] + ["sent"] * 4 + ["PA off"]
+        assert os.path.isfile(bulk.state_file)
+        assert mode.wait_for_downlinks([parent.radio.transmit(b"x"), parent.radio.transmit(b"y")]) == 1
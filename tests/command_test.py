@@ -1,9 +1,18 @@
+import struct
+from queue import Empty
+from types import SimpleNamespace
+
 from pytest import raises
 
+from communications.ax5043_manager.link_metrics import LinkMetrics, Metric, STATES, FIFO_BINS
+from communications.command_definitions import CommandDefinitions
 from communications.commands import CommandHandler
-from utils.struct import unpack_double, pack_double
-from utils.exceptions import SerializationException
-from utils.constants import MAC
+from communications.downlink import DownlinkHandler, DownlinkQueue
+from telemetry.telemetry import DownlinkQueueSensor
+from utils.struct import unpack_double, pack_double, pack_str, pack_unsigned_short
+from utils.exceptions import SerializationException, CommandPackingException, CommandUnpackingException
+from utils.constants import MAC, FMEnum, NormalCommandEnum, TestCommandEnum, DownlinkPriority
+from utils.constants import SUCCESSFUL, NAME, VALUE, HARD_SET, DATA_OFFSET, DATA_LEN_OFFSET
 
 
 class TestCommandHandler:
@@ -53,6 +62,129 @@ class TestCommandHandler:
         assert unpacked_counter == command_counter
         assert unpacked_mac == MAC
 
+    def test_fixed_size_command_is_one_struct(self):
+        ch = CommandHandler()
+        codec = ch.codecs[FMEnum.Normal.value][NormalCommandEnum.ACSPulsing.value]
+        assert codec.struct is not None and codec.struct.size == ch.get_command_size(
+            FMEnum.Normal.value, NormalCommandEnum.ACSPulsing.value)
+
+    def test_string_command_serialization(self):
+        ch = CommandHandler()
+        mode, command_id = FMEnum.Normal.value, NormalCommandEnum.SetParam.value
+        kwargs = {NAME: "TELEM_DOWNLINK_TIME", VALUE: 2.5, HARD_SET: True}
+
+        command_buffer = ch.pack_command(0x123456, mode, command_id, **kwargs)
+
+        assert len(command_buffer) == ch.get_command_size(mode, command_id)
+        # the string is length prefixed, the arguments after it follow directly and the rest is zero
+        payload = bytearray(len(command_buffer) - DATA_OFFSET)
+        offset = pack_str(payload, 0, kwargs[NAME])
+        offset += pack_double(payload, offset, kwargs[VALUE])
+        payload[offset] = 1
+        assert command_buffer[DATA_OFFSET:] == payload
+        assert ch.unpack_command(command_buffer) == (MAC, 0x123456, mode, command_id, kwargs)
+
+        with raises(CommandPackingException):
+            ch.pack_command(1, mode, command_id, **{NAME: "x" * 40, VALUE: 2.5, HARD_SET: True})
+        with raises(CommandPackingException):
+            ch.pack_command(1, mode, command_id, **{NAME: "x", VALUE: 2.5})
+
+    def test_parse_command_wraps_buffer(self):
+        ch = CommandHandler()
+        mode, command_id = FMEnum.Normal.value, NormalCommandEnum.SetParam.value
+        kwargs = {NAME: "OPNAV_INTERVAL", VALUE: 30.0, HARD_SET: False}
+        received = bytearray(ch.pack_command(5, mode, command_id, **kwargs))
+
+        frame = ch.parse_command(received)
+        assert frame.decode() is frame
+
+        assert frame.data.obj is received  # no copy of the received buffer
+        assert (frame.mac, frame.counter, frame.mode, frame.command_id) == (MAC, 5, mode, command_id)
+        assert frame.kwargs == kwargs
+        assert frame.kwargs is frame.kwargs  # decoded once
+        assert ch.parse_command(frame) is frame
+        assert ch.unpack_command(frame) == (MAC, 5, mode, command_id, kwargs)
+        assert bytes(frame) == received
+
+        with raises(CommandUnpackingException):
+            ch.parse_command(received[:-1])
+
+
+class TestDownlinkHandler:
+    def test_telemetry_downlink_matches_field_packers(self):
+        dh = DownlinkHandler()
+        mode, downlink_id = FMEnum.Normal.value, NormalCommandEnum.BasicTelem.value
+        args, size = dh.downlink_dict[mode][downlink_id]
+        kwargs = {arg: i for i, arg in enumerate(args)}
+
+        downlink = dh.pack_downlink(7, mode, downlink_id, **kwargs)
+
+        payload = bytearray(size)
+        offset = 0
+        for arg in args:
+            offset += dh.packers[arg](payload, offset, kwargs[arg])
+        assert len(downlink) == DATA_OFFSET + size
+        assert downlink[DATA_OFFSET:] == payload
+        header = bytearray(2)
+        pack_unsigned_short(header, 0, size)
+        assert downlink[DATA_LEN_OFFSET:DATA_OFFSET] == header
+        assert dh.unpack_downlink(downlink) == (MAC, 7, mode, downlink_id, kwargs)
+
+    def test_radio_metrics_downlink(self):
+        metrics = LinkMetrics(clock=lambda: 0.0)
+        metrics.count(Metric.RX_PACKETS, 3)
+        metrics.fifo_level(200)
+        metrics.sample_rx(-67, 40, -2)
+        metrics.sample_rx(-71, 42, 2)
+        telemetry = SimpleNamespace(rad=SimpleNamespace(metrics=metrics.snapshot()))
+        kwargs = CommandDefinitions(SimpleNamespace(telemetry=telemetry)).gather_radio_metrics()
+
+        dh = DownlinkHandler()
+        downlink = dh.pack_downlink(1, FMEnum.Normal.value, NormalCommandEnum.RadioMetrics.value, **kwargs)
+        unpacked = dh.unpack_downlink(downlink)[4]
+        assert unpacked["rx_packets"] == 3
+        assert unpacked["rssi"] == -69.0
+        assert struct.unpack(">%dI" % len(STATES), unpacked["state_time"]) == (0,) * len(STATES)
+        assert struct.unpack(">%dI" % FIFO_BINS, unpacked["fifo_fill"])[6] == 1
+
+
+
+class TestDownlinkQueue:
+    def telem(self, dh, counter):
+        args, _ = dh.downlink_dict[FMEnum.Normal.value][NormalCommandEnum.BasicTelem.value]
+        return dh.pack_downlink(counter, FMEnum.Normal.value, NormalCommandEnum.BasicTelem.value,
+                                **{arg: counter for arg in args})
+
+    def test_telemetry_is_coalesced_and_acks_jump_ahead(self):
+        dh = DownlinkHandler()
+        fake_time = [0.0]
+        queue = DownlinkQueue(clock=lambda: fake_time[0])
+        first, second = self.telem(dh, 1), self.telem(dh, 2)
+        ack = dh.pack_downlink(3, FMEnum.Normal.value, NormalCommandEnum.SetParam.value, **{SUCCESSFUL: True})
+        other = dh.pack_downlink(4, FMEnum.TestMode.value, TestCommandEnum.CommsDriver.value, gyro1=0., gyro2=0., gyro3=0.)
+
+        assert not queue.put(first, DownlinkPriority.Telemetry, coalesce=True)
+        queue.put(other)
+        fake_time[0] = 5.0
+        assert queue.put(second, DownlinkPriority.Telemetry, coalesce=True)
+        queue.put(ack, DownlinkPriority.Ack)
+        fake_time[0] = 7.0
+
+        assert queue.qsize() == 3
+        stats = queue.stats()
+        assert stats["Telemetry"] == (1, 2.0, 2, 1)
+        assert stats["Normal"] == (1, 7.0, 1, 0)
+        sensor = DownlinkQueueSensor(SimpleNamespace(downlink_queue=queue))
+        sensor.poll()
+        assert (sensor.depth["Telemetry"], sensor.age["Normal"], sensor.replaced["Telemetry"]) == (1, 7.0, 1)
+        assert [queue.get() for _ in range(3)] == [ack, second, other]
+        assert queue.empty()
+        with raises(Empty):
+            queue.get()
+
+        # once the old packet has been sent, the next one is queued again rather than replacing anything
+        assert not queue.put(first, DownlinkPriority.Telemetry, coalesce=True)
+
 
 tch = TestCommandHandler()
 tch.test_packers_unpackers_match()
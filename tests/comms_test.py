@@ -1,7 +1,23 @@
-from time import sleep
+from time import sleep, monotonic
 
 from queue import Queue
-from communications.comms_driver import CommunicationsSystem
+from communications.comms_driver import CommunicationsSystem, AsyncIPComms, LinkSimulator
+
+
+def wait_for(condition, timeout=5):
+    start = monotonic()
+    while not condition() and monotonic() - start < timeout:
+        sleep(0.01)
+    return condition()
+
+
+def link_pair(satellite_queue, link=None, max_backlog=1024):
+    """Returns (ground, satellite) ends sending to each other"""
+    ground = AsyncIPComms(queue=Queue(), server_port=5010, client_port=5011, link=link)
+    satellite = AsyncIPComms(queue=satellite_queue, server_port=5011, client_port=5010, max_backlog=max_backlog)
+    ground.listen()
+    satellite.listen()
+    return ground, satellite
 
 
 class TestIPCommunicationsSystem:
@@ -37,3 +53,68 @@ class TestIPCommunicationsSystem:
             assert (
                 data_packet == q.get()
             ), "Data packet received does not match what was sent"
+
+
+class TestAsyncIPComms:
+    def test_high_packet_rate(self):
+        q = Queue()
+        ground, satellite = link_pair(q)
+        try:
+            packets = [i.to_bytes(4, "big") * 8 for i in range(2000)]
+            for packet in packets:
+                ground.send_packet(packet)
+            assert wait_for(lambda: q.qsize() == len(packets))
+            assert [q.get() for _ in packets] == packets
+            assert ground.stats()["sent"] == len(packets)
+        finally:
+            ground.stop()
+            satellite.stop()
+
+    def test_simulated_latency_and_loss(self):
+        q = Queue()
+        ground, satellite = link_pair(q, link=LinkSimulator(latency=0.3, loss=0.25, seed=1))
+        try:
+            for i in range(100):
+                ground.send_packet(bytes([i]))
+            sleep(0.1)
+            assert q.empty(), "Packets arrived before the link latency"
+            lost = ground.stats()["lost"]
+            assert 0 < lost < 50
+            assert wait_for(lambda: q.qsize() == 100 - lost)
+        finally:
+            ground.stop()
+            satellite.stop()
+
+    def test_backpressure_into_full_queue(self):
+        q = Queue(maxsize=5)
+        ground, satellite = link_pair(q)
+        try:
+            for i in range(50):
+                ground.send_packet(bytes([i]))
+            assert wait_for(lambda: satellite.stats()["received"] > 5)
+            assert q.full() and satellite.reading_paused
+            received = []
+            while len(received) < 50:
+                received.append(q.get(timeout=5))
+            assert received == [bytes([i]) for i in range(50)]
+            assert satellite.stats()["dropped"] == 0
+        finally:
+            ground.stop()
+            satellite.stop()
+
+    def test_receiver_and_transmit_futures(self):
+        received = []
+        ground = AsyncIPComms(queue=Queue(), server_port=5012, client_port=5013)
+        satellite = AsyncIPComms(receiver=received.append, server_port=5013, client_port=5012)
+        ground.listen()
+        satellite.listen()
+        try:
+            futures = [satellite.transmit(bytes([i]) * 10) for i in range(3)]
+            assert [future.result(timeout=5) for future in futures] == [10, 10, 10]
+            assert wait_for(lambda: ground.queue.qsize() == 3)
+            ground.send_packet(b"command")
+            assert wait_for(lambda: received == [b"command"])
+        finally:
+            ground.stop()
+            satellite.stop()
+        assert isinstance(satellite.transmit(b"late").exception(timeout=5), RuntimeError)
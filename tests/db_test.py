@@ -1,6 +1,9 @@
 import datetime
+import numpy as np
+from sqlalchemy import create_engine, text
 
 from utils.db import create_sensor_tables_from_path, PressureModel
+from utils.db import OpNavTrajectoryStateModel, OpNavAttitudeStateModel, COVARIANCE_COLUMNS
 
 MEMORY_DB_PATH = "sqlite://"
 
@@ -35,3 +38,44 @@ def test_pressure_model():
     last_measurement = pressure_measurements[0]
     assert last_measurement.measurement_taken == measurement_taken
     assert last_measurement.pressure == pressure
+
+
+def test_state_covariance_round_trip():
+    create_session = create_sensor_tables_from_path(MEMORY_DB_PATH)
+    session = create_session()
+    time = datetime.datetime.now()
+    P = np.arange(36, dtype=float).reshape(6, 6) * 1e-3
+
+    session.add(OpNavTrajectoryStateModel.from_tuples((1., 2., 3.), (4., 5., 6.), P, time))
+    session.add(OpNavAttitudeStateModel.from_tuples((0., 0., 0., 1.), (0., 0., 0.), (0., 0., 0.), P.T, time))
+    session.commit()
+    session.close()
+
+    session = create_session()
+    traj = session.query(OpNavTrajectoryStateModel).one()
+    att = session.query(OpNavAttitudeStateModel).one()
+    assert traj.covariance.shape == (6, 6) and np.array_equal(traj.covariance, P)
+    assert np.array_equal(att.covariance, P.T)
+    session.close()
+
+
+def test_legacy_covariance_columns_are_migrated(tmp_path):
+    path = "sqlite:///" + str(tmp_path / "legacy.sqlite")
+    engine = create_engine(path)
+    P = np.random.default_rng(0).normal(size=(6, 6))
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE opnav_trajectory_state (id INTEGER PRIMARY KEY, time_retrieved DATETIME, "
+            "position_x FLOAT, position_y FLOAT, position_z FLOAT, velocity_x FLOAT, velocity_y FLOAT, velocity_z FLOAT, "
+            + ", ".join(f"{c} FLOAT" for c in COVARIANCE_COLUMNS) + ")"))
+        connection.execute(text(
+            f"INSERT INTO opnav_trajectory_state (id, position_x, {', '.join(COVARIANCE_COLUMNS)}) "
+            f"VALUES (1, 7.0, {', '.join(repr(v) for v in P.reshape(36))})"))
+    engine.dispose()
+
+    create_session = create_sensor_tables_from_path(path)
+    session = create_session()
+    entry = session.query(OpNavTrajectoryStateModel).one()
+    assert entry.position_x == 7.0
+    assert np.array_equal(entry.covariance, P)
+    session.close()
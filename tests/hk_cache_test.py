@@ -0,0 +1,86 @@
+from drivers.power.hk_cache import HkCache, TransactionCounter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def counting_reader(name, reads):
+    def read():
+        reads.append(name)
+        return f"{name}#{reads.count(name)}"
+    return read
+
+
+class TestHkCache:
+    def setup_method(self):
+        self.clock = FakeClock()
+        self.reads = []
+        self.cache = HkCache({"eps": counting_reader("eps", self.reads),
+                              "out": counting_reader("out", self.reads),
+                              "config": counting_reader("config", self.reads)},
+                             {"eps": 4.0, "out": 1.0}, clock=self.clock)
+
+    def test_serves_from_memory_until_max_age(self):
+        assert self.cache.get("eps") == "eps#1"
+        self.clock.now += 3.0
+        assert self.cache.get("eps") == "eps#1"
+        assert self.cache.age("eps") == 3.0
+        self.clock.now += 1.5
+        assert self.cache.get("eps") == "eps#2"
+        assert self.cache.reads["eps"] == 2 and self.cache.hits["eps"] == 1
+
+    def test_each_level_has_its_own_max_age(self):
+        self.cache.get("eps")
+        self.cache.get("out")
+        self.clock.now += 2.0
+        self.cache.get("eps")
+        self.cache.get("out")
+        assert self.reads == ["eps", "out", "out"]
+
+    def test_caller_max_age_and_forced_read(self):
+        self.cache.get("eps")
+        self.clock.now += 2.0
+        assert self.cache.get("eps", max_age=10) == "eps#1"
+        assert self.cache.get("eps", max_age=1) == "eps#2"
+        assert self.cache.get("eps", max_age=0) == "eps#3"
+
+    def test_levels_without_max_age_are_always_read(self):
+        self.cache.get("config")
+        self.cache.get("config")
+        assert self.reads == ["config", "config"]
+
+    def test_invalidate(self):
+        self.cache.get("eps")
+        self.cache.get("out")
+        self.cache.invalidate("out")
+        assert self.cache.age("out") is None
+        self.cache.get("eps")
+        self.cache.get("out")
+        self.cache.invalidate()
+        self.cache.get("eps")
+        assert self.reads == ["eps", "out", "out", "eps"]
+
+    def test_unknown_level(self):
+        try:
+            self.cache.get("bogus")
+        except KeyError:
+            pass
+        else:
+            assert False, "expected KeyError"
+
+
+class TestTransactionCounter:
+    def test_counts_the_last_minute(self):
+        clock = FakeClock()
+        counter = TransactionCounter(clock=clock)
+        for _ in range(5):
+            counter.count()
+            clock.now += 20.0
+        # transactions at 100, 120, 140, 160, 180; now 200
+        assert counter.per_minute() == 2
+        assert counter.total == 5
@@ -0,0 +1,128 @@
+import os
+from threading import Thread
+
+import pytest
+
+pytest.importorskip("pigpio")  # drivers.nemo needs the Raspberry Pi GPIO library
+
+from drivers.nemo.util import RotatingFileManager  # noqa: E402
+
+T0 = 1617000000 - 1617000000 % 3600  # start of an hour
+
+
+class FakeClock:
+    def __init__(self, now=T0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def on_disk(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def make_files(tmp_path, clock, period=3600, buffer_size=4096, flush_period=600):
+    return RotatingFileManager(str(tmp_path / "rate_data"), period, buffer_size=buffer_size,
+                               flush_period=flush_period, clock=clock)
+
+
+class TestRotatingFileManager:
+    def test_rotates_on_period_boundaries(self, tmp_path):
+        clock = FakeClock(T0 + 10)
+        files = make_files(tmp_path, clock)
+        files.write(b"a")
+        first = files.current_fname
+        assert first == str(tmp_path / "rate_data_20210329T060000Z")
+
+        clock.now = T0 + 3599
+        files.write(b"b")
+        assert files.current_fname == first
+
+        clock.now = T0 + 3600
+        files.write(b"c")
+        assert files.current_fname == str(tmp_path / "rate_data_20210329T070000Z")
+        files.close()
+        assert open(first, "rb").read() == b"ab"
+
+    def test_period_change_starts_a_new_file(self, tmp_path):
+        clock = FakeClock(T0 + 1800)
+        files = make_files(tmp_path, clock)
+        files.write(b"a")
+        files.period = 600
+        files.write(b"b")
+        assert files.current_fname == str(tmp_path / "rate_data_20210329T063000Z")
+        assert [size for _, size in files.sizes()] == [1, 1]
+        files.close()
+
+    def test_writes_are_buffered_until_the_flush_period(self, tmp_path):
+        clock = FakeClock()
+        files = make_files(tmp_path, clock)
+        files.write(b"x" * 100)
+        assert on_disk(files.current_fname) == 0
+
+        clock.now = T0 + 599
+        files.flush_if_due()
+        assert on_disk(files.current_fname) == 0
+
+        clock.now = T0 + 600
+        files.flush_if_due()
+        assert on_disk(files.current_fname) == 100
+
+        # the next flush is due flush_period after this one, whether it comes from write() or flush_if_due()
+        files.write(b"x" * 100)
+        clock.now = T0 + 1199
+        files.write(b"x")
+        assert on_disk(files.current_fname) == 100
+        clock.now = T0 + 1200
+        files.write(b"x")
+        assert on_disk(files.current_fname) == 202
+        files.close()
+
+    def test_full_buffer_is_written_before_the_flush_period(self, tmp_path):
+        files = make_files(tmp_path, FakeClock(), buffer_size=64)
+        files.write(b"x" * 100)
+        assert on_disk(files.current_fname) == 100
+        files.close()
+
+    def test_shorter_flush_period_applies_to_buffered_data(self, tmp_path):
+        clock = FakeClock()
+        files = make_files(tmp_path, clock)
+        files.write(b"x" * 10)
+        files.flush_period = 60
+        clock.now = T0 + 60
+        files.flush_if_due()
+        assert on_disk(files.current_fname) == 10
+        files.close()
+
+    def test_bytes_written_continues_files_and_keeps_recent_history(self, tmp_path):
+        clock = FakeClock()
+        files = make_files(tmp_path, clock, period=60)
+        files.write(b"x" * 10)
+        files.close()
+        files.write(b"x" * 5)  # appending to the same file after a restart
+        assert files.sizes() == [(files.current_fname, 15)]
+
+        for i in range(1, RotatingFileManager.FILE_HISTORY + 5):
+            clock.now = T0 + 60 * i
+            files.write(b"x" * i)
+        sizes = files.sizes()
+        assert len(sizes) == RotatingFileManager.FILE_HISTORY
+        assert sizes[-1] == (files.current_fname, RotatingFileManager.FILE_HISTORY + 4)
+        files.close()
+
+    def test_sizes_can_be_read_while_another_thread_rotates(self, tmp_path):
+        clock = FakeClock()
+        files = make_files(tmp_path, clock, period=1, flush_period=0)
+
+        def writer():
+            for i in range(500):
+                clock.now = T0 + i
+                files.write(b"x")
+
+        thread = Thread(target=writer)
+        thread.start()
+        while thread.is_alive():
+            assert len(files.sizes()) <= RotatingFileManager.FILE_HISTORY
+        thread.join()
+        files.close()
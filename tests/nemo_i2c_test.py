@@ -0,0 +1,126 @@
+import errno
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("pigpio")  # drivers.nemo needs the Raspberry Pi GPIO library
+
+from drivers.nemo.nemo import I2CTransactionFailure, Nemo  # noqa: E402
+
+
+class FakeBus:
+    """
+    busio.I2C stand-in serving a NEMO register map. REG_RATE is a FIFO that empties as it is read,
+    other reads continue at the next address. fail_at makes that transaction raise OSError(fail_errno).
+    """
+
+    def __init__(self, registers=None, fifo=b'', fail_at=None, fail_errno=errno.EREMOTEIO):
+        self.registers = bytearray(registers if registers is not None else bytes(256))
+        self.fifo = bytearray(fifo)
+        self.fail_at = fail_at
+        self.fail_errno = fail_errno
+        self.locked = False
+        self.locks = 0
+        self.transactions = []  # (register address, bytes read)
+
+    def try_lock(self):
+        if self.locked:
+            return False
+        self.locked = True
+        self.locks += 1
+        return True
+
+    def unlock(self):
+        assert self.locked
+        self.locked = False
+
+    def writeto_then_readfrom(self, address, buffer_out, buffer_in, *, in_start=0, in_end=None):
+        assert self.locked and address == 0x13 and len(buffer_out) == 1
+        if in_end is None:
+            in_end = len(buffer_in)
+        size = in_end - in_start
+        assert 0 < size <= Nemo.MAX_READ_SIZE
+        if len(self.transactions) == self.fail_at:
+            raise OSError(self.fail_errno, os.strerror(self.fail_errno))
+        self.transactions.append((buffer_out[0], size))
+
+        reg = buffer_out[0]
+        if reg == Nemo.REG_RATE:
+            data, self.fifo = self.fifo[:size], self.fifo[size:]
+        else:
+            data = self.registers[reg:reg + size]
+        if reg == Nemo.REG_RATE_AVAILABLE_L:
+            data = len(self.fifo).to_bytes(2, 'little')
+        buffer_in[in_start:in_end] = data
+
+
+def make_nemo(bus):
+    nemo = Nemo.__new__(Nemo)  # no reset GPIO or logging
+    nemo._bus = bus
+    nemo._dev_addr = 0x13
+    nemo._log = None
+    return nemo
+
+
+class TestReadRateData:
+    def test_drains_fifo_in_whole_entries(self):
+        fifo = bytes(range(100))
+        bus = FakeBus(fifo=fifo)
+        rates = make_nemo(bus).read_rate_data()
+
+        assert rates.shape == (33, 3)
+        assert rates.tobytes() == fifo[:99]
+        rate_reads = [(reg, size) for reg, size in bus.transactions if reg != Nemo.REG_RATE_AVAILABLE_L]
+        # every transaction reads the FIFO register, a whole number of (det0, det1, veto) entries
+        assert rate_reads == [(Nemo.REG_RATE, 30)] * 3 + [(Nemo.REG_RATE, 9)]
+        assert bus.fifo == fifo[99:]
+        assert not bus.locked
+
+    def test_nothing_available(self):
+        bus = FakeBus()
+        rates = make_nemo(bus).read_rate_data()
+        assert rates.shape == (0, 3)
+        assert bus.transactions == [(Nemo.REG_RATE_AVAILABLE_L, 2)]
+
+    def test_rate_data_lists(self):
+        bus = FakeBus(fifo=bytes([1, 2, 3, 4, 5, 6]))
+        assert make_nemo(bus).rate_data == ([1, 4], [2, 5], [3, 6])
+
+
+class TestReadHistograms:
+    def test_reads_all_bins_in_one_pass(self):
+        registers = np.random.default_rng(0).integers(0, 256, size=256, dtype=np.uint8).tobytes()
+        bus = FakeBus(registers)
+        bins = make_nemo(bus).read_histograms()
+
+        assert bins.shape == (3, 64)
+        assert bins.tobytes() == registers[Nemo.REG_D0_BIN_0:]
+        # consecutive registers, one MAX_READ_SIZE transaction after the other, holding the bus throughout
+        assert bus.transactions == [(Nemo.REG_D0_BIN_0 + start, 32) for start in range(0, 192, 32)]
+        assert bus.locks == 1 and not bus.locked
+
+    def test_veto_bins(self):
+        registers = bytes(range(256))
+        assert make_nemo(FakeBus(registers)).veto_bins == list(registers[Nemo.REG_VETO_BIN_0:])
+
+
+class TestReadFailure:
+    def test_failed_transaction_unlocks_the_bus(self):
+        bus = FakeBus(fail_at=2)
+        nemo = make_nemo(bus)
+        with pytest.raises(I2CTransactionFailure):
+            nemo.read_histograms()
+        assert bus.transactions == [(Nemo.REG_D0_BIN_0, 32), (Nemo.REG_D0_BIN_0 + 32, 32)]
+        assert not bus.locked
+
+        # the bus can be used again
+        bus.fail_at = None
+        assert nemo.read_histograms().shape == (3, 64)
+
+    def test_other_errors_are_raised_as_is(self):
+        bus = FakeBus(fifo=bytes(90), fail_at=1, fail_errno=errno.EIO)
+        with pytest.raises(OSError) as info:
+            make_nemo(bus).read_rate_data()
+        assert info.value.errno == errno.EIO and not isinstance(info.value, I2CTransactionFailure)
+        assert not bus.locked
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("pigpio")  # drivers.nemo needs the Raspberry Pi GPIO library
+
+from drivers.nemo import util  # noqa: E402
+from drivers.nemo.util import (HistogramPacket, LoResHistogramPacket, LoResRateDataPacket,  # noqa: E402
+                               RateDataPacket, SC_TIME_SLACK, _file_start_time)
+
+T0 = 1617000000 - 1617000000 % 3600  # 2021-03-29T06:00:00Z
+
+
+def random_records(packet_class, count, seed=0, sc_time_start=T0):
+    """count packets of random content with increasing sc_time, as a DTYPE array"""
+    rng = np.random.default_rng(seed)
+    raw = rng.integers(0, 256, size=count * packet_class.DTYPE.itemsize, dtype=np.uint8).tobytes()
+    records = np.frombuffer(raw, dtype=packet_class.DTYPE).copy()
+    records['sc_time'] = sc_time_start + 10 * np.arange(count)
+    return records
+
+
+def lores_bytes(lores_class, packet_class, records, decimation_factor):
+    """What the LoRes packet constructor makes from the same records, in groups of decimation_factor"""
+    packets = [packet_class(record.tobytes()) for record in records]
+    return b''.join(bytes(lores_class(packets[i:(i + decimation_factor)]))
+                    for i in range(0, len(packets), decimation_factor))
+
+
+@pytest.mark.parametrize("packet_class,lores_class", [(RateDataPacket, LoResRateDataPacket),
+                                                      (HistogramPacket, LoResHistogramPacket)])
+class TestDecimate:
+    @pytest.mark.parametrize("count,decimation_factor", [(12, 1), (12, 3), (12, 4), (13, 4), (5, 7)])
+    def test_matches_packet_constructor(self, packet_class, lores_class, count, decimation_factor):
+        records = random_records(packet_class, count)
+        lores = lores_class.decimate(records, decimation_factor)
+        assert lores.dtype == lores_class.DTYPE
+        assert len(lores) == -(-count // decimation_factor)  # a smaller last group still makes a record
+        assert lores.tobytes() == lores_bytes(lores_class, packet_class, records, decimation_factor)
+
+    def test_empty_input(self, packet_class, lores_class):
+        lores = lores_class.decimate(np.empty(0, dtype=packet_class.DTYPE), 4)
+        assert len(lores) == 0 and lores.dtype == lores_class.DTYPE
+
+
+def write_records(path, records):
+    path.write_bytes(records.tobytes())
+    return records
+
+
+class TestReadArray:
+    def test_file_start_time(self):
+        assert _file_start_time("/data/rate_data_20210329T060000Z") == T0
+        assert _file_start_time("/data/rate_data") is None
+        assert _file_start_time("/data/rate_data_20210329") is None
+
+    def test_reads_matching_packets_sorted(self, tmp_path):
+        first = write_records(tmp_path / "rate_data_20210329T060000Z", random_records(RateDataPacket, 5))
+        second = write_records(tmp_path / "rate_data_20210329T070000Z",
+                               random_records(RateDataPacket, 5, seed=1, sc_time_start=T0 + 3600))
+        records = RateDataPacket.read_array(str(tmp_path / "rate_data_*"), T0 + 20, T0 + 3620)
+        assert records.dtype == RateDataPacket.DTYPE
+        assert records.tobytes() == first[2:].tobytes() + second[:3].tobytes()
+        assert [bytes(p) for p in RateDataPacket.from_file(str(tmp_path / "rate_data_*"), T0 + 20, T0 + 3620,
+                                                           sort=True)] == [r.tobytes() for r in records]
+
+    def test_files_starting_after_sc_time_max_are_not_read(self, tmp_path):
+        # packets may be timestamped up to SC_TIME_SLACK before the start of the file they land in
+        early = random_records(RateDataPacket, 1, sc_time_start=T0 + 3600 - SC_TIME_SLACK)
+        write_records(tmp_path / "rate_data_20210329T070000Z", early)
+        pattern = str(tmp_path / "rate_data_*")
+        assert len(RateDataPacket.read_array(pattern, sc_time_max=T0 + 3600 - SC_TIME_SLACK)) == 1
+
+        # past the slack the file is skipped by its name alone, even holding packets that would match
+        write_records(tmp_path / "rate_data_20210329T070000Z", random_records(RateDataPacket, 1))
+        assert len(RateDataPacket.read_array(pattern, sc_time_max=T0 + 3600 - SC_TIME_SLACK)) == 1
+        assert len(RateDataPacket.read_array(pattern, sc_time_max=T0 + 3600 - SC_TIME_SLACK - 1)) == 0
+
+    def test_files_ending_before_sc_time_min_are_not_mapped(self, tmp_path, monkeypatch):
+        write_records(tmp_path / "rate_data_20210329T060000Z", random_records(RateDataPacket, 5))
+        mapped = []
+        real_mmap = util.mmap.mmap
+
+        def counting_mmap(*args, **kwargs):
+            mapped.append(args)
+            return real_mmap(*args, **kwargs)
+        monkeypatch.setattr(util.mmap, "mmap", counting_mmap)
+        pattern = str(tmp_path / "rate_data_*")
+
+        assert len(RateDataPacket.read_array(pattern, sc_time_min=T0 + 41)) == 0
+        assert not mapped
+        assert len(RateDataPacket.read_array(pattern, sc_time_min=T0 + 40)) == 1
+        assert len(mapped) == 1
+
+    def test_unrotated_and_partial_files(self, tmp_path):
+        records = random_records(RateDataPacket, 3)
+        (tmp_path / "rate_data").write_bytes(records.tobytes() + b'\x00' * 7)  # trailing partial packet
+        (tmp_path / "rate_data_empty").write_bytes(b'')
+        assert RateDataPacket.read_array(str(tmp_path / "rate_data*")).tobytes() == records.tobytes()
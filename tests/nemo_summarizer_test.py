@@ -0,0 +1,174 @@
+import struct
+from threading import Event, Thread
+
+import numpy as np
+import pytest
+
+pytest.importorskip("pigpio")  # drivers.nemo needs the Raspberry Pi GPIO library
+
+from drivers.nemo.summarizer import Summarizer  # noqa: E402
+from drivers.nemo.util import HistogramPacket, RateDataPacket, SummaryPacket  # noqa: E402
+
+T0 = 1617000000
+
+
+class FakeFile:
+    """Stands in for a RotatingFileManager, keeping what is written"""
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+
+class FakeClock:
+    def __init__(self, now=T0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def rate_packet(sc_time, rates):
+    rates = np.clip(rates, 0, 255).astype(int)
+    return RateDataPacket(struct.pack(RateDataPacket.FORMAT_CODE, sc_time, 1, 0, 0, 0, 0, *rates.flatten()))
+
+
+def histogram_packet(sc_time, bins):
+    return HistogramPacket(struct.pack(HistogramPacket.FORMAT_CODE, sc_time, 1, 0, *np.asarray(bins).flatten()))
+
+
+def poisson_packets(means, count, rng, sc_time_start=T0):
+    """count rate packets of Poisson samples with the given mean per channel, one packet every 20 s"""
+    shape = (3, RateDataPacket.NUM_SAMPLES)
+    return [rate_packet(sc_time_start + 20 * i, rng.poisson(np.array(means)[:, None], size=shape))
+            for i in range(count)]
+
+
+EMPTY_HISTOGRAM = histogram_packet(T0, np.zeros((3, HistogramPacket.NUM_BINS), dtype=int))
+
+
+def make_summarizer(clock=None, **kwargs):
+    files = {name: FakeFile() for name in ('summary_file', 'burst_rate_data_file', 'burst_histogram_file')}
+    return Summarizer(clock=clock or FakeClock(), **files, **kwargs), files
+
+
+def add_all(summarizer, packets):
+    """Index of each packet a change point was detected at, with the channels"""
+    return [(i, changed) for i, packet in enumerate(packets)
+            for changed in [summarizer.add(packet, EMPTY_HISTOGRAM)] if changed]
+
+
+class TestChangeDetection:
+    def test_steady_rates_do_not_alarm(self):
+        # the baseline starts at 0, far from the rates: the warm-up must not take that for a change
+        summarizer, _ = make_summarizer()
+        rng = np.random.default_rng(1)
+        assert add_all(summarizer, poisson_packets([20, 50, 3], 200, rng)) == []
+
+    def test_rate_step_is_detected_once(self):
+        summarizer, _ = make_summarizer()
+        rng = np.random.default_rng(2)
+        packets = poisson_packets([20, 50, 3], 30, rng) + poisson_packets([40, 50, 3], 60, rng, T0 + 600)
+        assert add_all(summarizer, packets) == [(30, ['det0'])]
+
+    def test_rate_drop_is_detected(self):
+        summarizer, _ = make_summarizer()
+        rng = np.random.default_rng(3)
+        packets = poisson_packets([20, 50, 3], 30, rng) + poisson_packets([20, 20, 3], 30, rng, T0 + 600)
+        assert add_all(summarizer, packets) == [(30, ['det1'])]
+
+
+class TestBurst:
+    def test_pre_and_post_packets_are_written(self):
+        summarizer, files = make_summarizer(burst_pre_packets=3, burst_post_packets=2)
+        rng = np.random.default_rng(4)
+        packets = poisson_packets([20, 50, 3], 30, rng) + poisson_packets([80, 50, 3], 10, rng, T0 + 600)
+        histograms = [histogram_packet(p.sc_time, np.full((3, HistogramPacket.NUM_BINS), i % 256))
+                      for i, p in enumerate(packets)]
+
+        triggers = [i for i, (p, h) in enumerate(zip(packets, histograms)) if summarizer.add(p, h)]
+        assert triggers == [30]
+        assert files['burst_rate_data_file'].writes == [bytes(p) for p in packets[27:33]]
+        assert files['burst_histogram_file'].writes == [bytes(h) for h in histograms[27:33]]
+        assert files['summary_file'].writes == []
+
+
+class TestSummary:
+    def test_summary_packet_round_trip(self):
+        clock = FakeClock()
+        summarizer, files = make_summarizer(clock, summary_period=3600, window=100)
+        rng = np.random.default_rng(5)
+        packets = poisson_packets([20, 50, 3], 30, rng) + poisson_packets([60, 50, 3], 10, rng, T0 + 600)
+        bins = np.zeros((3, HistogramPacket.NUM_BINS), dtype=int)
+        bins[0, 5] = 10  # det0 all in bin 5
+        bins[1, [2, 4]] = 1  # det1 split between bins 2 and 4
+        for packet in packets:
+            summarizer.add(packet, histogram_packet(packet.sc_time, bins))
+
+        assert not summarizer.summary_due()
+        clock.now = T0 + 3600
+        assert summarizer.summary_due()
+        packet = summarizer.summarize()
+        assert files['summary_file'].writes == [bytes(packet)]
+        assert not summarizer.summary_due()
+
+        decoded = SummaryPacket(bytes(packet))
+        assert decoded == packet
+        assert decoded.sc_time == T0 + 3600 and decoded.t_start == T0
+        assert decoded.serial_number == 1
+        assert decoded.num_samples == 40 * RateDataPacket.NUM_SAMPLES
+        rates = np.array([p.rate_data for p in packets])
+        assert decoded.rate_max == rates.max(axis=(0, 2)).tolist()
+        assert decoded.rate_mean == pytest.approx(rates.mean(axis=(0, 2)).tolist(), rel=1e-6)
+        # the percentiles are over the last `window` samples: the new det0 rate
+        assert decoded.rate_percentiles[0][1] == pytest.approx(np.median(rates[-5:, 0]))
+        assert decoded.hist_counts == [400, 80, 0]
+        assert decoded.hist_mean == pytest.approx([5, 3, 0])
+        assert decoded.hist_std == pytest.approx([0, 1, 0])
+        assert decoded.change_points == [1, 0, 0]
+        assert decoded.last_change == packets[30].sc_time
+
+        # the next interval starts empty
+        assert SummaryPacket(summarizer).num_samples == 0
+
+
+class BlockingFile(FakeFile):
+    """Holds the writing thread until released"""
+
+    def __init__(self):
+        super().__init__()
+        self.writing = Event()
+        self.release = Event()
+
+    def write(self, data):
+        self.writing.set()
+        self.release.wait(5)
+        super().write(data)
+
+
+class TestThreads:
+    def test_window_change_waits_for_add(self):
+        summarizer, _ = make_summarizer(burst_pre_packets=0, burst_post_packets=0)
+        summarizer._burst_rate_data_file = burst_file = BlockingFile()
+        rng = np.random.default_rng(6)
+        for packet in poisson_packets([20, 50, 3], 30, rng):
+            summarizer.add(packet, EMPTY_HISTOGRAM)
+
+        # the step is written to the burst files from inside add()
+        step = poisson_packets([80, 50, 3], 1, rng, T0 + 600)[0]
+        nemo_thread = Thread(target=summarizer.add, args=(step, EMPTY_HISTOGRAM))
+        nemo_thread.start()
+        assert burst_file.writing.wait(5)
+
+        command_thread = Thread(target=setattr, args=(summarizer, 'window', 10))
+        command_thread.start()
+        command_thread.join(0.1)
+        assert command_thread.is_alive() and summarizer.window == 360
+
+        burst_file.release.set()
+        nemo_thread.join(5)
+        command_thread.join(5)
+        assert summarizer.window == 10
+        assert burst_file.writes == [bytes(step)]
@@ -0,0 +1,88 @@
+import datetime
+from time import monotonic, sleep
+from types import SimpleNamespace
+
+from sqlalchemy import text
+
+import telemetry.telemetry
+from flight_modes.flight_mode import FlightMode
+from telemetry.writer import TelemetryWriter
+from utils.db import TelemetryModel
+
+
+def sample(i):
+    return {"time_polled": datetime.datetime(2021, 1, 1) + datetime.timedelta(seconds=i),
+            "GOM_vbatt": 7000 + i,
+            "PRESSURE_pressure": 15.0}
+
+
+def count_rows(writer):
+    with writer.engine.connect() as connection:
+        return connection.execute(text("SELECT COUNT(*) FROM Telemetry")).scalar()
+
+
+class TestTelemetryWriter:
+    def test_database_is_in_wal_mode(self, tmp_path):
+        writer = TelemetryWriter("sqlite:///" + str(tmp_path / "telem.sqlite"))
+        with writer.engine.connect() as connection:
+            assert connection.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+            assert connection.execute(text("PRAGMA synchronous")).scalar() == 1  # NORMAL
+        writer.close()
+
+    def test_writes_batch_when_size_reached(self, tmp_path):
+        writer = TelemetryWriter("sqlite:///" + str(tmp_path / "telem.sqlite"), batch_size=5, flush_interval=60)
+        for i in range(5):
+            writer.write(sample(i))
+
+        start = monotonic()
+        while writer.stats()["written"] < 5 and monotonic() - start < 5:
+            sleep(0.01)
+
+        stats = writer.stats()
+        assert stats["written"] == 5 and stats["batches"] == 1 and stats["queued"] == 0
+        assert count_rows(writer) == 5
+        writer.close()
+
+    def test_close_flushes_queued_samples(self, tmp_path):
+        path = "sqlite:///" + str(tmp_path / "telem.sqlite")
+        writer = TelemetryWriter(path, batch_size=100, flush_interval=60)
+        for i in range(3):
+            writer.write(sample(i))
+        assert writer.stats()["queued"] == 3
+
+        writer.close()
+
+        assert writer.stats() == {"queued": 0, "dropped": 0, "written": 3, "batches": 1,
+                                  "last_flush": writer.last_flush}
+        reader = TelemetryWriter(path)
+        with reader.engine.connect() as connection:
+            rows = connection.execute(TelemetryModel.__table__.select()).fetchall()
+        assert [row.GOM_vbatt for row in rows] == [7000, 7001, 7002]
+        assert rows[0].time_polled == datetime.datetime(2021, 1, 1)
+        reader.close()
+
+    def test_full_buffer_drops_oldest(self, tmp_path):
+        writer = TelemetryWriter("sqlite:///" + str(tmp_path / "telem.sqlite"), capacity=4, batch_size=100,
+                                 flush_interval=60)
+        results = [writer.write(sample(i)) for i in range(6)]
+
+        assert results == [True, True, True, True, False, False]
+        assert writer.stats()["queued"] == 4 and writer.stats()["dropped"] == 2
+        writer.close()
+        with writer.engine.connect() as connection:
+            vbatt = [row[0] for row in connection.execute(text("SELECT GOM_vbatt FROM Telemetry"))]
+        assert vbatt == [7002, 7003, 7004, 7005]
+
+
+class TestTelemetrySink:
+    def test_flight_mode_writes_telemetry_through_the_writer(self, tmp_path, monkeypatch):
+        path = "sqlite:///" + str(tmp_path / "telem.sqlite")
+        monkeypatch.setattr(telemetry.telemetry, "DB_FILE", path)
+        parent = SimpleNamespace(gom=None, gyro=None, adc=None, rtc=None, radio=None, nemo_manager=None)
+        parent.telemetry = telemetry.telemetry.Telemetry(parent)
+
+        FlightMode(parent).write_telemetry()
+        parent.telemetry.close()
+
+        assert parent.telemetry.writer.stats()["written"] == 1
+        assert count_rows(parent.telemetry.writer) == 1
@@ -0,0 +1,168 @@
+import os
+import socket
+from queue import Queue
+from time import sleep, monotonic
+from types import SimpleNamespace
+
+from communications.command_queue_writer import write_command
+from communications.commands import CommandHandler
+from communications.comms_driver import AsyncIPComms
+from communications.transport import (TransportMultiplexer, LoopbackTransport, IPTransport, CommandFileTransport,
+                                      RadioTransport, build_transports, ip_transport)
+
+
+def wait_for(condition, timeout=5):
+    start = monotonic()
+    while not condition() and monotonic() - start < timeout:
+        sleep(0.01)
+    return condition()
+
+
+def receiver():
+    """Returns (handler, received) where received collects (frame, transport name)"""
+    received = []
+    return lambda frame, transport: received.append((frame, transport.name)), received
+
+
+class TestTransportMultiplexer:
+    def test_loopback_frames_are_handled_in_order(self):
+        handler, received = receiver()
+        mux = TransportMultiplexer(handler)
+        loopback = LoopbackTransport()
+        mux.add(loopback)
+        for i in range(3):
+            loopback.send(bytes([i]))
+        assert mux.run_once(timeout=0) == 3
+        assert received == [(b"\x00", "loopback"), (b"\x01", "loopback"), (b"\x02", "loopback")]
+        mux.stop()
+
+    def test_waits_on_all_transports_at_once(self, tmp_path):
+        handler, received = receiver()
+        mux = TransportMultiplexer(handler)
+        ip = IPTransport(AsyncIPComms(server_port=5020, client_port=5021))
+        command_file = CommandFileTransport(str(tmp_path / "command_queue.txt"))
+        mux.add(ip)
+        mux.add(command_file)
+        mux.start()
+        try:
+            with open(command_file.path, "a") as f:
+                f.write("0102\n")
+            sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sender.sendto(b"datagram", ("127.0.0.1", 5020))
+            sender.close()
+            assert wait_for(lambda: len(received) == 2)
+            assert sorted(received) == [(b"\x01\x02", "command file"), (b"datagram", "ip")]
+        finally:
+            mux.stop()
+
+    def test_handler_errors_do_not_stop_the_multiplexer(self):
+        received = []
+
+        def handler(frame, transport):
+            if frame == b"bad":
+                raise ValueError(frame)
+            received.append(frame)
+
+        mux = TransportMultiplexer(handler)
+        loopback = LoopbackTransport()
+        mux.add(loopback)
+        mux.start()
+        try:
+            loopback.send(b"bad")
+            loopback.send(b"good")
+            assert wait_for(lambda: received == [b"good"])
+        finally:
+            mux.stop()
+
+
+class TestCommandFileTransport:
+    def test_reads_partial_lines_when_complete(self, tmp_path):
+        handler, received = receiver()
+        mux = TransportMultiplexer(handler)
+        command_file = CommandFileTransport(str(tmp_path / "command_queue.txt"))
+        mux.add(command_file)
+        fd = os.open(command_file.path, os.O_WRONLY)
+        try:
+            os.write(fd, b"ab")
+            mux.run_once(timeout=1)
+            assert received == []
+            os.write(fd, b"cd\nzz\n")
+            mux.run_once(timeout=1)
+            assert received == [(b"\xab\xcd", "command file")]  # the malformed line is logged and dropped
+        finally:
+            os.close(fd)
+            mux.stop()
+
+    def test_commands_left_in_a_plain_file_are_read_at_startup(self, tmp_path):
+        path = tmp_path / "command_queue.txt"
+        packed = CommandHandler().pack_command(1, 2, 1)
+        path.write_text(packed.hex() + "\n")
+        handler, received = receiver()
+        mux = TransportMultiplexer(handler)
+        mux.add(CommandFileTransport(str(path)))
+        mux.run_once(timeout=0)
+        assert received == [(bytes(packed), "command file")]
+        mux.stop()
+
+    def test_commands_written_while_stopped_are_read_at_the_next_start(self, tmp_path):
+        path = str(tmp_path / "command_queue.txt")
+        handler, received = receiver()
+        mux = TransportMultiplexer(handler)
+        mux.add(CommandFileTransport(path))
+        write_command(path, b"\x01")
+        mux.run_once(timeout=1)
+        mux.stop()
+        assert received == [(b"\x01", "command file")]
+        assert not os.path.exists(path)
+
+        # with no reader the writer neither blocks nor leaves a pipe behind
+        write_command(path, b"\x02")
+        os.mkfifo(str(tmp_path / "stale"))
+        write_command(str(tmp_path / "stale"), b"\x03")
+        assert open(path).read() == "02\n" and open(tmp_path / "stale").read() == "03\n"
+
+        mux = TransportMultiplexer(handler)
+        mux.add(CommandFileTransport(path))
+        mux.run_once(timeout=0)
+        mux.stop()
+        assert received[1:] == [(b"\x02", "command file")]
+
+
+class TestRadioTransport:
+    def test_delivers_packets_from_the_manager_outbox(self):
+        radio = SimpleNamespace(mgr=SimpleNamespace(outbox=Queue(), rx_enabled=False))
+        handler, received = receiver()
+        mux = TransportMultiplexer(handler)
+        mux.add(RadioTransport(radio))
+        mux.start()
+        try:
+            assert radio.mgr.rx_enabled
+            radio.mgr.outbox.put(bytearray(b"packet"))
+            assert wait_for(lambda: received == [(b"packet", "radio")])
+        finally:
+            mux.stop()
+
+    def test_build_transports_skips_missing_radio(self, tmp_path):
+        parent = SimpleNamespace(radio=None, command_file=str(tmp_path / "command_queue.txt"), ip_comms=None)
+        assert [transport.name for transport in build_transports(parent)] == ["command file"]
+
+
+class TestIPTransport:
+    def test_commands_in_and_downlinks_out(self):
+        ground = AsyncIPComms(queue=Queue(), server_port=5023, client_port=5022)
+        parent = SimpleNamespace(radio=None, command_file=None, ip_comms=AsyncIPComms(server_port=5022,
+                                                                                   client_port=5023))
+        transports = build_transports(parent, [ip_transport])
+        handler, received = receiver()
+        mux = TransportMultiplexer(handler)
+        mux.add(transports[0])
+        mux.start()
+        ground.listen()
+        try:
+            ground.send_packet(b"command")
+            assert wait_for(lambda: received == [(b"command", "ip")])
+            assert parent.ip_comms.transmit(b"downlink").result(timeout=5) == 8
+            assert ground.queue.get(timeout=5) == b"downlink"
+        finally:
+            mux.stop()
+            ground.stop()
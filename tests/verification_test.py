@@ -0,0 +1,61 @@
+import os
+from time import perf_counter
+from types import SimpleNamespace
+
+import pytest
+
+from communications.command_definitions import CommandDefinitions, verification_blocks
+from communications.downlink import DownlinkHandler, DownlinkQueue
+from utils.constants import a, b, M, team_identifier, NUM_BLOCKS, VERIFICATION_BLOCK, VERIFICATION_BLOCK_SIZE
+
+
+def reference_block(sequence_num, timestamp):
+    """Block as built by the original verification(), field by field"""
+    seconds = int(timestamp)
+    header = (team_identifier.to_bytes(4, 'big') + sequence_num.to_bytes(4, 'big') + seconds.to_bytes(4, 'big')
+              + int((timestamp - seconds) * (10 ** 6)).to_bytes(4, 'big'))
+    x = team_identifier ^ seconds ^ sequence_num
+    data_field = bytes()
+    for _ in range(128 // 4):
+        x = (a * x + b) % M
+        data_field += x.to_bytes(4, 'big')
+    return header + data_field
+
+
+def fixed_clock(start=1617000000.25, step=0.5):
+    times = iter(start + step * i for i in range(10 ** 6))
+    return lambda: next(times)
+
+
+def generation_time(num_blocks):
+    start = perf_counter()
+    for _ in verification_blocks(num_blocks, clock=fixed_clock()):
+        pass
+    return perf_counter() - start
+
+
+class TestVerification:
+    def test_blocks_match_reference(self):
+        blocks = list(verification_blocks(5, clock=fixed_clock()))
+        assert all(len(block) == VERIFICATION_BLOCK_SIZE for block in blocks)
+        assert blocks == [reference_block(i, 1617000000.25 + 0.5 * i) for i in range(5)]
+
+    def test_blocks_are_queued_as_downlinks(self):
+        dh = DownlinkHandler()
+        parent = SimpleNamespace(downlink_handler=dh, downlink_queue=DownlinkQueue(), downlink_counter=0)
+        CommandDefinitions(parent).verification(**{NUM_BLOCKS: 3})
+
+        assert parent.downlink_queue.qsize() == 3
+        for sequence_num in range(3):
+            block = dh.unpack_downlink(parent.downlink_queue.get())[4][VERIFICATION_BLOCK]
+            assert block[4:8] == sequence_num.to_bytes(4, 'big')
+
+    # wall clock ratios are unreliable on shared CI runners, so only run when asked for
+    @pytest.mark.benchmark
+    @pytest.mark.skipif(not os.environ.get("CISLUNAR_BENCHMARKS"), reason="set CISLUNAR_BENCHMARKS=1 to run")
+    def test_generation_scales_linearly(self):
+        # time per block stays flat from hundreds to thousands of blocks
+        generation_time(100)  # warm up
+        small = min(generation_time(250) for _ in range(3)) / 250
+        large = min(generation_time(4000) for _ in range(3)) / 4000
+        assert large < 3 * small
@@ -89,6 +89,10 @@ T_STOP = "t_stop"
 
 DECIMATION_FACTOR = "decimation_factor"
 
+FILE_ID = "file_id"
+SEGMENT_SEQ = "segment_seq"
+RETRANSMIT_BITMAP = "retransmit_bitmap"
+
 # Keyword argument definitions for downlink
 RTC_TIME = "rtc_time"
 
@@ -120,6 +124,31 @@ PROP_TANK_PRESSURE = "prs_pressure"
 
 SUCCESSFUL = "successful"
 
+SEGMENT_COUNT = "segment_count"
+SEGMENT_CRC = "segment_crc"
+SEGMENT_DATA = "segment_data"
+FILE_SIZE = "file_size"
+VERIFICATION_BLOCK = "verification_block"
+
+# AX5043 link metrics, named as in LinkMetrics.snapshot()
+RADIO_TX_PACKETS = "tx_packets"
+RADIO_TX_BYTES = "tx_bytes"
+RADIO_TX_FAILURES = "tx_failures"
+RADIO_RX_PACKETS = "rx_packets"
+RADIO_RX_BYTES = "rx_bytes"
+RADIO_RX_CRC_ERRORS = "rx_crc_errors"
+RADIO_RX_LENGTH_ERRORS = "rx_length_errors"
+RADIO_RX_FIFO_ERRORS = "rx_fifo_errors"
+RADIO_STATE_TIME = "state_time"  # seconds in each manager state, big endian uint32 per state
+RADIO_FIFO_FILL = "fifo_fill"  # FIFO fill level histogram, big endian uint32 per bin
+RADIO_RSSI = "rssi"  # means over the last received packets
+RADIO_BGND_RSSI = "bgnd_rssi"
+RADIO_RF_FREQ_OFFSET = "rf_freq_offset"
+
+# Bulk downlink
+BULK_SEGMENT_SIZE = 200  # data bytes per segment, keeps a segment frame inside one AX5043 packet
+BULK_BITMAP_SIZE = 32  # bytes of retransmit bitmap, one bit per segment
+
 # SQL Stuff
 SQL_PREFIX = "sqlite:///"
 CISLUNAR_BASE_DIR = os.path.join(
@@ -128,11 +157,24 @@ CISLUNAR_BASE_DIR = os.path.join(
 LOG_DIR = os.path.join(CISLUNAR_BASE_DIR, "logs")
 DB_FILE = SQL_PREFIX + os.path.join(CISLUNAR_BASE_DIR, "satellite-db.sqlite")
 NEMO_DIR = os.path.join(CISLUNAR_BASE_DIR, "nemo")
+OPNAV_REMAP_DIR = os.path.join(CISLUNAR_BASE_DIR, "opnav_remap")
+BULK_STATE_FILE = os.path.join(CISLUNAR_BASE_DIR, "bulk_downlink.json")
+# Named pipe that command_queue_writer.py writes hex commands to (relative to the repo root)
+COMMAND_FILE = "communications/command_queue.txt"
+# UDP stand-in for the radio (AsyncIPComms), for load testing the command and downlink path. Never enabled in flight
+IP_COMMS_ENABLED = False
+IP_COMMS_PORT = 5000  # port the flight software receives commands on
+IP_COMMS_GROUND_HOST = "127.0.0.1"  # ground station simulator downlinks are sent to
+IP_COMMS_GROUND_PORT = 5001
+TELEM_DB_SYNCHRONOUS = "NORMAL"  # SQLite synchronous level for the telemetry writer
 
 a = 1664525
 b = 1013904223
 M = 2 ** 32
 team_identifier = 0xEB902D2D  # Team 2
+VERIFICATION_PRN_WORDS = 128 // 4  # 32 bit PRN words in the data field of a verification block
+VERIFICATION_HEADER_SIZE = 16  # team identifier, sequence number, seconds, microseconds
+VERIFICATION_BLOCK_SIZE = VERIFICATION_HEADER_SIZE + 4 * VERIFICATION_PRN_WORDS
 
 # TODO: validate these values:
 SPLIT_BURNWIRE_DURATION = 1  # second
@@ -146,6 +188,33 @@ NO_FM_CHANGE = -1
 
 GOM_TIMING_FUDGE_FACTOR = 3  # milliseconds
 
+# Main loop scheduler activities. Periods and deadlines in seconds
+# (deadline = how long after becoming due an activity may wait before it has to start)
+WDT_ACTIVITY = "wdt_tick"
+TELEMETRY_ACTIVITY = "telemetry_poll"
+COMMANDS_ACTIVITY = "commands"
+MODE_ACTIVITY = "mode"
+
+WDT_TICK_PERIOD = 5.0
+WDT_TICK_DEADLINE = 2.0
+TELEMETRY_POLL_PERIOD = 5.0
+TELEMETRY_POLL_DEADLINE = 5.0
+COMMANDS_PERIOD = 1.0
+COMMANDS_DEADLINE = 0.1
+MODE_PERIOD = 5.0
+MODE_DEADLINE = 5.0
+
+# Seconds each Gomspace housekeeping struct is served from memory before it is read again
+# (see drivers/power/hk_cache.py). Structs without a max age (config, config2) are always read
+GOM_HK_MAX_AGE = {
+    "default": 60.0,
+    "eps": 4.0,  # under TELEMETRY_POLL_PERIOD, so every telemetry poll reads it
+    "vi": 4.0,
+    "out": 1.0,
+    "wdt": 30.0,
+    "basic": 60.0,
+}
+
 # Gyro specific constants
 # TODO: make sure that we change this to 500 if need be
 GYRO_RANGE = 250  # degrees per second
@@ -219,6 +288,11 @@ class NormalCommandEnum(IntEnum):
     NemoReboot = 22
     NemoProcessRateData = 23
     NemoProcessHistograms = 24
+    BulkSegment = 25  # downlink: one segment of a bulk transfer
+    BulkDownlinkFile = 26  # arg = path of the file relative to CISLUNAR_BASE_DIR; acknowledged by a downlink
+    BulkRetransmit = 27  # args = file id, first segment and bitmap of the segments to send again
+    BulkComplete = 28  # arg = file id of a transfer the ground station has fully received
+    RadioMetrics = 29  # no args, downlinks the AX5043 link metrics
 
 
 @unique
@@ -305,3 +379,12 @@ class CommandCommandEnum(IntEnum):
     GomGeneralCmd = 7
     GeneralCmd = 8
     CeaseComms = 170
+
+
+# Downlink queue priority classes, lowest value is transmitted first
+@unique
+class DownlinkPriority(IntEnum):
+    Critical = 0  # faults and anything that must reach the ground before the next pass ends
+    Ack = 1  # acknowledgements of received commands
+    Telemetry = 2  # periodic telemetry, coalesced so only the newest packet of each kind is kept
+    Normal = 3
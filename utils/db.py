@@ -1,9 +1,10 @@
 from numpy.testing._private.utils import measure
 from sys import float_repr_style
-from sqlalchemy import Column, Integer, String, create_engine
+import numpy as np
+from sqlalchemy import Column, Integer, String, create_engine, event, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.types import Float, DateTime, Boolean
+from sqlalchemy.types import Float, DateTime, Boolean, LargeBinary, TypeDecorator
 from sqlalchemy.dialects import postgresql
 
 from OpticalNavigation.core.const import CameraMeasurementVector
@@ -17,6 +18,33 @@ SQLAlchemyTableBase = declarative_base()
 # NOTE do not use foreign key in any of these tables
 # TODO implement Model classes for all sensor data to be stored
 
+# Layout of the covariance BLOB: 36 little-endian float64 values, row major
+COVARIANCE_DTYPE = np.dtype("<f8")
+COVARIANCE_SHAPE = (6, 6)
+# Legacy covariance columns r1c1...r6c6, row major
+COVARIANCE_COLUMNS = [f"r{r}c{c}" for r in range(1, 7) for c in range(1, 7)]
+
+
+class CovarianceMatrixType(TypeDecorator):
+    """6x6 covariance matrix stored as a single BLOB of 36 little-endian float64 values.
+    Values are decoded with np.frombuffer, so reads return a read-only (6, 6) view of the row's bytes"""
+
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        matrix = np.asarray(value, dtype=COVARIANCE_DTYPE)
+        if matrix.shape != COVARIANCE_SHAPE:
+            raise ValueError(f"Covariance matrix must be {COVARIANCE_SHAPE}, got {matrix.shape}")
+        return matrix.tobytes()
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return np.frombuffer(value, dtype=COVARIANCE_DTYPE).reshape(COVARIANCE_SHAPE)
+
 
 class CommandModel(SQLAlchemyTableBase):
     __tablename__ = "commands"
@@ -77,13 +105,8 @@ class OpNavTrajectoryStateModel(SQLAlchemyTableBase):
     velocity_x = Column(Float)
     velocity_y = Column(Float)
     velocity_z = Column(Float)
-    # Covariance Matrix
-    r1c1, r1c2, r1c3, r1c4, r1c5, r1c6 = Column(Float), Column(Float), Column(Float), Column(Float), Column(Float), Column(Float)
-    r2c1, r2c2, r2c3, r2c4, r2c5, r2c6 = Column(Float), Column(Float), Column(Float), Column(Float), Column(Float), Column(Float)
-    r3c1, r3c2, r3c3, r3c4, r3c5, r3c6 = Column(Float), Column(Float), Column(Float), Column(Float), Column(Float), Column(Float)
-    r4c1, r4c2, r4c3, r4c4, r4c5, r4c6 = Column(Float), Column(Float), Column(Float), Column(Float), Column(Float), Column(Float)
-    r5c1, r5c2, r5c3, r5c4, r5c5, r5c6 = Column(Float), Column(Float), Column(Float), Column(Float), Column(Float), Column(Float)
-    r6c1, r6c2, r6c3, r6c4, r6c5, r6c6 = Column(Float), Column(Float), Column(Float), Column(Float), Column(Float), Column(Float)
+    # Covariance Matrix (6x6)
+    covariance = Column(CovarianceMatrixType)
 
     """
     Create an OpNavTrajectoryStateModel instance
@@ -106,12 +129,7 @@ class OpNavTrajectoryStateModel(SQLAlchemyTableBase):
             position_x=position_x,
             position_y=position_y,
             position_z=position_z,
-            r1c1 = P[0,0], r1c2 = P[0,1], r1c3 = P[0,2], r1c4 = P[0,3], r1c5 = P[0,4], r1c6 = P[0,5],
-            r2c1 = P[1,0], r2c2 = P[1,1], r2c3 = P[1,2], r2c4 = P[1,3], r2c5 = P[1,4], r2c6 = P[1,5],
-            r3c1 = P[2,0], r3c2 = P[2,1], r3c3 = P[2,2], r3c4 = P[2,3], r3c5 = P[2,4], r3c6 = P[2,5],
-            r4c1 = P[3,0], r4c2 = P[3,1], r4c3 = P[3,2], r4c4 = P[3,3], r4c5 = P[3,4], r4c6 = P[3,5],
-            r5c1 = P[4,0], r5c2 = P[4,1], r5c3 = P[4,2], r5c4 = P[4,3], r5c5 = P[4,4], r5c6 = P[4,5],
-            r6c1 = P[5,0], r6c2 = P[5,1], r6c3 = P[5,2], r6c4 = P[5,3], r6c5 = P[5,4], r6c6 = P[5,5],
+            covariance=P,
         )
 
     def __repr__(self):
@@ -120,7 +138,7 @@ class OpNavTrajectoryStateModel(SQLAlchemyTableBase):
             f", velocity=({self.velocity_x}, {self.velocity_y}, "
             f"{self.velocity_z}), position=({self.position_x}, "
             f"{self.position_y}, {self.position_z}), "
-            f"covariance matrix trace=({self.r1c1+self.r2c2+self.r3c3+self.r4c4+self.r5c5+self.r6c6}))>"
+            f"covariance matrix trace=({np.trace(self.covariance) if self.covariance is not None else None}))>"
         )
 
 class OpNavAttitudeStateModel(SQLAlchemyTableBase):
@@ -138,13 +156,8 @@ class OpNavAttitudeStateModel(SQLAlchemyTableBase):
     b1 = Column(Float)
     b2 = Column(Float)
     b3 = Column(Float)
-    # Covariance Matrix
-    r1c1, r1c2, r1c3, r1c4, r1c5, r1c6 = Column(Float), Column(Float), Column(Float), Column(Float), Column(Float), Column(Float)
-    r2c1, r2c2, r2c3, r2c4, r2c5, r2c6 = Column(Float), Column(Float), Column(Float), Column(Float), Column(Float), Column(Float)
-    r3c1, r3c2, r3c3, r3c4, r3c5, r3c6 = Column(Float), Column(Float), Column(Float), Column(Float), Column(Float), Column(Float)
-    r4c1, r4c2, r4c3, r4c4, r4c5, r4c6 = Column(Float), Column(Float), Column(Float), Column(Float), Column(Float), Column(Float)
-    r5c1, r5c2, r5c3, r5c4, r5c5, r5c6 = Column(Float), Column(Float), Column(Float), Column(Float), Column(Float), Column(Float)
-    r6c1, r6c2, r6c3, r6c4, r6c5, r6c6 = Column(Float), Column(Float), Column(Float), Column(Float), Column(Float), Column(Float)
+    # Covariance Matrix (6x6)
+    covariance = Column(CovarianceMatrixType)
 
     """
     Create an OpNavAttitudeStateModel instance
@@ -171,12 +184,7 @@ class OpNavAttitudeStateModel(SQLAlchemyTableBase):
             b1=b1,
             b2=b2,
             b3=b3,
-            r1c1 = P[0,0], r1c2 = P[0,1], r1c3 = P[0,2], r1c4 = P[0,3], r1c5 = P[0,4], r1c6 = P[0,5],
-            r2c1 = P[1,0], r2c2 = P[1,1], r2c3 = P[1,2], r2c4 = P[1,3], r2c5 = P[1,4], r2c6 = P[1,5],
-            r3c1 = P[2,0], r3c2 = P[2,1], r3c3 = P[2,2], r3c4 = P[2,3], r3c5 = P[2,4], r3c6 = P[2,5],
-            r4c1 = P[3,0], r4c2 = P[3,1], r4c3 = P[3,2], r4c4 = P[3,3], r4c5 = P[3,4], r4c6 = P[3,5],
-            r5c1 = P[4,0], r5c2 = P[4,1], r5c3 = P[4,2], r5c4 = P[4,3], r5c5 = P[4,4], r5c6 = P[4,5],
-            r6c1 = P[5,0], r6c2 = P[5,1], r6c3 = P[5,2], r6c4 = P[5,3], r6c5 = P[5,4], r6c6 = P[5,5],
+            covariance=P,
         )
 
     def __repr__(self):
@@ -185,7 +193,7 @@ class OpNavAttitudeStateModel(SQLAlchemyTableBase):
             f", quaternion=({self.q1}, {self.q2}, {self.q3}, {self.q4}), "
             f"rodriguez_params=({self.r1}, {self.r2}, {self.r3}), "
             f"baises=({self.b1}, {self.b2}, {self.b3}), "
-            f"covariance matrix trace=({self.r1c1+self.r2c2+self.r3c3+self.r4c4+self.r5c5+self.r6c6}))>"
+            f"covariance matrix trace=({np.trace(self.covariance) if self.covariance is not None else None}))>"
         )
 
 class OpNavEphemerisModel(SQLAlchemyTableBase):
@@ -615,11 +623,57 @@ class TelemetryModel(SQLAlchemyTableBase):
     PRESSURE_pressure = Column(Float)
 
 
+def migrate_covariance_columns(engine):
+    """Moves the covariance matrices of databases created before the covariance BLOB column
+    from the 36 r#c# columns into the covariance column. The legacy columns are left in place (unused)
+    Returns the number of migrated rows"""
+    migrated = 0
+    inspector = inspect(engine)
+    for model in [OpNavTrajectoryStateModel, OpNavAttitudeStateModel]:
+        table = model.__tablename__
+        if not inspector.has_table(table):
+            continue
+        columns = {column["name"] for column in inspector.get_columns(table)}
+        if "r1c1" not in columns:
+            continue
+        with engine.begin() as connection:
+            if "covariance" not in columns:
+                connection.execute(text(f"ALTER TABLE {table} ADD COLUMN covariance BLOB"))
+            rows = connection.execute(text(
+                f"SELECT id, {', '.join(COVARIANCE_COLUMNS)} FROM {table} "
+                f"WHERE covariance IS NULL AND r1c1 IS NOT NULL"
+            )).fetchall()
+            if not rows:
+                continue
+            matrices = np.array([row[1:] for row in rows], dtype=COVARIANCE_DTYPE)
+            connection.execute(
+                text(f"UPDATE {table} SET covariance = :covariance WHERE id = :id"),
+                [{"id": row[0], "covariance": matrix.tobytes()} for row, matrix in zip(rows, matrices)],
+            )
+            migrated += len(rows)
+    return migrated
+
+
 def create_sensor_tables(engine):
     SQLAlchemyTableBase.metadata.create_all(engine)
+    migrate_covariance_columns(engine)
     create_session.configure(bind=engine)
     return create_session
 
 def create_sensor_tables_from_path(path: str):
     engine = create_engine(path)
     return create_sensor_tables(engine)
+
+
+def create_wal_engine(path: str, synchronous: str = "NORMAL"):
+    """Creates an engine whose SQLite connections use write-ahead logging, so that telemetry writes do not block
+    readers, and the given [synchronous] level (NORMAL only fsyncs at WAL checkpoints instead of every commit)"""
+    engine = create_engine(path)
+    if engine.dialect.name == "sqlite":
+        @event.listens_for(engine, "connect")
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute(f"PRAGMA synchronous={synchronous}")
+            cursor.close()
+    return engine
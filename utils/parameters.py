@@ -1,5 +1,3 @@
-DOWNLINK_BUFFER_TIME = 3
-
 TELEM_DOWNLINK_TIME = .5
     
 BOOTUP_SEPARATION_DELAY = 30.0  # seconds
@@ -32,3 +30,11 @@ ACS_SPIKE_DURATION = 15  # milliseconds
 WANT_TO_ELECTROLYZE = False
 
 DEFAULT_ELECTROLYSIS_DELAY = 1
+
+OPNAV_DETECTION_WORKERS = 4
+OPNAV_DETECTION_MEMORY_CAP = 256  # MB of frames held by the detection stage at once
+
+TELEM_BUFFER_SIZE = 1000  # samples held in memory before the oldest are dropped
+TELEM_WRITE_BATCH_SIZE = 50  # samples written to the database per transaction
+TELEM_WRITE_INTERVAL = 60  # seconds, longest a sample waits before being written
+BULK_SEGMENTS_PER_PASS = 20  # bulk transfer segments sent each time CommsMode runs
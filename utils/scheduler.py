@@ -0,0 +1,178 @@
+from queue import Queue
+from threading import Event, Lock
+from time import monotonic
+
+from utils.log import get_log
+
+logger = get_log()
+
+
+class Activity:
+    """A periodic piece of work run by the Scheduler.
+    [name]: unique name used to release the activity and in timing reports
+    [func]: callable (no arguments) that does the work
+    [period]: seconds between periodic releases of the activity
+    [deadline]: seconds after release by which the activity must have started; defaults to [period]"""
+
+    def __init__(self, name: str, func, period: float, deadline: float = None):
+        self.name = name
+        self.func = func
+        self.period = period
+        self.deadline = period if deadline is None else deadline
+
+        self.next_release = float("-inf")  # run on the first iteration
+        self.released_at = None  # set when released early by new input
+
+        # timing statistics
+        self.runs = 0
+        self.deadline_misses = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.last_runtime = 0.0
+        self.max_runtime = 0.0
+
+    def release_time(self, now: float):
+        """Returns the time this activity became due, or None if it is not due at [now]"""
+        if self.released_at is not None:
+            return min(self.released_at, self.next_release)
+        if now >= self.next_release:
+            return self.next_release
+        return None
+
+    def run(self, release: float, clock):
+        """Runs the activity and returns (latency, runtime) in seconds"""
+        start = clock()
+        self.released_at = None
+        try:
+            self.func()
+        finally:
+            end = clock()
+            latency = start - release if release != float("-inf") else 0.0
+            runtime = end - start
+
+            self.runs += 1
+            self.last_latency = latency
+            self.max_latency = max(self.max_latency, latency)
+            self.last_runtime = runtime
+            self.max_runtime = max(self.max_runtime, runtime)
+            if latency > self.deadline:
+                self.deadline_misses += 1
+                logger.warning(f"Activity {self.name} missed its deadline: started {latency:.3f}s after release "
+                               f"(deadline {self.deadline:.3f}s)")
+
+            # next periodic release; skip missed periods instead of running them back to back
+            self.next_release = max(self.next_release, start) + self.period
+            if self.next_release <= end:
+                self.next_release = end + self.period
+        return latency, runtime
+
+
+class Scheduler:
+    """Deadline based scheduler for the main loop.
+    Each iteration sleeps until the earliest activity release or until woken by new input,
+    then runs every due activity in the order the activities were added."""
+
+    def __init__(self, clock=monotonic):
+        self.clock = clock
+        self.activities = []
+        self._activity_dict = {}
+        self._wakeup = Event()
+        self._lock = Lock()
+        self.running = False
+
+        self.iterations = 0
+        self.last_report = {}
+
+    def add_activity(self, name: str, func, period: float, deadline: float = None) -> Activity:
+        if name in self._activity_dict:
+            raise ValueError(f"Activity {name} is already scheduled")
+        activity = Activity(name, func, period, deadline)
+        self.activities.append(activity)
+        self._activity_dict[name] = activity
+        return activity
+
+    def get_activity(self, name: str) -> Activity:
+        return self._activity_dict[name]
+
+    def release(self, name: str):
+        """Makes the named activity due immediately and wakes the scheduler. Safe to call from any thread"""
+        activity = self._activity_dict.get(name)
+        with self._lock:
+            if activity is not None and activity.released_at is None:
+                activity.released_at = self.clock()
+        self._wakeup.set()
+
+    def wakeup(self):
+        """Wakes the scheduler so that it re-evaluates which activities are due"""
+        self._wakeup.set()
+
+    def time_until_next_release(self) -> float:
+        now = self.clock()
+        with self._lock:
+            if any(activity.released_at is not None for activity in self.activities):
+                return 0.0
+        if not self.activities:
+            return None
+        return max(0.0, min(activity.next_release for activity in self.activities) - now)
+
+    def run_once(self):
+        """Waits for the next due activity (or new input) and runs all due activities.
+        Returns the timing report of the iteration"""
+        wait_start = self.clock()
+        timeout = self.time_until_next_release()
+        woken = self._wakeup.wait(timeout)
+        # clear before collecting due activities so input arriving while we run wakes the next iteration
+        self._wakeup.clear()
+        iteration_start = self.clock()
+
+        report = {
+            "iteration": self.iterations,
+            "woken": woken,
+            "slept": iteration_start - wait_start,
+            "activities": {},
+        }
+
+        for activity in self.activities:
+            with self._lock:
+                release = activity.release_time(self.clock())
+            if release is None:
+                continue
+            latency, runtime = activity.run(release, self.clock)
+            report["activities"][activity.name] = (latency, runtime)
+
+        report["total"] = self.clock() - iteration_start
+        self.iterations += 1
+        self.last_report = report
+
+        ran = ", ".join(f"{name} (latency {latency * 1000:.1f}ms, runtime {runtime * 1000:.1f}ms)"
+                        for name, (latency, runtime) in report["activities"].items())
+        logger.debug(f"Scheduler iteration {report['iteration']}: slept {report['slept']:.3f}s, ran {ran}")
+        return report
+
+    def run_forever(self):
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def stop(self):
+        self.running = False
+        self._wakeup.set()
+
+    def stats(self) -> dict:
+        """Returns {name: (runs, deadline_misses, max_latency, max_runtime)} for every activity"""
+        return {activity.name: (activity.runs, activity.deadline_misses, activity.max_latency, activity.max_runtime)
+                for activity in self.activities}
+
+
+class WakeupQueue(Queue):
+    """Queue that releases a Scheduler activity whenever an item is put on it,
+    so the activity consuming the queue runs immediately instead of waiting for its next period"""
+
+    def __init__(self, scheduler: Scheduler, activity_name: str, maxsize=0):
+        super().__init__(maxsize)
+        self.scheduler = scheduler
+        self.activity_name = activity_name
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        self.scheduler.release(self.activity_name)
@@ -1,5 +1,7 @@
 import struct
 
+from utils.constants import MAC, MAC_LENGTH, DATA_OFFSET
+
 # All packing is done in Big Endian as specified by > argument to struct module
 
 
@@ -88,6 +90,16 @@ def unpack_str(buf, off):
     sbytes = buf[off + 2: off + 2 + slen]
     return 2 + slen, str(sbytes, "utf-8")
 
+def pack_bytes(buf, off, b):
+    assert len(b) <= MAXSTRINGLEN, "trying to pack too many bytes"
+    struct.pack_into(">H%ds" % (len(b),), buf, off, len(b), b)
+    return 2 + len(b)
+
+
+def unpack_bytes(buf, off):
+    blen = struct.unpack_from(">H", buf, off)[0]
+    return 2 + blen, bytes(buf[off + 2: off + 2 + blen])
+
 packer_dict = {
 'bool': (pack_bool,unpack_bool),
 'uint8': (pack_unsigned_int8,unpack_unsigned_int8),
@@ -96,5 +108,117 @@ packer_dict = {
 'long': (pack_unsigned_long,unpack_unsigned_long),
 'float': (pack_float,unpack_float),
 'double': (pack_double,unpack_double),
-'string': (pack_str,unpack_str)
+'string': (pack_str,unpack_str),
+'bytes': (pack_bytes,unpack_bytes)
 }
+
+# struct format character of every fixed size packer, used to compile the format of a whole frame
+packer_formats = {
+    pack_bool: "?",
+    pack_unsigned_int8: "B",
+    pack_unsigned_short: "H",
+    pack_unsigned_int: "I",
+    pack_unsigned_long: "Q",
+    pack_float: "f",
+    pack_double: "d",
+}
+
+# Frame header: MAC, counter (COUNTER_SIZE = 3 bytes, split into a high byte and a low short), mode, id, data length
+FRAME_HEADER_FORMAT = ">%dsBHBBH" % MAC_LENGTH
+FRAME_HEADER = struct.Struct(FRAME_HEADER_FORMAT)
+assert FRAME_HEADER.size == DATA_OFFSET
+
+
+def unpack_frame_header(buf):
+    """Returns (mac, counter, mode, id, data length) of a command or downlink frame"""
+    mac, counter_high, counter_low, mode, frame_id, data_len = FRAME_HEADER.unpack_from(buf)
+    return mac, (counter_high << 16) | counter_low, mode, frame_id, data_len
+
+
+class FrameCodec:
+    """Serializer for every frame of one (mode, id) pair, compiled once when the pair is registered.
+    Runs of fixed size arguments (and the frame header) are packed with one precompiled struct.Struct each,
+    so a frame without strings is packed and unpacked by a single C-level call.
+    Variable length arguments (strings) use their packer/unpacker functions between the runs,
+    with the rest of the frame packed into a reused buffer.
+    [mode], [frame_id]: flight mode and command/downlink id written to the header
+    [args]: argument names in payload order
+    [size]: payload size in bytes; bytes not used by the arguments are zero
+    [packers], [unpackers]: map argument name -> packer/unpacker function"""
+
+    def __init__(self, mode: int, frame_id: int, args, size: int, packers: dict, unpackers: dict):
+        self.mode = mode
+        self.frame_id = frame_id
+        self.args = tuple(args)
+        self.size = size
+        self.frame_size = DATA_OFFSET + size
+
+        # segments are (Struct, argument names) for runs of fixed size arguments following a
+        # variable length argument, and (None, argument name, packer, unpacker) for the variable length arguments
+        self.segments = []
+        fmt = FRAME_HEADER_FORMAT
+        names = []
+        for arg in self.args:
+            packer = packers[arg]
+            if packer in packer_formats:
+                fmt += packer_formats[packer]
+                names.append(arg)
+            else:
+                self.segments.append((struct.Struct(fmt), tuple(names)))
+                self.segments.append((None, arg, packer, unpackers[arg]))
+                fmt, names = ">", []
+        if names or fmt != ">":
+            self.segments.append((struct.Struct(fmt), tuple(names)))
+        fixed_size = sum(segment[0].size for segment in self.segments if segment[0] is not None)
+        if fixed_size > self.frame_size:
+            raise ValueError(f"Arguments {self.args} need {fixed_size - DATA_OFFSET} bytes, "
+                             f"more than the {size} byte payload of mode {mode} id {frame_id}")
+
+        # the first segment always starts with the header
+        self.head, self.head_args = self.segments.pop(0)
+        if not self.segments:
+            # no variable length arguments: pad the single struct out to the full frame
+            padding = self.frame_size - fixed_size
+            self.struct = struct.Struct(fmt + "%dx" % padding if padding else fmt)
+            self.buffer = None
+        else:
+            self.struct = None
+            self.buffer = bytearray(self.frame_size)
+            self.zeros = bytes(self.frame_size)
+
+    def pack(self, counter: int, kwargs: dict) -> bytes:
+        """Returns the frame for [kwargs]. Raises KeyError for a missing argument and struct.error for a bad value"""
+        if self.struct is not None:
+            return self.struct.pack(MAC, counter >> 16, counter & 0xFFFF, self.mode, self.frame_id, self.size,
+                                    *[kwargs[arg] for arg in self.args])
+
+        buf = self.buffer
+        buf[:] = self.zeros
+        self.head.pack_into(buf, 0, MAC, counter >> 16, counter & 0xFFFF, self.mode, self.frame_id, self.size,
+                            *[kwargs[arg] for arg in self.head_args])
+        offset = self.head.size
+        for segment in self.segments:
+            packer = segment[0]
+            if packer is None:
+                offset += segment[2](buf, offset, kwargs[segment[1]])
+            else:
+                packer.pack_into(buf, offset, *[kwargs[arg] for arg in segment[1]])
+                offset += packer.size
+        return bytes(buf)
+
+    def unpack(self, buf) -> dict:
+        """Returns the arguments of a frame of this (mode, id) as a dict"""
+        if self.struct is not None:
+            return dict(zip(self.args, self.struct.unpack_from(buf)[6:]))
+
+        kwargs = dict(zip(self.head_args, self.head.unpack_from(buf)[6:]))
+        offset = self.head.size
+        for segment in self.segments:
+            unpacker = segment[0]
+            if unpacker is None:
+                off, kwargs[segment[1]] = segment[3](buf, offset)
+                offset += off
+            else:
+                kwargs.update(zip(segment[1], unpacker.unpack_from(buf, offset)))
+                offset += unpacker.size
+        return kwargs